@@ -12,6 +12,7 @@ sys.path.insert(1, partis_dir + '/python')
 
 import utils
 import glutils
+import columnarfile
 from clusterpath import ClusterPath
 
 helpstr = """
@@ -53,7 +54,29 @@ default_glfo_dir = partis_dir + '/data/germlines/human'
 if utils.getsuffix(args.infile) == '.csv' and args.glfo_dir is None:
     print '  note: reading deprecated csv format, so need to get germline info from a separate directory; --glfo-dir was not set, so using default %s. If it doesn\'t crash, it\'s probably ok.' % default_glfo_dir
     args.glfo_dir = default_glfo_dir
-glfo, annotation_list, cpath = utils.read_output(args.infile, glfo_dir=args.glfo_dir, locus=args.locus)
+# ----------------------------------------------------------------------------------------
+def read_columnar_annotations(colfile, glfo, clusters):  # read only the clusters and columns we need from a columnar file
+    keys = ['unique_ids', 'invalid', 'input_seqs']
+    if args.indel_reversed_seqs:
+        keys += ['indel_reversed_seqs']
+    if args.extra_columns is not None:
+        keys += args.extra_columns
+    if any(k not in colfile.columns for k in keys):  # if they want an implicit column, we have to read all of them and add implicit info (but still only for these clusters)
+        keys = None
+    lines = [l for l in colfile.get_cluster_events(clusters, keys=keys) if l is not None]
+    if keys is None:
+        lines = utils.parse_yaml_annotations(glfo, {'events' : lines}, -1, False, False)
+    elif args.indel_reversed_seqs:
+        for line in [l for l in lines if not l['invalid']]:
+            utils.transfer_indel_reversed_seqs(line)
+    return {':'.join(l['unique_ids']) : l for l in lines}
+
+colfile = None
+if utils.getsuffix(args.infile) == columnarfile.suffix and args.plotdir is None:  # only read partitions now, then below we read just the clusters we need
+    colfile = columnarfile.ColumnarFile(args.infile)
+    glfo, annotation_list, cpath = utils.read_output(args.infile, skip_annotations=True)
+else:
+    glfo, annotation_list, cpath = utils.read_output(args.infile, glfo_dir=args.glfo_dir, locus=args.locus)
 
 if args.plotdir is not None:
     from parametercounter import ParameterCounter
@@ -65,7 +88,7 @@ if args.plotdir is not None:
     sys.exit(0)
 
 if cpath is None or cpath.i_best is None:
-    clusters_to_use = [l['unique_ids'] for l in annotation_list]
+    clusters_to_use = [l['unique_ids'] for l in annotation_list] if colfile is None else colfile.read_column('unique_ids')
     print '  no cluster path in input file, so just using all %d sequences (in %d clusters) in annotations' % (sum(len(c) for c in clusters_to_use), len(clusters_to_use))
 else:
     ipartition = cpath.i_best if args.partition_index is None else args.partition_index
@@ -81,7 +104,10 @@ else:
         print '    removing clusters not containing sequence \'%s\' (leaving %d)' % (args.seed_unique_id, len(clusters_to_use))
 
 seqfos = []
-annotations = {':'.join(adict['unique_ids']) : adict for adict in annotation_list}  # collect the annotations in a dictionary so they're easier to access
+if colfile is None:
+    annotations = {':'.join(adict['unique_ids']) : adict for adict in annotation_list}  # collect the annotations in a dictionary so they're easier to access
+else:
+    annotations = read_columnar_annotations(colfile, glfo, clusters_to_use)
 for cluster in clusters_to_use:
     if ':'.join(cluster) not in annotations:
         print '  %s cluster with size %d not in annotations, so skipping it' % (utils.color('red', 'warning'), len(cluster))
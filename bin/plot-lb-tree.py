@@ -238,7 +238,6 @@ except ImportError as e:
 args.queries_to_include = utils.get_arg_list(args.queries_to_include)
 args.metafo = None
 if args.metafname is not None:
-    with open(args.metafname) as metafile:
-        args.metafo = yaml.load(metafile, Loader=yaml.CLoader)
+    args.metafo = utils.read_json_yaml(args.metafname)
 
 plot_trees(args)
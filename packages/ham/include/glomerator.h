@@ -52,10 +52,30 @@ public:
   pair<string, string> parents_;  // queries that were joined to make this
 };
 
+// ----------------------------------------------------------------------------------------
+// cached info (mostly read from, and written to, the cache file), which can be kept in memory across several Glomerator instances, i.e. for several steps in --worker mode
+class GlomCache {
+public:
+  GlomCache() : read_pos_(0) {}
+  void Clear();
+
+  map<string, double> log_probs_;
+  map<string, double> naive_hfracs_;  // NOTE since this uses the joint key, it assumes there's only *one* way to get to a given cluster (this is similar to, but not quite the same as, the situation for log probs and naive seqs)
+  map<string, string> naive_seqs_;
+  map<string, string> errors_;
+
+  set<string> failed_queries_;
+
+  set<string> initial_log_probs_, initial_naive_hfracs_, initial_naive_seqs_;  // keep track of the ones we read from the initial cache file so we can write only the new ones to the output cache file
+
+  string cachefname_;  // input cache file that we've read up to <read_pos_> (in --worker mode the python appends new info to the end of the same file after each step, so we only need to read the new lines)
+  streampos read_pos_;
+};
+
 // ----------------------------------------------------------------------------------------
 class Glomerator {
 public:
-  Glomerator(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> > &qry_seq_list, Args *args, Track *track);
+  Glomerator(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> > &qry_seq_list, Args *args, Track *track, GlomCache *cache=nullptr);  // if <cache> is set, we use (and add to) it instead of our own
   ~Glomerator();
   void Cluster();
   double LogProbOfPartition(Partition &clusters, bool debug=false);
@@ -154,16 +174,20 @@ private:
   map<string, Query> cachefo_;  // cache info for clusters we've actually merged
   map<string, Query> tmp_cachefo_;  // cache info for clusters we're only considering merging
 
-  // These all include cached info from previous runs
-  map<string, double> log_probs_;  
-  map<string, double> naive_hfracs_;  // NOTE since this uses the joint key, it assumes there's only *one* way to get to a given cluster (this is similar to, but not quite the same as, the situation for log probs and naive seqs)
-  map<string, double> lratios_;
-  map<string, string> naive_seqs_;
-  map<string, string> errors_;
+  GlomCache own_cache_;  // only used if we weren't passed a cache in the constructor
+  GlomCache &cache_;
 
-  set<string> failed_queries_;
+  // These all include cached info from previous runs (they're references to the maps in <cache_>)
+  map<string, double> &log_probs_;
+  map<string, double> &naive_hfracs_;
+  map<string, string> &naive_seqs_;
+  map<string, string> &errors_;
 
-  set<string> initial_log_probs_, initial_naive_hfracs_, initial_naive_seqs_;  // keep track of the ones we read from the initial cache file so we can write only the new ones to the output cache file
+  set<string> &failed_queries_;
+
+  set<string> &initial_log_probs_, &initial_naive_hfracs_, &initial_naive_seqs_;
+
+  map<string, double> lratios_;
 
   int n_fwd_calculated_, n_vtb_calculated_, n_hfrac_calculated_, n_hfrac_merges_, n_lratio_merges_;
 
@@ -22,10 +22,17 @@ using namespace std;
 
 // ----------------------------------------------------------------------------------------
 vector<vector<Sequence> > GetSeqs(Args &args, Track *trk);
+void run_step(HMMHolder &hmms, GermLines &gl, Args &args, Track *trk, GlomCache *cache=nullptr);
 void run_algorithm(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> > &qry_seq_list, Args &args);
+void run_worker();
 
 // ----------------------------------------------------------------------------------------
 int main(int argc, const char * argv[]) {
+  if(argc == 2 && string(argv[1]) == "--worker") {  // persistent worker mode: all the actual arguments come in on stdin (see run_worker())
+    run_worker();
+    return 0;
+  }
+
   clock_t run_start(clock());
   Args args(argc, argv);
   srand(args.random_seed());
@@ -35,20 +42,82 @@ int main(int argc, const char * argv[]) {
   Track track("NUKES", characters, args.ambig_base());
   GermLines gl(args.datadir(), args.locus());
   HMMHolder hmms(args.hmmdir(), gl, &track);
-  vector<vector<Sequence> > qry_seq_list(GetSeqs(args, &track));
+
+  run_step(hmms, gl, args, &track);
+
+  printf("        time: bcrham %.1f\n", ((clock() - run_start) / (double)CLOCKS_PER_SEC));
+  return 0;
+}
+
+// ----------------------------------------------------------------------------------------
+void run_step(HMMHolder &hmms, GermLines &gl, Args &args, Track *trk, GlomCache *cache) {
+  vector<vector<Sequence> > qry_seq_list(GetSeqs(args, trk));
 
   if(args.cache_naive_seqs()) {
-    Glomerator glom(hmms, gl, qry_seq_list, &args, &track);
+    Glomerator glom(hmms, gl, qry_seq_list, &args, trk, cache);
     glom.CacheNaiveSeqs();
   } else if(args.partition()) {  // NOTE this is kind of hackey -- there's some code duplication between Glomerator and the loop below... but only a little, and they're doing fairly different things, so screw it for the time being
-    Glomerator glom(hmms, gl, qry_seq_list, &args, &track);
+    Glomerator glom(hmms, gl, qry_seq_list, &args, trk, cache);
     glom.Cluster();
   } else {
     run_algorithm(hmms, gl, qry_seq_list, args);
   }
+}
 
-  printf("        time: bcrham %.1f\n", ((clock() - run_start) / (double)CLOCKS_PER_SEC));
-  return 0;
+// ----------------------------------------------------------------------------------------
+// Read one line of command line arguments at a time from stdin, and run each of them as if they'd been passed to a separate bcrham process.
+// But since we only read the hmms and germline info once, and keep the cached naive seqs and log probs in memory (so we only need to read new lines from the cache file), each step is much faster than starting a new process.
+// After each step we print a line starting with <worker_done_str> (which must match the one in python/bcrhamworkers.py), then wait for the next line.
+void run_worker() {
+  string worker_done_str("bcrham-worker-done");
+  vector<string> characters {"A", "C", "G", "T"};
+  Track *track(nullptr);
+  GermLines *gl(nullptr);
+  HMMHolder *hmms(nullptr);
+  GlomCache cache;
+  string infrastr;  // string with the args that determine the infrastructure, so we know when we need to re-initialize it
+
+  string line;
+  while(getline(cin, line)) {
+    if(line.size() == 0)
+      continue;
+    clock_t run_start(clock());
+    int status(0);
+    try {
+      vector<string> argstrs(PythonSplit(line));
+      argstrs.insert(argstrs.begin(), "bcrham");
+      vector<const char*> argv;
+      for(auto &astr : argstrs)
+	argv.push_back(astr.c_str());
+      Args args(argv.size(), argv.data());
+      srand(args.random_seed());
+
+      string new_infrastr(args.hmmdir() + " " + args.datadir() + " " + args.locus() + " " + args.ambig_base());
+      if(new_infrastr != infrastr) {  // first time through, or if they changed (which they shouldn't, in normal use)
+	delete hmms;
+	delete gl;
+	delete track;
+	track = new Track("NUKES", characters, args.ambig_base());
+	gl = new GermLines(args.datadir(), args.locus());
+	hmms = new HMMHolder(args.hmmdir(), *gl, track);
+	cache.Clear();
+	infrastr = new_infrastr;
+      }
+
+      run_step(*hmms, *gl, args, track, &cache);
+    } catch(exception &e) {
+      cerr << "bcrham worker step failed: " << e.what() << endl;
+      status = 1;
+    }
+
+    printf("        time: bcrham %.1f\n", ((clock() - run_start) / (double)CLOCKS_PER_SEC));
+    printf("%s %d\n", worker_done_str.c_str(), status);
+    fflush(stdout);
+  }
+
+  delete hmms;
+  delete gl;
+  delete track;
 }
 
 // ----------------------------------------------------------------------------------------
@@ -3,11 +3,34 @@
 namespace ham {
 
 // ----------------------------------------------------------------------------------------
-Glomerator::Glomerator(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> > &qry_seq_list, Args *args, Track *track) :
+void GlomCache::Clear() {
+  log_probs_.clear();
+  naive_hfracs_.clear();
+  naive_seqs_.clear();
+  errors_.clear();
+  failed_queries_.clear();
+  initial_log_probs_.clear();
+  initial_naive_hfracs_.clear();
+  initial_naive_seqs_.clear();
+  cachefname_ = "";
+  read_pos_ = 0;
+}
+
+// ----------------------------------------------------------------------------------------
+Glomerator::Glomerator(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> > &qry_seq_list, Args *args, Track *track, GlomCache *cache) :
   track_(track),
   args_(args),
   gl_(gl),
   hmms_(hmms),
+  cache_(cache == nullptr ? own_cache_ : *cache),
+  log_probs_(cache_.log_probs_),
+  naive_hfracs_(cache_.naive_hfracs_),
+  naive_seqs_(cache_.naive_seqs_),
+  errors_(cache_.errors_),
+  failed_queries_(cache_.failed_queries_),
+  initial_log_probs_(cache_.initial_log_probs_),
+  initial_naive_hfracs_(cache_.initial_naive_hfracs_),
+  initial_naive_seqs_(cache_.initial_naive_seqs_),
   n_fwd_calculated_(0),
   n_vtb_calculated_(0),
   n_hfrac_calculated_(0),
@@ -121,23 +144,40 @@ void Glomerator::ReadCacheFile() {
   if(!ifs.is_open())
     throw runtime_error("input cache file " + args_->input_cachefname() + " dne\n");
 
+  bool incremental(cache_.cachefname_ == args_->input_cachefname() && cache_.read_pos_ > 0);  // we already read the start of this file in a previous step (in --worker mode), so only need to read the lines that've been appended since then
+  if(incremental) {
+    ifs.seekg(0, ifs.end);
+    if(ifs.tellg() < cache_.read_pos_) {  // file was rewritten (rather than appended to), so start over
+      cache_.Clear();
+      incremental = false;
+    }
+    ifs.seekg(incremental ? cache_.read_pos_ : streampos(0));
+  }
+
   string line;
-  // check the header is right (no cached info)
-  if(!getline(ifs, line)) {
-    cout << "        empty cachefile" << endl;
-    return;  // return for zero length file
+  if(!incremental) {  // check the header is right (no cached info)
+    if(!getline(ifs, line)) {
+      cout << "        empty cachefile" << endl;
+      return;  // return for zero length file
+    }
+    line.erase(remove(line.begin(), line.end(), '\r'), line.end());
+    vector<string> headstrs(SplitString(line, ","));
+    assert(headstrs[0].find("unique_ids") == 0);  // these have to match the line in WriteCacheFile(), as well as partition_cachefile_headers in utils.py
+    assert(headstrs[1].find("logprob") == 0);
+    assert(headstrs[2].find("naive_seq") == 0);
+    assert(headstrs[3].find("naive_hfrac") == 0);
+    assert(headstrs[4].find("errors") == 0);
+    cache_.cachefname_ = args_->input_cachefname();
+    cache_.read_pos_ = ifs.tellg();
   }
-  line.erase(remove(line.begin(), line.end(), '\r'), line.end());
-  vector<string> headstrs(SplitString(line, ","));
-  assert(headstrs[0].find("unique_ids") == 0);  // these have to match the line in WriteCacheFile(), as well as partition_cachefile_headers in utils.py
-  assert(headstrs[1].find("logprob") == 0);
-  assert(headstrs[2].find("naive_seq") == 0);
-  assert(headstrs[3].find("naive_hfrac") == 0);
-  assert(headstrs[4].find("errors") == 0);
 
   // NOTE there can be two lines with the same key (say if in one run we calculated the naive seq, and in a later run calculated the log prob)
   while(getline(ifs, line)) {
+    if(ifs.tellg() != streampos(-1))  // i.e. unless we hit the end of the file without a trailing newline
+      cache_.read_pos_ = ifs.tellg();
     line.erase(remove(line.begin(), line.end(), '\r'), line.end());
+    if(line.size() == 0)
+      continue;
     vector<string> column_list = SplitString(line, ",");
     assert(column_list.size() == 5);
     string query(column_list[0]);
@@ -166,7 +206,7 @@ void Glomerator::ReadCacheFile() {
       initial_naive_seqs_.insert(query);
     }
   }
-  cout << "        read-cache:  logprobs " << log_probs_.size() << "   naive-seqs " << naive_seqs_.size() << endl;
+  cout << "        read-cache:  logprobs " << initial_log_probs_.size() << "   naive-seqs " << initial_naive_seqs_.size() << endl;  // NOTE these are the same as the sizes of <log_probs_> and <naive_seqs_>, except in --worker mode, where those also include things we calculated (and that every other worker doesn't know about) in previous steps
 }
 
 // ----------------------------------------------------------------------------------------
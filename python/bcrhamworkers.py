@@ -0,0 +1,107 @@
+import os
+import sys
+import subprocess
+
+import utils
+
+worker_done_str = 'bcrham-worker-done'  # has to match the string in packages/ham/src/bcrham.cc
+
+# ----------------------------------------------------------------------------------------
+class BcrhamWorkerPool(object):
+    """
+    Pool of persistent bcrham processes, started with --worker, to which we send one command line per clustering step (instead of starting a new bcrham process for each step).
+    Each worker only reads the hmm yamls and germline info once, and keeps cached naive seqs and log probs in memory between steps (so it only has to read the new lines that we append to the cache file after each step).
+    """
+    def __init__(self, bcrham_binary, n_workers, workdir, debug=False):
+        self.workdir = workdir + '/bcrham-workers'
+        self.debug = debug
+        utils.prep_dir(self.workdir)
+        self.procs, self.errfiles, self.errreaders = [], [], []
+        for iworker in range(n_workers):
+            self.errfiles.append(open(self.errfname(iworker), 'w'))
+            self.errreaders.append(open(self.errfname(iworker)))
+            self.procs.append(subprocess.Popen([bcrham_binary, '--worker'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.errfiles[-1]))
+        if self.debug:
+            print '    started %d persistent bcrham worker%s' % (n_workers, utils.plural(n_workers))
+
+    # ----------------------------------------------------------------------------------------
+    def errfname(self, iworker):
+        return '%s/err-%d' % (self.workdir, iworker)
+
+    # ----------------------------------------------------------------------------------------
+    def n_workers(self):
+        return len(self.procs)
+
+    # ----------------------------------------------------------------------------------------
+    def read_step_output(self, iworker):  # read stdout from <iworker> until it tells us it's finished this step (returns None for status if it died)
+        outlines, status = [], None
+        while True:
+            line = self.procs[iworker].stdout.readline()
+            if line == '':  # EOF, i.e. worker died
+                break
+            if line.find(worker_done_str) == 0:
+                status = int(line.split()[1])
+                break
+            outlines.append(line)
+        return ''.join(outlines), status
+
+    # ----------------------------------------------------------------------------------------
+    # Run one step with one command (from <cmdfos>, which should be formatted as for utils.run_cmds()) on each of the first len(cmdfos) workers.
+    # Then write each worker's stdout/stderr to the usual files in 'logdir', so we can use the same processing fcn as for normal subprocesses.
+    # Returns list of indices of cmdfos that failed (which the calling fcn should rerun as normal subprocesses).
+    def run(self, cmdfos, debug=None):
+        if len(cmdfos) > self.n_workers():
+            raise Exception('asked to run %d commands, but only have %d workers' % (len(cmdfos), self.n_workers()))
+        for iproc, cmdfo in enumerate(cmdfos):
+            cmd_words = cmdfo['cmd_str'].split()
+            self.procs[iproc].stdin.write(' '.join(cmd_words[1:]) + '\n')  # first word is the bcrham binary
+            self.procs[iproc].stdin.flush()
+
+        failed_iprocs = []
+        for iproc, cmdfo in enumerate(cmdfos):
+            outstr, status = self.read_step_output(iproc)
+            logdir = cmdfo.get('logdir', cmdfo['workdir'])
+            with open(logdir + '/out', 'w') as outfile:
+                outfile.write(outstr)
+            with open(logdir + '/err', 'w') as errfile:
+                errfile.write(self.errreaders[iproc].read())  # only has what was written since the last time we read it
+            if status != 0 or not os.path.exists(cmdfo['outfname']):
+                print '    %s bcrham worker %d %s (status %s), will rerun as normal subprocess' % (utils.color('yellow', 'warning'), iproc, 'died' if status is None else 'failed', status)
+                failed_iprocs.append(iproc)
+                continue
+            utils.process_out_err(logdir, extra_str='' if len(cmdfos) == 1 else str(iproc), dbgfo=cmdfo.get('dbgfo'), cmd_str=cmdfo['cmd_str'], debug=debug)
+        sys.stdout.flush()
+
+        if len(failed_iprocs) > 0:  # if any of them died, it's not worth trying to figure out which are still ok, just give up on all of them
+            self.close()
+            for iproc in failed_iprocs:  # clean up so run_cmds() can start from scratch
+                for ltype in ['out', 'err']:
+                    fname = cmdfos[iproc].get('logdir', cmdfos[iproc]['workdir']) + '/' + ltype
+                    if os.path.exists(fname):
+                        os.remove(fname)
+
+        return failed_iprocs
+
+    # ----------------------------------------------------------------------------------------
+    def is_open(self):
+        return len(self.procs) > 0
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        if not self.is_open():
+            return
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.stdin.close()  # worker exits when it reaches EOF on stdin
+        for iworker, proc in enumerate(self.procs):
+            proc.wait()
+            self.errfiles[iworker].close()
+            leftover_err = self.errreaders[iworker].read()
+            if len(leftover_err.strip()) > 0:
+                print '    bcrham worker %d stderr:\n%s' % (iworker, utils.pad_lines(leftover_err))
+            self.errreaders[iworker].close()
+            os.remove(self.errfname(iworker))
+        os.rmdir(self.workdir)
+        self.procs, self.errfiles, self.errreaders = [], [], []
+        if self.debug:
+            print '    closed bcrham workers'
@@ -0,0 +1,131 @@
+import os
+import json
+import glob
+import shutil
+import random
+import hashlib
+
+from clusterpath import ClusterPath
+
+state_fname = 'state.json'
+cache_fname = 'hmm_cached_info.csv'
+progress_subdir = 'cluster-path-progress'
+
+# ----------------------------------------------------------------------------------------
+class PartitionCheckpoint(object):
+    """
+    Persist the state of a partition run after each clustering step, so that if it dies we can --resume from the last completed step.
+    The checkpoint dir has a json file with the loop state (step index, n_procs history and next n_procs, timing info, removed seeded/small-cluster seqs, random state, and how much of the hmm cache is valid), plus the current cluster path, a copy of each step's cpath progress file, and a copy of the hmm cache file.
+    Since the hmm cache is usually only appended to during clustering, we only copy the bytes that were added since the last checkpoint (the json state, which is written last and atomically, records how many bytes of the copy are valid, plus a hash of the copied part so we can tell if the cache file was rewritten, in which case we copy the whole thing).
+    """
+    def __init__(self, cpdir, queries):
+        self.cpdir = cpdir
+        self.input_hash = hashlib.md5(':'.join(sorted(queries))).hexdigest()  # make sure we don't resume with different input
+        if not os.path.exists(self.cpdir):
+            os.makedirs(self.cpdir)
+        if not os.path.exists(self.fname(progress_subdir)):
+            os.makedirs(self.fname(progress_subdir))
+
+    # ----------------------------------------------------------------------------------------
+    def fname(self, basename):
+        return '%s/%s' % (self.cpdir, basename)
+
+    # ----------------------------------------------------------------------------------------
+    def exists(self):
+        return os.path.exists(self.fname(state_fname))
+
+    # ----------------------------------------------------------------------------------------
+    def clear(self):  # remove everything from a previous run (if we're not resuming, we don't want to mix its state and progress files with ours)
+        if os.path.exists(self.fname(state_fname)):
+            print '  removing existing checkpoint in %s (set --resume to use it)' % self.cpdir
+        for fn in [state_fname, state_fname + '.tmp', cache_fname] + [os.path.basename(f) for f in glob.glob(self.fname('cpath-istep-*.csv'))]:
+            if os.path.exists(self.fname(fn)):
+                os.remove(self.fname(fn))
+        for fn in glob.glob(self.fname(progress_subdir) + '/*'):
+            os.remove(fn)
+
+    # ----------------------------------------------------------------------------------------
+    def read_state(self):
+        with open(self.fname(state_fname)) as statefile:
+            state = json.load(statefile)
+        if state['input-hash'] != self.input_hash:
+            raise Exception('checkpoint in %s is for different input queries than the current run' % self.cpdir)
+        return state
+
+    # ----------------------------------------------------------------------------------------
+    def prefix_hash(self, fname, size, chunk_size=2**16):  # hash of the start of <fname>, and of the bytes just before <size> (enough to tell if a file that we'd copied up to <size> has since been rewritten, rather than just appended to)
+        md5 = hashlib.md5()
+        with open(fname, 'rb') as infile:
+            md5.update(infile.read(min(size, chunk_size)))
+            infile.seek(max(0, size - chunk_size))
+            md5.update(infile.read(min(size, chunk_size)))
+        return md5.hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def save_cache(self, hmm_cachefname, last_state):  # copy new bytes from the hmm cache file to our copy, returning (number of valid bytes, prefix hash)
+        if not os.path.exists(hmm_cachefname):
+            return 0, None
+        cpfname = self.fname(cache_fname)
+        new_size = os.path.getsize(hmm_cachefname)
+        old_size = 0 if last_state is None else last_state['cache-size']
+        if new_size < old_size or not os.path.exists(cpfname) or os.path.getsize(cpfname) < old_size:  # cache file got smaller (or we lost part of our copy), so start over
+            old_size = 0
+        elif old_size > 0 and self.prefix_hash(hmm_cachefname, old_size) != last_state.get('cache-hash'):  # single-proc bcrham steps rewrite the whole cache file (in sorted order), so it's not just appended to
+            old_size = 0
+        with open(hmm_cachefname, 'rb') as infile, open(cpfname, 'r+b' if old_size > 0 else 'wb') as outfile:
+            infile.seek(old_size)
+            outfile.seek(old_size)
+            outfile.truncate()  # remove anything left over from a checkpoint that didn't finish
+            shutil.copyfileobj(infile, outfile)
+        return new_size, self.prefix_hash(cpfname, new_size)
+
+    # ----------------------------------------------------------------------------------------
+    def save(self, istep, cpath, n_proc_list, next_n_procs, hmm_cachefname, progress_fnames, extra_state, finished_clustering=False):
+        last_state = self.read_state() if self.exists() else None
+        for pfname in progress_fnames:  # each one only gets written once, so only need to copy the new ones
+            cpfname = self.fname('%s/%s' % (progress_subdir, os.path.basename(pfname)))
+            if not os.path.exists(cpfname):
+                shutil.copy(pfname, cpfname)
+        cpath_fname = 'cpath-istep-%d%s.csv' % (istep, '-finished' if finished_clustering else '')  # new name each time, so the old one is still there if we die before writing the new state
+        cpath.write(self.fname(cpath_fname), is_data=True)
+        state = {'input-hash' : self.input_hash,
+                 'istep' : istep,
+                 'n-proc-list' : n_proc_list,
+                 'next-n-procs' : next_n_procs,
+                 'n-progress-files' : len(progress_fnames),
+                 'finished-clustering' : finished_clustering,
+                 'cpath-fname' : cpath_fname,
+                 'random-state' : random.getstate()}
+        state['cache-size'], state['cache-hash'] = self.save_cache(hmm_cachefname, last_state)
+        state.update(extra_state)
+        with open(self.fname(state_fname) + '.tmp', 'w') as statefile:
+            json.dump(state, statefile)
+        os.rename(self.fname(state_fname) + '.tmp', self.fname(state_fname))
+        if last_state is not None and last_state['cpath-fname'] != cpath_fname:
+            os.remove(self.fname(last_state['cpath-fname']))
+
+    # ----------------------------------------------------------------------------------------
+    def restore_cache(self, hmm_cachefname):  # copy the valid part of our cache file copy to <hmm_cachefname>
+        state = self.read_state()
+        with open(self.fname(cache_fname), 'rb') as infile, open(hmm_cachefname, 'wb') as outfile:
+            n_remaining = state['cache-size']
+            while n_remaining > 0:
+                chunk = infile.read(min(n_remaining, 2**20))
+                if chunk == '':
+                    raise Exception('checkpoint hmm cache file %s shorter than expected' % self.fname(cache_fname))
+                outfile.write(chunk)
+                n_remaining -= len(chunk)
+
+    # ----------------------------------------------------------------------------------------
+    def restore(self, progress_fname_fcn, seed_unique_id=None):  # returns (state, cpath), and copies the cpath progress files to where <progress_fname_fcn(istep)> says they should be
+        state = self.read_state()
+        for ipf in range(state['n-progress-files']):
+            pfname = progress_fname_fcn(ipf)
+            if not os.path.exists(os.path.dirname(pfname)):
+                os.makedirs(os.path.dirname(pfname))
+            shutil.copy(self.fname('%s/%s' % (progress_subdir, os.path.basename(pfname))), pfname)
+        rstate = state['random-state']
+        random.setstate((rstate[0], tuple(rstate[1]), rstate[2]))  # json turns tuples into lists
+        cpath = ClusterPath(fname=self.fname(state['cpath-fname']), seed_unique_id=seed_unique_id)
+        print '  resuming from checkpoint in %s: %s step %d with %d clusters (n_procs history: %s)' % (self.cpdir, 'finished clustering after' if state['finished-clustering'] else 'starting', state['istep'], len(cpath.partitions[cpath.i_best_minus_x]), ' '.join(str(n) for n in state['n-proc-list']))
+        return state, cpath
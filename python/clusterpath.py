@@ -10,6 +10,7 @@ import numpy
 
 import utils
 import treeutils
+import columnarfile
 
 # ----------------------------------------------------------------------------------------
 # print a single partition without having to make a cluster path
@@ -17,13 +18,152 @@ def ptnprint(partition, **kwargs):
     ClusterPath(partition=partition).print_partitions(**kwargs)
 
 # ----------------------------------------------------------------------------------------
+def get_merge_groups(prev_partition, partition):  # if each cluster in <partition> is exactly (including uid order) the concatenation of some clusters in <prev_partition>, with each of them used once, return a list with the indices of those clusters for each cluster in <partition> (otherwise return None)
+    prev_icluster = {}
+    for iclust, cluster in enumerate(prev_partition):
+        for uid in cluster:
+            prev_icluster[uid] = iclust
+    if len(prev_icluster) != sum(len(c) for c in prev_partition):  # uid in more than one cluster (happens e.g. with the seed uid in earlier partitions with n_procs > 1)
+        return None
+    groups, n_used = [], 0
+    for cluster in partition:
+        group, pos = [], 0
+        while pos < len(cluster):
+            iclust = prev_icluster.get(cluster[pos])
+            if iclust is None:
+                return None
+            prev_cluster = prev_partition[iclust]
+            if cluster[pos : pos + len(prev_cluster)] != prev_cluster:
+                return None
+            group.append(iclust)
+            pos += len(prev_cluster)
+        groups.append(group)
+        n_used += len(group)
+    if n_used != len(prev_partition) or len(set(i for g in groups for i in g)) != n_used:
+        return None
+    return groups
+
+# ----------------------------------------------------------------------------------------
+def apply_merge_groups(prev_partition, groups):  # inverse of get_merge_groups() (each entry in <groups> can also be a bare int for a cluster that didn't change, which is how they're written to file)
+    return [list(prev_partition[g]) if isinstance(g, int) else [u for ic in g for u in prev_partition[ic]] for g in groups]
+
+# ----------------------------------------------------------------------------------------
+class MergeLogPartitions(object):
+    """
+    List-like (indexing, len, iteration, append, pop, item assignment) store for a cluster path's partitions, which keeps memory from growing as (n partitions) * (n uids).
+    Uids are replaced by integer ids, and instead of each full partition we store either a snapshot (flat array of uid ids plus cluster ends) or the merges since the previous partition (for each cluster, which previous clusters it's made of).
+    Partitions are rebuilt when they're accessed (starting from the nearest snapshot or cached partition), and we keep the last few that we built.
+    NOTE you get back a new copy of the partition each time, so modifying it in place doesn't change what's stored -- use item assignment for that.
+    Since copying is O(n uids), read-only callers that access the same partition many times should either keep the copy they got, or use get_cached(), which returns the cached partition itself (so don't modify it).
+    """
+    def __init__(self, partitions=None, snapshot_interval=20, n_cached=4):
+        self.uids, self.uid_ids = [], {}
+        self.entries = []  # (is_snapshot, uid ids or source cluster indices, cluster/group ends) for each partition
+        self.snapshot_interval = snapshot_interval  # max number of merge steps between snapshots (so we never have to replay too many to get to a partition)
+        self.n_cached = n_cached
+        self.cache = collections.OrderedDict()
+        for partition in partitions if partitions is not None else []:
+            self.append(partition)
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.entries)
+
+    # ----------------------------------------------------------------------------------------
+    def __iter__(self):
+        for ip in range(len(self)):
+            yield self[ip]
+
+    # ----------------------------------------------------------------------------------------
+    def get_ip(self, ip):
+        if ip < 0:
+            ip += len(self)
+        if ip < 0 or ip >= len(self):
+            raise IndexError('partition index %d out of range for %d partitions' % (ip, len(self)))
+        return ip
+
+    # ----------------------------------------------------------------------------------------
+    def add_to_cache(self, ip, partition):
+        self.cache[ip] = partition
+        while len(self.cache) > self.n_cached:
+            self.cache.popitem(last=False)
+
+    # ----------------------------------------------------------------------------------------
+    def get_cached(self, ip):  # return the cached partition at <ip>, building it if necessary (NOTE don't modify it)
+        ip = self.get_ip(ip)
+        if ip in self.cache:
+            self.cache[ip] = self.cache.pop(ip)  # move to end, so it's the last to get removed
+            return self.cache[ip]
+        istart = ip
+        while istart not in self.cache and not self.entries[istart][0]:  # go back to the nearest cached or snapshot partition
+            istart -= 1
+        if istart in self.cache:
+            partition = self.cache[istart]
+        else:
+            _, vals, ends = self.entries[istart]
+            vals = vals.tolist()
+            partition = [[self.uids[i] for i in vals[s : e]] for s, e in zip([0] + ends.tolist()[:-1], ends.tolist())]
+        for jp in range(istart + 1, ip + 1):
+            _, vals, ends = self.entries[jp]
+            vals = vals.tolist()
+            partition = [[u for ic in vals[s : e] for u in partition[ic]] for s, e in zip([0] + ends.tolist()[:-1], ends.tolist())]
+        self.add_to_cache(ip, partition)
+        return partition
+
+    # ----------------------------------------------------------------------------------------
+    def __getitem__(self, ip):
+        return [list(c) for c in self.get_cached(ip)]  # copy, so callers can't modify the cached partition
+
+    # ----------------------------------------------------------------------------------------
+    def encode(self, ip, partition):  # entry for <partition> at index <ip>, given that the entries before it are already set
+        groups = None
+        if ip > 0 and any(self.entries[ip - i][0] for i in range(1, min(ip, self.snapshot_interval) + 1)):  # don't bother diffing if we need a snapshot anyway
+            groups = get_merge_groups(self.get_cached(ip - 1), partition)
+        if groups is not None:
+            return (False, numpy.array([i for g in groups for i in g], dtype=numpy.int32), numpy.cumsum([len(g) for g in groups], dtype=numpy.int64))
+        for cluster in partition:
+            for uid in cluster:
+                if uid not in self.uid_ids:
+                    self.uid_ids[uid] = len(self.uids)
+                    self.uids.append(uid)
+        return (True, numpy.array([self.uid_ids[u] for c in partition for u in c], dtype=numpy.int32), numpy.cumsum([len(c) for c in partition], dtype=numpy.int64))
+
+    # ----------------------------------------------------------------------------------------
+    def append(self, partition):
+        self.entries.append(self.encode(len(self), partition))
+        self.add_to_cache(len(self) - 1, [list(c) for c in partition])  # copy, so modifying the caller's partition doesn't get our cache out of sync
+
+    # ----------------------------------------------------------------------------------------
+    def reset_entries(self, ip, partitions):  # re-encode entries starting from <ip> with the (already built) <partitions>
+        self.cache.clear()
+        for jp, partition in enumerate(partitions):
+            self.entries[ip + jp] = self.encode(ip + jp, partition)
+
+    # ----------------------------------------------------------------------------------------
+    def __setitem__(self, ip, partition):
+        ip = self.get_ip(ip)
+        self.cache.clear()
+        following = [self[ip + 1]] if ip + 1 < len(self) else []  # the next one is the only other entry that depends on this one
+        self.reset_entries(ip, [partition] + following)
+
+    # ----------------------------------------------------------------------------------------
+    def pop(self, ip=-1):
+        ip = self.get_ip(ip)
+        self.cache.clear()
+        popped = self[ip]
+        following = [self[ip + 1]] if ip + 1 < len(self) else []
+        self.entries.pop(ip)
+        self.reset_entries(ip, following)
+        return popped
+
+    # ----------------------------------------------------------------------------------------
 class ClusterPath(object):
     def __init__(self, initial_path_index=0, seed_unique_id=None, partition=None, fname=None, partition_lines=None):  # <partition> is a fully-formed partition, while <partition_lines> is straight from reading a file (perhaps could combine them, but I don't want to think through it now)
         # could probably remove path index since there's very little chance of doing smc in the future, but the path-merging code in glomerator was _very_ difficult to write, so I'm reluctant to nuke it
         self.initial_path_index = initial_path_index  # NOTE this is set to None if it's nonsensical, e.g. if we're merging several paths with different indices
 
         # NOTE make *damn* sure if you add another list here that you also take care of it in remove_first_partition()
-        self.partitions = []  # it would of course be damn nice to glomph these into a class at some point
+        self.partitions = MergeLogPartitions()  # list-like, but stores merges between successive partitions rather than each full partition
         self.logprobs = []
         self.n_procs = []
         self.ccfs = []  # pair of floats (not just a float) for each partition
@@ -34,6 +174,8 @@ class ClusterPath(object):
         self.i_best, self.i_best_minus_x = None, None
         self.we_have_a_ccf = False  # did we read in at least one adj mi value from a file?
         self.trees = None  # list of trees corresponding to clusters in most likely partition
+        self.sub_paths = None  # cached sub paths (partitions restricted to each cluster in the most likely partition) for make_trees()
+        self.sub_paths_best_partition = None  # most likely partition corresponding to self.sub_paths (differs from self.best() if we had to deduplicate the seed uid)
 
         self.seed_unique_id = seed_unique_id
 
@@ -45,7 +187,9 @@ class ClusterPath(object):
             self.readlines(partition_lines)
 
     # ----------------------------------------------------------------------------------------
-    def best(self):  # return best partition NOTE adding this very late, so there's a ton of places where i could go back and use it
+    def best(self, readonly=False):  # return best partition NOTE adding this very late, so there's a ton of places where i could go back and use it
+        if readonly:  # no copy (see MergeLogPartitions), so don't modify it
+            return self.partitions.get_cached(self.i_best)
         return self.partitions[self.i_best]
 
     # ----------------------------------------------------------------------------------------
@@ -88,7 +232,7 @@ class ClusterPath(object):
         if ccfs is None:
             ccfs = [None, None]
         # NOTE you typically want to allow duplicate (in terms of log prob) partitions, since they can have different n procs
-        self.partitions.append(partition)  # NOTE not deep copied
+        self.partitions.append(partition)  # NOTE stored in encoded form, so later modifying <partition> has no effect
         self.logprobs.append(logprob)
         self.n_procs.append(n_procs)
         self.logweights.append(logweight)
@@ -102,6 +246,7 @@ class ClusterPath(object):
             self.i_best = len(self.partitions) - 1
         self.update_best_minus_x_partition()
         self.trees = None  # they'll be out of date if the best partition changed (so I guess in principle we could only do this if self.i_best changes, but this seems tidier)
+        self.sub_paths, self.sub_paths_best_partition = None, None
 
     # ----------------------------------------------------------------------------------------
     def remove_partition(self, ip_to_remove):  # NOTE doesn't update self.we_have_a_ccf, but it probably won't change, right?
@@ -118,6 +263,7 @@ class ClusterPath(object):
                 self.i_best = ip
         self.update_best_minus_x_partition()
         self.trees = None  # they'll be out of date if the best partition changed (so I guess in principle we could only do this if self.i_best changes, but this seems tidier)
+        self.sub_paths, self.sub_paths_best_partition = None, None
 
     # ----------------------------------------------------------------------------------------
     def readfile(self, fname):
@@ -133,13 +279,14 @@ class ClusterPath(object):
                     raise Exception('\'partition\' not among headers in %s, maybe this isn\'t a partition file? (if you\'re running \'view-output\' on a deprecated csv output file, you may need to run \'view-annotations\' instead, to tell it that this is an annotation file rather than a partition file)' % fname)
                 lines = [line for line in reader]  # not sure that I really need this step
             self.readlines(lines, process_csv=True)
-        elif utils.getsuffix(fname) == '.yaml':
-            utils.read_yaml_output(fname, cpath=self)
+        elif utils.getsuffix(fname) in ['.yaml', columnarfile.suffix]:
+            utils.read_yaml_output(fname, cpath=self, skip_annotations=True)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
 
     # ----------------------------------------------------------------------------------------
     def readlines(self, lines, process_csv=False):
+        last_partition = None  # lines written with <compact> set in get_partition_lines() only have the merges since the previous line
         for line in lines:
             if 'path_index' in line and int(line['path_index']) != self.initial_path_index:  # if <lines> contains more than one path_index, that means they represent more than one path, so you need to use glomerator, not just one ClusterPath
                 raise Exception('path index in lines %d doesn\'t match my initial path index %d' % (int(line['path_index']), self.initial_path_index))
@@ -151,6 +298,11 @@ class ClusterPath(object):
 
             if process_csv:
                 line['partition'] = [cluster_str.split(':') for cluster_str in line['partition'].split(';')]
+            if 'partition' not in line:
+                if last_partition is None:
+                    raise Exception('first partition line has merges (%s) but no partition' % ' '.join(sorted(line)))
+                line['partition'] = apply_merge_groups(last_partition, line['partition_merges'])
+            last_partition = line['partition']
 
             ccfs = [None, None]
             if 'ccf_under' in line and 'ccf_over' in line:  # I don't know what I want to do if there's one but not the other, but it shouldn't be possible
@@ -323,7 +475,8 @@ class ClusterPath(object):
                 writer.writerow(row)
 
     # ----------------------------------------------------------------------------------------
-    def get_partition_lines(self, is_data, reco_info=None, true_partition=None, n_to_write=None, calc_missing_values='none', path_index=None):  # we use this (instead of .write()) if we're writing a yaml file
+    def get_partition_lines(self, is_data, reco_info=None, true_partition=None, n_to_write=None, calc_missing_values='none', path_index=None, compact=False):  # we use this (instead of .write()) if we're writing a yaml file
+        # if <compact> is set, lines whose partition can be made by merging clusters in the previous line's partition have 'partition_merges' (for each cluster, either the index of the unchanged cluster in the previous partition, or a list of indices of the clusters it's made of) instead of 'partition' (only for yaml, since csv needs the full partition)
         if not is_data:
             assert reco_info is not None and true_partition is not None  # we could get the true_partition if we have reco_info, but easier to just make the caller do it
         assert calc_missing_values in ['none', 'all', 'best']
@@ -332,6 +485,7 @@ class ClusterPath(object):
 
         headers = self.get_headers(is_data)
         lines = []
+        last_part = None
         for ipart in self.get_surrounding_partitions(n_to_write):
             part = self.partitions[ipart]
 
@@ -339,6 +493,11 @@ class ClusterPath(object):
                    'n_clusters' : len(part),
                    'n_procs' : self.n_procs[ipart],
                    'partition' : part}
+            groups = get_merge_groups(last_part, part) if compact and last_part is not None else None
+            if groups is not None:
+                del row['partition']
+                row['partition_merges'] = [g[0] if len(g) == 1 else g for g in groups]
+            last_part = part
             if 'ccf_under' in headers:
                 if reco_info is not None and calc_missing_values == 'best' and ipart == self.i_best:
                     self.calculate_missing_values(reco_info, only_ip=ipart)
@@ -412,6 +571,7 @@ class ClusterPath(object):
     # make tree for the single cluster in the last partition of <partitions> (which is in general *not* the last partition in self.partitions, since the calling function stops at self.i_best)
     def make_single_tree(self, partitions, annotations, uid_set, naive_seq_name, get_fasttrees=False, n_max_cons_seqs=10, debug=False):
         # NOTE don't call this externally -- if you want a single tree, call make_trees() with <i_only_cluster> set
+        uid_line_indices = {}
         def getline(uidstr, uid_set=None):
             if uidstr == naive_seq_name:
                 assert False  # shouldn't actually happen (I think)
@@ -421,10 +581,13 @@ class ClusterPath(object):
                 if uid_set is None:
                     uid_set = set(uidstr.split(':'))  # should only get called if it's a singleton
                 # note that for internal nodes in a fasttree-derived subtree, the uids will be out of order compared the the annotation keys
-                for line in annotations.values():  # we may actually have the annotation for every subcluster (e.g. if --calculate-alternative-annotations was set), but in case we don't, this is fine
-                    # print uid_set, len(uid_set & set(line['unique_ids']))
-                    if len(uid_set & set(line['unique_ids'])) > 0:  # just take the first one with any overlap. Yeah, it's not necessarily the best, but its naive sequence probably isn't that different, and for just getting the fasttree it reeeeeeaaaallly doesn't matter
-                        return line
+                if len(uid_line_indices) == 0:  # index of first line (in <annotations> order) containing each uid
+                    for iline, line in enumerate(annotations.values()):
+                        for uid in line['unique_ids']:
+                            uid_line_indices.setdefault(uid, iline)
+                ilines = [uid_line_indices[u] for u in uid_set if u in uid_line_indices]
+                if len(ilines) > 0:  # just take the first line with any overlap. Yeah, it's not necessarily the best, but its naive sequence probably isn't that different, and for just getting the fasttree it reeeeeeaaaallly doesn't matter (we may actually have the annotation for every subcluster, e.g. if --calculate-alternative-annotations was set, but in case we don't, this is fine)
+                    return annotations.values()[min(ilines)]
             raise Exception('couldn\'t find uid %s in annotations' % uidstr)
         def getseq(uid):
             if uid == naive_seq_name:
@@ -444,25 +607,27 @@ class ClusterPath(object):
         default_edge_length = 999999  # it's nice to have the edges all set to something that's numeric (so the trees print), but also obvious wrong, if we forget to set somebody
         assert len(partitions[-1]) == 1
         root_label = lget(partitions[-1][0])  # we want the order of the uids in the label to correspond to the order in self.partitions
-        tns = dendropy.TaxonNamespace([root_label])
-        root_node = dendropy.Node(taxon=tns.get_taxon(root_label))
-        root_node.uids = uid_set  # each node keeps track of the uids of its children
+        merge_nodes = self.replay_merges(partitions)
+        tns = dendropy.TaxonNamespace()
+        def make_node(mnode):
+            dnode = dendropy.Node(taxon=dendropy.Taxon(lget(mnode['cluster'])), edge_length=default_edge_length)
+            tns.add_taxon(dnode.taxon)
+            dnode.uids = set(mnode['cluster']) if len(mnode['children']) == 0 else None  # leaves keep track of their uids (we don't need them for internal nodes)
+            return dnode
+        root_mnode = merge_nodes[-1]
+        root_node = make_node(root_mnode)
         dtree = dendropy.Tree(taxon_namespace=tns, seed_node=root_node, is_rooted=True)
         if debug:
             print '    starting tree with %d leaves' % len(uid_set)
-        for ipart in reversed(range(len(partitions) - 1)):  # dendropy seems to only have fcns to build a tree from the root downward, so we loop starting with the last partition (- 1 is because the last partition is guaranteed to be just one cluster)
-            for lnode in dtree.leaf_node_iter():  # look for leaf nodes that contain uids from two clusters in this partition, and add those as children
-                tclusts = [c for c in partitions[ipart] if len(set(c) & lnode.uids) > 0]
-                if len(tclusts) < 2:
-                    continue
-                for tclust in tclusts:
-                    ttaxon = dendropy.Taxon(lget(tclust))
-                    tns.add_taxon(ttaxon)
-                    child = lnode.new_child(taxon=ttaxon, edge_length=default_edge_length)
-                    child.uids = set(tclust)
-                if debug:
-                    print '      ipart %d' % ipart
-                    print '        split node: %d --> %s      %s --> %s' % (len(lnode.uids), ' '.join([str(len(tc)) for tc in tclusts]), lnode.taxon.label, ' '.join([c.taxon.label for c in lnode.child_node_iter()]))
+        nodes_to_add = [(root_node, root_mnode)]  # dendropy seems to only have fcns to build a tree from the root downward, so we go from the root down through the merges
+        while len(nodes_to_add) > 0:
+            dnode, mnode = nodes_to_add.pop()
+            for ichild in mnode['children']:
+                child = make_node(merge_nodes[ichild])
+                dnode.add_child(child)
+                nodes_to_add.append((child, merge_nodes[ichild]))
+            if debug and len(mnode['children']) > 0:
+                print '        split node: %d --> %s      %s --> %s' % (sum(len(merge_nodes[i]['cluster']) for i in mnode['children']), ' '.join([str(len(merge_nodes[i]['cluster'])) for i in mnode['children']]), dnode.taxon.label, ' '.join([c.taxon.label for c in dnode.child_node_iter()]))
 
         # split existing leaves, which are probably not singletons (they're probably from the initial naive sequence collapse step) into subtrees such that each leaf is a singleton
         for lnode in dtree.leaf_node_iter():
@@ -575,20 +740,89 @@ class ClusterPath(object):
 
         return new_partitions
 
+    # ----------------------------------------------------------------------------------------
+    def replay_merges(self, partitions):  # go forward through <partitions> (which must be hierarchical, i.e. each cluster is a union of clusters in the previous partition), keeping track of which clusters merged in each step with a union-find over uids
+        # returns list of nodes, each a dict with 'cluster' (the most recent cluster with the node's uids, i.e. the one just before it merged with something) and 'children' (indices in the list), where the last node is the root (only makes sense if the last partition is one cluster)
+        uf_parents = {}  # union-find parent of each uid (roots are the first uid in the node's cluster at the time the node was created)
+        def find(uid):
+            root = uid
+            while uf_parents[root] != root:
+                root = uf_parents[root]
+            while uf_parents[uid] != root:  # path compression
+                uf_parents[uid], uid = root, uf_parents[uid]
+            return root
+        nodes, root_inodes = [], {}  # <root_inodes>: index in <nodes> for each union-find root
+        def add_node(cluster, iclust, children):
+            root_inodes[cluster[0]] = len(nodes)
+            nodes.append({'cluster' : cluster, 'iclust' : iclust, 'children' : children, 'root' : cluster[0]})
+        def get_inode(uid):  # index in <nodes> of the node that currently contains <uid>
+            if uid not in uf_parents:  # shouldn't happen, but if a uid wasn't in the previous partitions, it starts as a singleton
+                uf_parents[uid] = uid
+                add_node([uid], -1, [])
+            return root_inodes[find(uid)]
+        for iclust, cluster in enumerate(partitions[0]):
+            for uid in cluster:
+                uf_parents[uid] = cluster[0]
+            add_node(cluster, iclust, [])
+        for ipart in range(1, len(partitions)):
+            for iclust, cluster in enumerate(partitions[ipart]):
+                inode = get_inode(cluster[0])
+                if len(nodes[inode]['cluster']) == len(cluster):  # same cluster as in the previous partition (since it has to contain this node's uids)
+                    nodes[inode]['cluster'], nodes[inode]['iclust'] = cluster, iclust
+                    continue
+                children = sorted(set(get_inode(u) for u in cluster), key=lambda i: nodes[i]['iclust'])  # order them as they were in the previous partition
+                if sum(len(nodes[i]['cluster']) for i in children) != len(cluster):
+                    raise Exception('cluster of size %d in partition %d isn\'t the union of clusters from the previous partition (sizes %s)' % (len(cluster), ipart, ' '.join(str(len(nodes[i]['cluster'])) for i in children)))
+                for ichild in children:
+                    uf_parents[nodes[ichild]['root']] = cluster[0]
+                uf_parents[cluster[0]] = cluster[0]
+                add_node(cluster, iclust, children)
+        if len(partitions[-1]) == 1:  # make sure the root is at the end (it's already there unless the last partition is the same as the first one)
+            final_inode = get_inode(partitions[-1][0][0])
+            if final_inode != len(nodes) - 1:
+                nodes.append(nodes[final_inode])  # (the final node isn't anybody's child, so we don't need to fix indices)
+        return nodes
+
+    # ----------------------------------------------------------------------------------------
+    def get_sub_paths(self, partitions, i_clusters):  # for each cluster index in <i_clusters>, get list of partitions (from 0 to self.i_best+1) restricted to clusters that overlap with that cluster in the best partition
+        iclust_map = {}  # index in best partition for each uid
+        best_partition = partitions[self.i_best]
+        for iclust in i_clusters:
+            for uid in best_partition[iclust]:
+                iclust_map[uid] = iclust
+        sub_paths = {i : [[] for _ in range(self.i_best + 1)] for i in i_clusters}  # new lists of partitions, but only including clusters that overlap with each cluster
+        for ipart in range(self.i_best + 1):
+            for tmpclust in partitions[ipart]:
+                for iclust in set(iclust_map[u] for u in tmpclust if u in iclust_map):  # usually just one
+                    sub_paths[iclust][ipart].append(tmpclust)  # note that many of these adjacent sub-partitions can be identical, if the merges happened between clusters that correspond to a different final cluster
+        return sub_paths
+
+    # ----------------------------------------------------------------------------------------
+    def init_sub_paths(self, debug=False):  # get the sub paths for all the clusters at once (even if make_trees() is only doing one of them, since it's probably about to get called for the rest). If you're making trees in forked processes, call this in the parent first, so they inherit it rather than each redoing it
+        if self.i_best is None or self.sub_paths is not None:
+            return
+        partitions = self.partitions
+        if self.seed_unique_id is not None:
+            partitions = self.deduplicate_seed_uid(debug=debug)
+        self.sub_paths_best_partition = partitions[self.i_best] if self.seed_unique_id is not None else self.best(readonly=True)  # only get it once, since for self.partitions each access makes a copy
+        self.sub_paths = self.get_sub_paths(partitions, range(len(self.sub_paths_best_partition)))
+
     # ----------------------------------------------------------------------------------------
     def get_sub_path(self, uid_set, partitions=None, annotations=None):  # get list of partitions (from 0 to self.i_best+1) restricted to clusters that overlap with uid_set
         if partitions is None:
             partitions = self.partitions
         sub_partitions = [[] for _ in range(self.i_best + 1)]  # new list of partitions, but only including clusters that overlap with uid_set
-        sub_annotations = {}
         for ipart in range(self.i_best + 1):
             for tmpclust in partitions[ipart]:
-                if len(set(tmpclust) & uid_set) == 0:
-                    continue
-                sub_partitions[ipart].append(tmpclust)  # note that many of these adjacent sub-partitions can be identical, if the merges happened between clusters that correspond to a different final cluster
-                if annotations is not None and ':'.join(tmpclust) in annotations:
-                    sub_annotations[':'.join(tmpclust)] = annotations[':'.join(tmpclust)]
-        return sub_partitions, sub_annotations
+                if any(u in uid_set for u in tmpclust):
+                    sub_partitions[ipart].append(tmpclust)  # note that many of these adjacent sub-partitions can be identical, if the merges happened between clusters that correspond to a different final cluster
+        return sub_partitions, self.get_sub_annotations(sub_partitions, annotations)
+
+    # ----------------------------------------------------------------------------------------
+    def get_sub_annotations(self, sub_partitions, annotations):
+        if annotations is None:
+            return {}
+        return {':'.join(c) : annotations[':'.join(c)] for sptn in sub_partitions for c in sptn if ':'.join(c) in annotations}
 
     # ----------------------------------------------------------------------------------------
     def make_trees(self, annotations, i_only_cluster=None, get_fasttrees=False, naive_seq_name='XnaiveX', debug=False):  # makes a tree for each cluster in the most likely (not final) partition
@@ -596,20 +830,18 @@ class ClusterPath(object):
         if self.i_best is None:
             return
 
-        partitions = self.partitions
-        if self.seed_unique_id is not None:
-            partitions = self.deduplicate_seed_uid(debug=debug)
-
+        self.init_sub_paths(debug=debug)
+        best_partition = self.sub_paths_best_partition
         if debug:
-            print '  making %d tree%s over %d partitions' % (len(partitions[self.i_best]) if i_only_cluster is None else 1, 's' if i_only_cluster is None else '', self.i_best + 1)
+            print '  making %d tree%s over %d partitions' % (len(best_partition) if i_only_cluster is None else 1, 's' if i_only_cluster is None else '', self.i_best + 1)
         if self.trees is None:
-            self.trees = [None for _ in partitions[self.i_best]]
+            self.trees = [None for _ in best_partition]
         else:
-            assert len(self.trees) == len(partitions[self.i_best])  # presumably because we were already called with <i_only_cluster> set for a different cluster
-        for i_cluster in range(len(partitions[self.i_best])):
+            assert len(self.trees) == len(best_partition)  # presumably because we were already called with <i_only_cluster> set for a different cluster
+        for i_cluster in range(len(best_partition)):
             if i_only_cluster is not None and i_cluster != i_only_cluster:
                 continue
-            uid_set = set(partitions[self.i_best][i_cluster])  # usually the set() isn't doing anything, but sometimes I think we have uids duplicated between clusters, e.g. I think when seed partitioning (or even within a cluster, because order matters within a cluster because of bcrham caching)
-            sub_partitions, sub_annotations = self.get_sub_path(uid_set, partitions=partitions, annotations=annotations)
-            self.trees[i_cluster] = self.make_single_tree(sub_partitions, sub_annotations, uid_set, naive_seq_name, get_fasttrees=get_fasttrees, debug=debug)
+            uid_set = set(best_partition[i_cluster])  # usually the set() isn't doing anything, but sometimes I think we have uids duplicated between clusters, e.g. I think when seed partitioning (or even within a cluster, because order matters within a cluster because of bcrham caching)
+            sub_partitions = self.sub_paths[i_cluster]
+            self.trees[i_cluster] = self.make_single_tree(sub_partitions, self.get_sub_annotations(sub_partitions, annotations), uid_set, naive_seq_name, get_fasttrees=get_fasttrees, debug=debug)
 
@@ -0,0 +1,128 @@
+import os
+import json
+import struct
+import numpy
+
+suffix = '.pcol'
+format_version = 0.1
+footer_size_fmt = '<Q'
+
+# ----------------------------------------------------------------------------------------
+def write_columnar_file(fname, yamldata):
+    """
+    Write the same info as in a json/yaml output file (<yamldata> as constructed in utils.write_yaml_output()) in a columnar layout, so it can be read a column and/or an event at a time.
+    The file has one data block for each column (key) with the json-encoded value for each event on its own line (empty line if the event doesn't have that key), followed by a binary offset array for each column (n_events + 1 uint64 byte offsets into the data block).
+    At the end is a json footer with everything that isn't per-event (germline info, partitions, etc.) plus where to find each column, then eight bytes with the footer's offset.
+    """
+    events = yamldata['events']
+    columns = []
+    for event in events:  # keep the order in which we first see each key, so that e.g. 'unique_ids' is first
+        for key in event:
+            if key not in columns:
+                columns.append(key)
+    colfos = {}
+    with open(fname, 'wb') as colfile:
+        for key in columns:
+            offsets = numpy.zeros(len(events) + 1, dtype='<u8')
+            offsets[0] = colfile.tell()
+            for ievent, event in enumerate(events):
+                colfile.write(('' if key not in event else json.dumps(event[key])) + '\n')
+                offsets[ievent + 1] = colfile.tell()
+            colfos[key] = {'index-offset' : colfile.tell()}
+            offsets.tofile(colfile)
+        footer = {'partis-columnar' : format_version, 'n-events' : len(events), 'columns' : columns, 'column-info' : colfos}
+        footer.update({k : v for k, v in yamldata.items() if k != 'events'})
+        footer_offset = colfile.tell()
+        json.dump(footer, colfile)
+        colfile.write(struct.pack(footer_size_fmt, footer_offset))
+
+# ----------------------------------------------------------------------------------------
+class ColumnarFile(object):
+    """
+    Read-only, lazy access to a file written by write_columnar_file(): opening it only reads the footer (germline info, partitions, and column locations), then columns and events are read from disk only when asked for.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(self.fname, 'rb') as colfile:
+            colfile.seek(-struct.calcsize(footer_size_fmt), os.SEEK_END)
+            footer_end = colfile.tell()
+            footer_offset = struct.unpack(footer_size_fmt, colfile.read(struct.calcsize(footer_size_fmt)))[0]
+            colfile.seek(footer_offset)
+            footer = json.loads(colfile.read(footer_end - footer_offset))
+        if 'partis-columnar' not in footer:
+            raise Exception('%s doesn\'t look like a partis columnar file' % self.fname)
+        self.n_events = footer['n-events']
+        self.columns = footer['columns']
+        self.column_info = footer['column-info']
+        self.version_info = footer['version-info']
+        self.glfo = footer['germline-info']
+        self.partition_lines = footer['partitions']
+        self.offsets = {}  # offset arrays for the columns we've looked at
+        self.event_indices = None  # map from ':'.join(unique_ids) to event index (only filled if we need to look up clusters)
+
+    # ----------------------------------------------------------------------------------------
+    def get_offsets(self, key):
+        if key not in self.offsets:
+            if key not in self.column_info:
+                raise Exception('column \'%s\' not in %s (choices: %s)' % (key, self.fname, ' '.join(self.columns)))
+            with open(self.fname, 'rb') as colfile:
+                colfile.seek(self.column_info[key]['index-offset'])
+                self.offsets[key] = numpy.fromfile(colfile, dtype='<u8', count=self.n_events + 1)
+        return self.offsets[key]
+
+    # ----------------------------------------------------------------------------------------
+    def read_strs(self, key, ievents=None):  # return list of json strings for <key> for each event in <ievents> (all events if None), with '' for events that don't have <key>
+        offsets = self.get_offsets(key)
+        if ievents is None:
+            ievents = range(self.n_events)
+        with open(self.fname, 'rb') as colfile:
+            if len(ievents) > 0 and list(ievents) == range(ievents[0], ievents[0] + len(ievents)):  # contiguous, so read the whole block at once, then split it up
+                colfile.seek(int(offsets[ievents[0]]))
+                block = colfile.read(int(offsets[ievents[-1] + 1] - offsets[ievents[0]]))
+                rel_offsets = [int(o - offsets[ievents[0]]) for o in offsets[ievents[0] : ievents[-1] + 2]]
+                return [block[rel_offsets[i] : rel_offsets[i + 1] - 1] for i in range(len(ievents))]
+            strs = []
+            for ievent in ievents:
+                colfile.seek(int(offsets[ievent]))
+                strs.append(colfile.read(int(offsets[ievent + 1] - offsets[ievent]) - 1))
+            return strs
+
+    # ----------------------------------------------------------------------------------------
+    def decode(self, strs):  # decoding them all at once is much faster than one at a time
+        return json.loads('[%s]' % ','.join('null' if vstr == '' else vstr for vstr in strs))
+
+    # ----------------------------------------------------------------------------------------
+    def read_column(self, key, ievents=None):  # same as read_strs(), but decoded (with None for events that don't have <key>)
+        return self.decode(self.read_strs(key, ievents=ievents))
+
+    # ----------------------------------------------------------------------------------------
+    def iter_events(self, ievents=None, keys=None, n_per_read=1000):  # yield event dicts for <ievents> (default all), with only <keys> (default all columns), reading each column for <n_per_read> events at a time
+        if ievents is None:
+            ievents = range(self.n_events)
+        if keys is None:
+            keys = self.columns
+        for istart in range(0, len(ievents), n_per_read):
+            sub_ievents = ievents[istart : istart + n_per_read]
+            events = [{} for _ in sub_ievents]
+            for key in keys:
+                if key not in self.column_info:  # not all keys are in all files (e.g. if there's no failed queries)
+                    continue
+                strs = self.read_strs(key, ievents=sub_ievents)
+                for event, vstr, val in zip(events, strs, self.decode(strs)):
+                    if vstr != '':
+                        event[key] = val
+            for event in events:
+                yield event
+
+    # ----------------------------------------------------------------------------------------
+    def get_event_indices(self):
+        if self.event_indices is None:
+            self.event_indices = {':'.join(uids) : ievent for ievent, uids in enumerate(self.read_column('unique_ids'))}
+        return self.event_indices
+
+    # ----------------------------------------------------------------------------------------
+    def get_cluster_events(self, clusters, keys=None):  # return list of event dicts for each cluster in <clusters> (None for clusters without an annotation)
+        eindices = self.get_event_indices()
+        ievents = [eindices.get(':'.join(c)) for c in clusters]
+        events = dict(zip([i for i in ievents if i is not None], self.iter_events(ievents=[i for i in ievents if i is not None], keys=keys)))
+        return [events.get(i) for i in ievents]
@@ -4,6 +4,8 @@ import sys
 import math
 import csv
 import time
+import heapq
+import numpy
 
 import utils
 from clusterpath import ClusterPath
@@ -20,56 +22,61 @@ class Glomerator(object):
     def naive_seq_glomerate(self, naive_seqs, n_clusters, debug=False):
         """ Perform hierarchical agglomeration (with naive hamming distance as the distance), stopping at <n_clusters> """
         start = time.time()
-        clusters = [[names,] for names in naive_seqs.keys()]
+        names = naive_seqs.keys()
 
-        seqs_per_cluster = float(len(clusters)) / n_clusters
+        seqs_per_cluster = float(len(names)) / n_clusters
         max_per_cluster = int(math.ceil(seqs_per_cluster))
         if debug:
             print '  max %d per cluster' % max_per_cluster
 
-        distances = {}  # cache the calculated fractional hamming distances
+        # single linkage, with a heap of (distance, id, id) for pairs of clusters. Each cluster's id is the order in which it was created, which is also its position in the list of clusters
+        # that we used to loop over with itertools.combinations() (merged clusters went at the end), so breaking ties on the pair of ids gives the same merges as we used to get
+        members = {i : [n] for i, n in enumerate(names)}  # current clusters, by id
+        distances = {i : {} for i in members}  # min distance between each pair of current clusters
+        if len(names) > 1:
+            hdists, hlens = utils.hamming_all_pairs([naive_seqs[n] for n in names])
+            hfracs = numpy.where(hlens > 0, hdists / numpy.maximum(hlens, 1).astype(float), 0.).tolist()  # i.e. utils.hamming_fraction() for each pair
+            for (i, j), hfrac in itertools.izip(itertools.combinations(range(len(names)), 2), hfracs):
+                distances[i][j] = distances[j][i] = hfrac
+        heaps = {'ok' : [], 'too-big' : []}  # split by whether merging the pair would make a cluster bigger than <max_per_cluster> (cluster sizes only grow, so once a pair is too big it stays too big)
+        for i, j in itertools.combinations(range(len(names)), 2):
+            heaps['ok' if max_per_cluster >= 2 else 'too-big'].append((distances[i][j], i, j))
+        for hlist in heaps.values():
+            heapq.heapify(hlist)
 
         # ----------------------------------------------------------------------------------------
-        def get_clusters_to_merge():
-            smallest_min_distance, clusters_to_merge = None, None
-            n_skipped = 0
-            for clust_a, clust_b in itertools.combinations(clusters, 2):  # find the two clusters which contain the pair of sequences which are closest in hamming fraction (skipping cluster pairs that would make a cluster that's too big)
-                if len(clust_a) + len(clust_b) > max_per_cluster and not glomerate.merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
-                    n_skipped += 1
-                    continue
-                min_distance = None  # find the smallest hamming distance between any two sequences in the two clusters
-                for query_a in clust_a:
-                    for query_b in clust_b:
-                        joint_key = query_a + ';' + query_b  #';'.join([query_a, query_b])
-                        if joint_key not in distances:
-                            distances[joint_key] = utils.hamming_fraction(naive_seqs[query_a], naive_seqs[query_b])
-                            distances[query_b + ';' + query_a] = distances[joint_key]  # also add with key in reverse order, in case we run into the pair that way later on
-                        if min_distance is None or distances[joint_key] < min_distance:
-                            min_distance = distances[joint_key]
-                if smallest_min_distance is None or min_distance < smallest_min_distance:
-                    smallest_min_distance = min_distance
-                    clusters_to_merge = (clust_a, clust_b)
-
-            if debug and n_skipped > 0:
-                print '      skipped: %d ' % n_skipped
-
-            return clusters_to_merge
+        def get_clusters_to_merge():  # pop pairs off the heap until we find one whose clusters both still exist
+            while len(heaps['ok']) > 0:
+                _, i, j = heapq.heappop(heaps['ok'])
+                if i in members and j in members:
+                    return i, j
+            return None
 
         # ----------------------------------------------------------------------------------------
         def glomerate():
             if debug:
-                print '    current ', ' '.join([str(len(cl)) for cl in clusters])
+                print '    current ', ' '.join([str(len(members[i])) for i in sorted(members)])
             clusters_to_merge = get_clusters_to_merge()
             if clusters_to_merge is None:  # if we didn't find a suitable pair
                 if debug:
                     print '    didn\'t find shiznitz'
                 glomerate.merge_whatever_you_got = True  # next time through, merge whatever's best regardless of size
-            else:
-                if debug:
-                    print '    merging', len(clusters_to_merge[0]), len(clusters_to_merge[1])
-                clusters.append(clusters_to_merge[0] + clusters_to_merge[1])
-                clusters.remove(clusters_to_merge[0])
-                clusters.remove(clusters_to_merge[1])
+                heaps['ok'] = heaps['too-big']
+                heaps['too-big'] = None
+                return
+            i, j = clusters_to_merge
+            if debug:
+                print '    merging', len(members[i]), len(members[j])
+            inew = glomerate.next_id
+            glomerate.next_id += 1
+            members[inew] = members.pop(i) + members.pop(j)
+            idists, jdists = distances.pop(i), distances.pop(j)
+            distances[inew] = {}
+            for k in [k for k in members if k != inew]:
+                del distances[k][i], distances[k][j]
+                distances[k][inew] = distances[inew][k] = min(idists[k], jdists[k])
+                too_big = len(members[k]) + len(members[inew]) > max_per_cluster and not glomerate.merge_whatever_you_got
+                heapq.heappush(heaps['too-big' if too_big else 'ok'], (distances[k][inew], k, inew))  # <k> is always older than <inew>
 
         # ----------------------------------------------------------------------------------------
         def homogenize():
@@ -91,10 +98,12 @@ class Glomerator(object):
         # ----------------------------------------------------------------------------------------
         # da bizniz
         glomerate.merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
+        glomerate.next_id = len(names)
 
-        while len(clusters) > n_clusters:
+        while len(members) > n_clusters:
             glomerate()
-        
+
+        clusters = [members[i] for i in sorted(members)]
         if len(clusters) > 1:  # homogenize if partition is non-trivial
             clusters.sort(key=len)
 
@@ -123,27 +132,23 @@ class Glomerator(object):
     # ----------------------------------------------------------------------------------------
     def read_file_info(self, infname, n_paths):
         paths = [None for _ in range(n_paths)]
-        lines_list = [[] for _ in range(n_paths)]
         with open(infname, 'r') as csvfile:
             reader = csv.DictReader(csvfile)
-            for line in reader:
+            for line in reader:  # add each line to its path as we read it (rather than reading them all first)
                 if line['partition'] == '':
                     print '    %s null partition (one of the processes probably got passed zero sequences)' % utils.color('red', 'warning')
-                    return paths
+                    return [None for _ in range(n_paths)]
                 path_index = int(line['path_index']) if 'path_index' in line else 0
                 initial_path_index = int(line['initial_path_index']) if 'initial_path_index' in line else 0
                 if paths[path_index] is None:  # is this the first line for this path?
                     paths[path_index] = ClusterPath(initial_path_index, seed_unique_id=self.seed_unique_id)  # NOTE I may have screwed up the initial_path_index/path_index distinction here... it's been too long since I wrote the smc stuff and I'm not sure
                 else:
                     assert paths[path_index].initial_path_index == initial_path_index
-                lines_list[path_index].append(line)
+                paths[path_index].readlines([line], process_csv=True)
 
         if paths.count(None) > 0:
             raise Exception('couldn\'t find the required number of paths in file %s' % infname)
 
-        for path_index in range(n_paths):
-            paths[path_index].readlines(lines_list[path_index], process_csv=True)
-
         for cp in paths:
             if cp is None:
                 raise Exception('None type path read from %s' % infname)
@@ -197,40 +202,38 @@ class Glomerator(object):
                     fileinfos[ifile][ipath].print_partitions(self.reco_info, extrastr=('%d ' % (ifile)), print_header=ifile==0)
                     print ''
 
-            # merge all the steps in each path
+            # merge all the steps in each path (we keep track of where we are in each file's path with an index, rather than removing partitions from the front of them, since ClusterPath.remove_partition() has to recalculate i_best each time)
+            iparts = [0 for _ in fileinfos]  # index of the current partition in each file's path
             def last_one():
-                last = True
-                for ifile in range(len(fileinfos)):  # we're finished when all the files are out of glomeration steps (i.e. they all only have one [the last] line left)
-                    last &= len(fileinfos[ifile][ipath].partitions) == 1
-                return last
+                return all(iparts[ifile] == len(fileinfos[ifile][ipath].partitions) - 1 for ifile in range(len(fileinfos)))  # we're finished when all the files are out of glomeration steps (i.e. they're all on their last line)
 
-            def remove_one_of_the_first_partitions():
+            def advance_one_of_the_files():
                 maxdelta, ibestfile = None, None
                 for ifile in range(len(fileinfos)):
-                    if len(fileinfos[ifile][ipath].partitions) == 1:  # if this is the last line (i.e. there aren't any more glomeration steps in this file), leave it alone
+                    fpath, ip = fileinfos[ifile][ipath], iparts[ifile]
+                    if ip == len(fpath.partitions) - 1:  # if this is the last line (i.e. there aren't any more glomeration steps in this file), leave it alone
                         continue
-                    thisdelta = fileinfos[ifile][ipath].logprobs[1] - fileinfos[ifile][ipath].logprobs[0]  # logprob difference between the next partition and this one
+                    thisdelta = fpath.logprobs[ip + 1] - fpath.logprobs[ip]  # logprob difference between the next partition and this one
                     if maxdelta is None or thisdelta > maxdelta:
                         maxdelta = thisdelta
                         ibestfile = ifile
-                # print '    ibest %d with %f - %f = %f' % (ibestfile, fileinfos[ibestfile][ipath].logprobs[1], fileinfos[ibestfile][ipath].logprobs[0], fileinfos[ibestfile][ipath].logprobs[1] - fileinfos[ibestfile][ipath].logprobs[0])
-                fileinfos[ibestfile][ipath].remove_partition(0)
+                iparts[ibestfile] += 1
 
             def add_next_global_partition():
                 global_partition = []
                 global_logprob = 0.
-                for ifile in range(len(fileinfos)):  # combine the first line in each file to make a global partition
-                    for cluster in fileinfos[ifile][ipath].partitions[0]:
+                for ifile in range(len(fileinfos)):  # combine the current line in each file to make a global partition
+                    fpath, ip = fileinfos[ifile][ipath], iparts[ifile]
+                    for cluster in fpath.partitions[ip]:
                         global_partition.append(list(cluster))
-                    global_logprob += fileinfos[ifile][ipath].logprobs[0]
+                    global_logprob += fpath.logprobs[ip]
                 self.paths[ipath].add_partition(global_partition, global_logprob, n_procs=len(fileinfos), logweight=0.)  # don't know the logweight yet (or maybe at all!)
 
             while not last_one():
                 add_next_global_partition()
-                remove_one_of_the_first_partitions()
+                advance_one_of_the_files()
             add_next_global_partition()
 
-
             if smc_particles > 1:
                 self.paths[ipath].set_synthetic_logweight_history(self.reco_info)
             if debug:
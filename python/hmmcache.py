@@ -0,0 +1,142 @@
+import os
+import struct
+import hashlib
+import shutil
+import numpy
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class HmmCacheStore(object):
+    """
+    Indexed, append-only store for the bcrham cache file (naive seqs, log probs, etc. for each uid string).
+    The log itself is still the usual csv cache file (so bcrham procs can all read it directly, rather than each getting a copy), while the index is a binary sidecar file <fname>.idx with one fixed-width (key hash, byte offset) record for each line in the log.
+    After each step, new info from the bcrham procs is appended to the log, and the index is extended to cover only the new lines (rather than re-merging and re-reading the whole file).
+    If something else (e.g. a single bcrham proc) rewrites the log, we notice and rebuild the index.
+    """
+    idx_dtype = numpy.dtype([('hash', '<u8'), ('offset', '<u8')])
+    def __init__(self, fname):
+        self.fname = fname
+        self.idxfname = fname + '.idx'
+        self.reset()
+        self.sync()
+
+    # ----------------------------------------------------------------------------------------
+    def reset(self):
+        self.hashes = numpy.array([], dtype=self.idx_dtype['hash'])
+        self.offsets = numpy.array([], dtype=self.idx_dtype['offset'])
+        self.indexed_size = 0  # number of bytes of the log covered by the index
+        self.last_stat = None  # (size, mtime) of log the last time we were sure the index was up to date
+
+    # ----------------------------------------------------------------------------------------
+    @staticmethod
+    def keyhash(key):
+        return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+    # ----------------------------------------------------------------------------------------
+    def stat(self):
+        fst = os.stat(self.fname)
+        return fst.st_size, fst.st_mtime
+
+    # ----------------------------------------------------------------------------------------
+    def load_idx_file(self):  # only called on a fresh store, i.e. if we're reopening an existing log + index
+        idx = numpy.fromfile(self.idxfname, dtype=self.idx_dtype)
+        self.hashes, self.offsets = idx['hash'], idx['offset']
+        if len(self.offsets) > 0:
+            with open(self.fname) as logfile:
+                logfile.seek(self.offsets[-1])
+                self.indexed_size = int(self.offsets[-1]) + len(logfile.readline())
+
+    # ----------------------------------------------------------------------------------------
+    def sync(self):  # make sure the index covers the whole log
+        if not os.path.exists(self.fname):
+            self.reset()
+            return
+        if self.stat() == self.last_stat:
+            return
+        if self.last_stat is None and len(self.offsets) == 0 and os.path.exists(self.idxfname) and os.path.getmtime(self.idxfname) >= os.path.getmtime(self.fname):
+            self.load_idx_file()
+        elif self.last_stat is not None or self.indexed_size > 0:  # someone else rewrote the log (bcrham never appends), so start over
+            self.reset()
+            if os.path.exists(self.idxfname):
+                os.remove(self.idxfname)
+        self.index_tail()
+
+    # ----------------------------------------------------------------------------------------
+    def index_tail(self):  # add index records for any lines after <self.indexed_size>
+        new_hashes, new_offsets = [], []
+        with open(self.fname) as logfile:
+            logfile.seek(self.indexed_size)
+            offset = self.indexed_size
+            if offset == 0:  # skip header
+                offset += len(logfile.readline())
+            for line in iter(logfile.readline, ''):
+                if not line.endswith('\n'):  # partially-written line (shouldn't happen, but if it does we'll get it next time)
+                    break
+                key = line[:line.find(',')]
+                if key != '':
+                    new_hashes.append(self.keyhash(key))
+                    new_offsets.append(offset)
+                offset += len(line)
+        self.indexed_size = offset
+        if len(new_offsets) > 0:
+            self.hashes = numpy.concatenate([self.hashes, numpy.array(new_hashes, dtype=self.idx_dtype['hash'])])
+            self.offsets = numpy.concatenate([self.offsets, numpy.array(new_offsets, dtype=self.idx_dtype['offset'])])
+            new_idx = numpy.zeros(len(new_offsets), dtype=self.idx_dtype)
+            new_idx['hash'], new_idx['offset'] = new_hashes, new_offsets
+            with open(self.idxfname, 'ab') as idxfile:
+                new_idx.tofile(idxfile)
+        self.last_stat = self.stat()
+
+    # ----------------------------------------------------------------------------------------
+    def append_files(self, fnames):  # append lines (except the header) from each of <fnames> to the log, index them, and then delete <fnames> (some of which may not exist)
+        self.sync()
+        header = None
+        if os.path.exists(self.fname) and os.stat(self.fname).st_size > 0:
+            with open(self.fname) as logfile:
+                header = logfile.readline()
+        with open(self.fname, 'a') as logfile:
+            for fname in fnames:
+                if not os.path.exists(fname):
+                    continue
+                with open(fname) as infile:
+                    inheader = infile.readline()
+                    if header is None:
+                        header = inheader
+                        logfile.write(header)
+                    elif inheader != header:
+                        raise Exception('header in %s doesn\'t match cache file %s:\n    %s    %s' % (fname, self.fname, inheader, header))
+                    shutil.copyfileobj(infile, logfile)
+                os.remove(fname)
+        self.index_tail()
+
+    # ----------------------------------------------------------------------------------------
+    def read_lines(self, keys):  # return list of (column list) lines for each of <keys>, in the order they appear in the log
+        self.sync()
+        if len(self.offsets) == 0 or len(keys) == 0:
+            return []
+        keys = set(keys)
+        matched_offsets = numpy.sort(self.offsets[numpy.in1d(self.hashes, [self.keyhash(k) for k in keys])])
+        lines = []
+        with open(self.fname) as logfile:
+            for offset in matched_offsets:
+                logfile.seek(offset)
+                columns = logfile.readline().rstrip('\r\n').split(',')
+                if columns[0] in keys:  # i.e. not a hash collision
+                    lines.append(columns)
+        return lines
+
+    # ----------------------------------------------------------------------------------------
+    def get_naive_seqs(self, queries):  # return dict with the (first non-empty) cached naive seq for each of <queries> that's in the cache
+        inaive = utils.partition_cachefile_headers.index('naive_seq')
+        naive_seqs = {}
+        for columns in self.read_lines(queries):
+            if columns[0] not in naive_seqs and columns[inaive] != '':
+                naive_seqs[columns[0]] = columns[inaive]
+        return naive_seqs
+
+    # ----------------------------------------------------------------------------------------
+    def clean(self):
+        if os.path.exists(self.idxfname):
+            os.remove(self.idxfname)
+        self.reset()
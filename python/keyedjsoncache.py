@@ -0,0 +1,67 @@
+import os
+import json
+import glob
+import hashlib
+
+# ----------------------------------------------------------------------------------------
+class KeyedJsonCache(object):
+    """
+    Append-only store of json-encoded values keyed by string, with an in-memory index of key : byte offset, so we only read the values we ask for.
+    The file has one line per key: the key, then a tab, then the json-encoded value.
+    We use it for raw bcrham viterbi output lines, so we don't rerun bcrham for clusters that we've already annotated (either earlier in this run, or in a previous run with the same cache file). These are keyed by a hash of the bcrham input line for the cluster (i.e. uids, seqs, k bounds, only_genes, etc.) plus a context hash (of the hmm files, germline seqs, and anything else that affects the result), so if a cluster's membership or any of its inputs change, we'll rerun it (see context_hash() and line_key()).
+    It's also used for FastTree newick strings (see treeutils.get_fasttree_newicks()).
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.offsets = {}
+        if os.path.exists(self.fname):
+            with open(self.fname) as cachefile:
+                offset = cachefile.tell()
+                for line in iter(cachefile.readline, ''):
+                    if not line.endswith('\n'):  # partial last line from a run that died while writing (we truncate it in add_lines())
+                        break
+                    self.offsets[line[:line.find('\t')]] = offset
+                    offset = cachefile.tell()
+            self.valid_size = offset
+        else:
+            self.valid_size = 0
+
+    # ----------------------------------------------------------------------------------------
+    @staticmethod
+    def context_hash(parameter_dir, glfo, extra_strs):  # hash of everything besides the input line that affects bcrham's annotation
+        md5 = hashlib.md5()
+        for fname in sorted(glob.glob(parameter_dir + '/hmms/*.yaml')):
+            fst = os.stat(fname)
+            md5.update('%s %d %f\n' % (os.path.basename(fname), fst.st_size, fst.st_mtime))
+        for region in sorted(glfo['seqs']):
+            for gene, seq in sorted(glfo['seqs'][region].items()):
+                md5.update('%s %s\n' % (gene, seq))
+        for estr in extra_strs:
+            md5.update(estr + '\n')
+        return md5.hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    @staticmethod
+    def line_key(context, input_line, header):  # <input_line> is the dict that we write to bcrham's input file for this cluster
+        return hashlib.md5(context + ' ' + ' '.join(str(input_line[h]) for h in header)).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def get_line(self, key):  # returns None if we don't have it
+        if key not in self.offsets:
+            return None
+        with open(self.fname) as cachefile:
+            cachefile.seek(self.offsets[key])
+            line = cachefile.readline()
+        return json.loads(line[line.find('\t') + 1:])
+
+    # ----------------------------------------------------------------------------------------
+    def add_lines(self, keyed_lines):  # <keyed_lines> is a list of (key, value) pairs
+        with open(self.fname, 'r+' if os.path.exists(self.fname) else 'w') as cachefile:
+            cachefile.seek(self.valid_size)
+            cachefile.truncate()
+            for key, line in keyed_lines:
+                if key in self.offsets:
+                    continue
+                self.offsets[key] = cachefile.tell()
+                cachefile.write('%s\t%s\n' % (key, json.dumps(line)))
+            self.valid_size = cachefile.tell()
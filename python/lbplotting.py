@@ -1005,7 +1005,7 @@ def get_lb_tree_cmd(treestr, outfname, lb_metric, affy_key, ete_path, subworkdir
     cmdstr = '%s/bin/plot-lb-tree.py --treefname %s' % (utils.get_partis_dir(), treefname)
     if metafo is not None:
         with open(metafname, 'w') as metafile:
-            yaml.dump(metafo, metafile, Dumper=Dumper)
+            json.dump(metafo, metafile)  # json is much faster to read than full yaml (and is still yaml)
         cmdstr += ' --metafname %s' % metafname
     if queries_to_include is not None:
         cmdstr += ' --queries-to-include %s' % ':'.join(queries_to_include)
@@ -1034,7 +1034,7 @@ def plot_lb_trees(metric_methods, baseplotdir, lines, ete_path, base_workdir, is
         for iclust, line in enumerate(lines):  # note that <min_selection_metric_cluster_size> was already applied in treeutils
             treestr = get_tree_from_line(line, is_true_line)
             affy_key = 'affinities'  # turning off possibility of using relative affinity for now
-            metafo = copy.deepcopy(line['tree-info']['lb'])  # NOTE there's lots of entries in the lb info that aren't observed (i.e. aren't in line['unique_ids'])
+            metafo = {lb_metric : line['tree-info']['lb'][lb_metric]}  # only write the column that we're plotting (plus affinity below), since plot-lb-tree.py doesn't need the rest NOTE there's lots of entries in the lb info that aren't observed (i.e. aren't in line['unique_ids'])
             if affy_key in line:  # either 'affinities' or 'relative_affinities'
                 metafo[utils.reversed_input_metafile_keys[affy_key]] = {uid : affy for uid, affy in zip(line['unique_ids'], line[affy_key])}
             outfname = '%s/%s-tree-iclust-%d%s.svg' % (plotdir, lb_metric, iclust, '-relative' if 'relative' in affy_key else '')
@@ -0,0 +1,91 @@
+import math
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class NProcScheduler(object):
+    """
+    Choose n_procs for each clustering step using a cost model fit to the previous steps (rather than reducing by a fixed factor based on heuristics).
+    Each step's exec time is modeled as <overhead> + <per-calc cost> * <mean cluster size> * <calcs per proc>, where the number of fwd + vtb calcs per proc goes as the square of the number of clusters per proc (every pair within a proc is a potential merge).
+    The merge fraction in the next step is extrapolated from the last step in the same way (more clusters per proc --> more merges), and we choose the n_procs that minimizes the predicted time of the next step plus the predicted time of the final, single-proc step.
+    The merge-accuracy budget is the largest factor by which we'll decrease n_procs in one step, since going straight to very few procs hands each proc many more (mostly unrelated) clusters at once than the earlier steps have had a chance to collapse.
+    """
+    def __init__(self, max_n_procs, max_reduction_factor=3., min_step_time=2., debug=False):
+        self.max_n_procs = max_n_procs
+        self.max_reduction_factor = max_reduction_factor
+        self.min_step_time = min_step_time  # don't bother running steps that are predicted to be faster than this (it's all overhead)
+        self.debug = debug
+        self.steps = []  # one dict for each clustering step that we've been told about with add_step()
+        self.predictions = []  # predicted step time for each step (None if we didn't make the prediction)
+
+    # ----------------------------------------------------------------------------------------
+    def add_step(self, n_procs, n_clusters_in, n_clusters_out, mean_cluster_size, proc_info, timing):  # <proc_info> is bcrham_proc_info from the step, <timing> is the step's entry in timing_info
+        calcd = [pfo['calcd']['vtb'] + pfo['calcd']['fwd'] for pfo in proc_info if 'calcd' in pfo and None not in [pfo['calcd'].get(k) for k in ['vtb', 'fwd']]]
+        bcrham_times = [pfo['time']['bcrham'] for pfo in proc_info if 'time' in pfo and pfo['time'].get('bcrham') is not None]
+        step = {'n_procs' : n_procs, 'n_clusters_in' : n_clusters_in, 'n_clusters_out' : n_clusters_out, 'mean_size' : mean_cluster_size,
+                'calcd' : calcd, 'bcrham_times' : bcrham_times, 'exec' : timing['exec'], 'total' : timing['total']}
+        self.steps.append(step)
+        if len(self.predictions) < len(self.steps):
+            self.predictions.append(None)
+        if self.predictions[-1] is not None:
+            print '        n_procs scheduler: predicted step time %.1f, actual %.1f (with %d procs)' % (self.predictions[-1], step['total'], n_procs)
+
+    # ----------------------------------------------------------------------------------------
+    def fit(self, n_recent=3):  # return (overhead, per-calc cost, calcs per proc pair-coefficient), using the last few steps
+        recent = [s for s in self.steps[-n_recent:] if len(s['calcd']) > 0 and sum(s['calcd']) > 0]
+        if len(recent) == 0:
+            return None
+        per_calc_cost = sum(sum(s['bcrham_times']) for s in recent) / sum(s['mean_size'] * sum(s['calcd']) for s in recent)  # ratio estimator, i.e. time per (calc * cluster size)
+        overhead = sum(max(0., s['total'] - (max(s['bcrham_times']) if len(s['bcrham_times']) > 0 else 0.)) for s in recent) / len(recent)  # everything that isn't the slowest proc's bcrham time (process startup, splitting/merging files...)
+        last = recent[-1]
+        clusters_per_proc = float(last['n_clusters_in']) / last['n_procs']
+        pair_coeff = (float(sum(last['calcd'])) / last['n_procs']) / max(1., clusters_per_proc**2)  # calcs per proc per (clusters per proc)^2
+        return overhead, per_calc_cost, pair_coeff
+
+    # ----------------------------------------------------------------------------------------
+    def predict_step_time(self, fitpars, n_clusters, mean_size, n_procs):
+        overhead, per_calc_cost, pair_coeff = fitpars
+        clusters_per_proc = float(n_clusters) / n_procs
+        return overhead + per_calc_cost * mean_size * pair_coeff * clusters_per_proc**2
+
+    # ----------------------------------------------------------------------------------------
+    def predict_n_clusters_out(self, n_clusters, n_procs):  # extrapolate the fraction of clusters that survive a step from the last step, assuming log(surviving fraction) is proportional to the number of clusters per proc
+        last = self.steps[-1]
+        last_frac = float(max(1, last['n_clusters_out'])) / max(1, last['n_clusters_in'])
+        last_cpp, new_cpp = float(last['n_clusters_in']) / last['n_procs'], float(n_clusters) / n_procs
+        return max(1., n_clusters * last_frac**(new_cpp / last_cpp))
+
+    # ----------------------------------------------------------------------------------------
+    def choose_n_procs(self, n_clusters, mean_size, n_proc_list):
+        last_n_procs = n_proc_list[-1]
+        fitpars = self.fit()
+        if fitpars is None:  # nothing to go on (e.g. bcrham didn't calculate anything), so just reduce by the max allowed factor
+            self.predictions.append(None)
+            return max(1, int(last_n_procs / self.max_reduction_factor))
+        min_n_procs = max(1, int(math.ceil(last_n_procs / self.max_reduction_factor)))
+        candidates = range(min_n_procs, min(self.max_n_procs, last_n_procs) + 1)
+
+        if self.debug:
+            print '        n_procs scheduler: overhead %.1f  per-calc %.2e  pair coeff %.3f  (%d clusters, mean size %.1f)' % (fitpars[0], fitpars[1], fitpars[2], n_clusters, mean_size)
+            print '             n_procs   step   final   total'
+        best_n_procs, best_time, best_step_time = None, None, None
+        for n_procs in candidates:
+            step_time = self.predict_step_time(fitpars, n_clusters, mean_size, n_procs)
+            n_out = self.predict_n_clusters_out(n_clusters, n_procs)
+            final_time = 0. if n_procs == 1 else self.predict_step_time(fitpars, n_out, mean_size * float(n_clusters) / n_out, 1)  # time for the final single-proc step, starting from where this step leaves us (merged clusters are bigger, so they're slower)
+            total_time = step_time + final_time
+            if self.debug:
+                print '             %5d   %6.1f  %6.1f  %6.1f' % (n_procs, step_time, final_time, total_time)
+            if best_time is None or total_time < best_time:
+                best_n_procs, best_time, best_step_time = n_procs, total_time, step_time
+
+        if best_n_procs == last_n_procs and n_proc_list.count(last_n_procs) >= max(4, last_n_procs):  # make sure we eventually get to one proc (same criterion as the non-adaptive version)
+            best_n_procs = max(min_n_procs, last_n_procs - 1)
+            best_step_time = self.predict_step_time(fitpars, n_clusters, mean_size, best_n_procs)
+        while best_n_procs > min_n_procs and self.predict_step_time(fitpars, n_clusters, mean_size, best_n_procs - 1) < self.min_step_time:  # if the step's going to be really quick, there's no point in spreading it out
+            best_n_procs -= 1
+            best_step_time = self.predict_step_time(fitpars, n_clusters, mean_size, best_n_procs)
+
+        self.predictions.append(best_step_time)
+        print '        n_procs scheduler: chose %d proc%s (predicted step time %.1f)' % (best_n_procs, utils.plural(best_n_procs), best_step_time)
+        return best_n_procs
@@ -9,7 +9,8 @@ import glob
 import csv
 csv.field_size_limit(sys.maxsize)  # make sure we can write very large csv fields
 import random
-from collections import OrderedDict
+import hashlib
+from collections import OrderedDict, deque
 from subprocess import Popen, check_call, PIPE, CalledProcessError, check_output
 import copy
 import multiprocessing
@@ -20,6 +21,8 @@ import utils
 import glutils
 import indelutils
 import treeutils
+import columnarfile
+import sharedinfo
 from glomerator import Glomerator
 from clusterpath import ClusterPath, ptnprint
 from waterer import Waterer
@@ -31,6 +34,11 @@ from performanceplotter import PerformancePlotter
 from partitionplotter import PartitionPlotter
 from hist import Hist
 import seqfileopener
+from bcrhamworkers import BcrhamWorkerPool
+from hmmcache import HmmCacheStore
+from nprocscheduler import NProcScheduler
+from checkpoint import PartitionCheckpoint
+from keyedjsoncache import KeyedJsonCache
 
 # ----------------------------------------------------------------------------------------
 class PartitionDriver(object):
@@ -48,7 +56,9 @@ class PartitionDriver(object):
         self.vs_info, self.sw_info = None, None
         self.duplicates = {}
         self.bcrham_proc_info = None
+        self.bcrham_workers = None  # pool of persistent bcrham processes (only used for clustering steps, and only if --persistent-bcrham-workers is set)
         self.timing_info = []  # it would be really nice to clean up both this and bcrham_proc_info
+        self.nproc_scheduler = None  # chooses n_procs for each clustering step from measured step costs (only if --adaptive-n-procs is set)
         self.istep = None  # stupid hack to get around network file system issues (see self.subworkidr()
         self.subworkdirs = []  # arg. same stupid hack
 
@@ -61,7 +71,10 @@ class PartitionDriver(object):
         self.hmm_infname = self.args.workdir + '/hmm_input.csv'
         self.hmm_cachefname = self.args.workdir + '/hmm_cached_info.csv'
         self.hmm_outfname = self.args.workdir + '/hmm_output.csv'
+        self.hmm_cache = None  # indexed view of <self.hmm_cachefname> (initialized after we've dealt with any persistent cache file)
         self.cpath_progress_dir = '%s/cluster-path-progress' % self.args.workdir  # write the cluster paths for each clustering step to separate files in this dir
+        self.annotation_cache = None  # raw bcrham annotation output for each cluster we've already annotated (only if --annotation-cachefname or --checkpoint-dir is set)
+        self.checkpoint = None  # if --checkpoint-dir is set, we save the partition loop state after each clustering step (see get_checkpoint())
 
         if self.args.outfname is not None:
             utils.prep_dir(dirname=None, fname=self.args.outfname, allow_other_files=True)
@@ -149,6 +162,8 @@ class PartitionDriver(object):
             os.remove(lockfname)
         if os.path.exists(self.hmm_cachefname):
             os.remove(self.hmm_cachefname)
+        if self.hmm_cache is not None:
+            self.hmm_cache.clean()
 
         for subd in self.subworkdirs:
             if os.path.exists(subd):  # if there was only one proc for this step, it'll have already been removed
@@ -325,13 +340,14 @@ class PartitionDriver(object):
         if self.current_action == 'get-selection-metrics' and self.args.input_metafname is not None:  # presumably if you're running 'get-selection-metrics' with --input-metafname set, that means you didn't add the affinities (+ other metafo) when you partitioned, so we need to add it now
             seqfileopener.read_input_metafo(self.args.input_metafname, annotation_list, debug=True)
         if self.args.seed_unique_id is not None:  # restrict to seed cluster in the best partition (clusters from non-best partition have duplicate uids, which then make fasttree barf, and it doesn't seem worth the trouble to fix it now)
-            annotation_dict = OrderedDict([(uidstr, line) for uidstr, line in annotation_dict.items() if self.args.seed_unique_id in line['unique_ids'] and line['unique_ids'] in cpath.partitions[cpath.i_best]])
-            cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id, partition=cpath.partitions[cpath.i_best])  # replace <cpath> with a new <cpath> that only has the best partition. The cpath will in general have duplicate uids in different clusters when seed partitioning, so it's better to just use the best partition and use fasttree for everything
+            annotation_dict = OrderedDict([(uidstr, line) for uidstr, line in annotation_dict.items() if self.args.seed_unique_id in line['unique_ids'] and line['unique_ids'] in cpath.best(readonly=True)])
+            cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id, partition=cpath.best())  # replace <cpath> with a new <cpath> that only has the best partition. The cpath will in general have duplicate uids in different clusters when seed partitioning, so it's better to just use the best partition and use fasttree for everything
         # treeutils.get_trees_for_annotations(annotation_dict, cpath=cpath, workdir=self.args.workdir, min_cluster_size=self.args.min_selection_metric_cluster_size, cluster_indices=self.args.cluster_indices, debug=self.args.debug)  # NOTE this is not tested, but might be worth using in the future
         treeutils.calculate_tree_metrics(annotation_dict, self.args.lb_tau, lbr_tau_factor=self.args.lbr_tau_factor, cpath=cpath, reco_info=self.reco_info, treefname=self.args.treefname,
                                          use_true_clusters=self.reco_info is not None, base_plotdir=self.args.plotdir, ete_path=self.args.ete_path, workdir=self.args.workdir, dont_normalize_lbi=self.args.dont_normalize_lbi,
                                          only_csv=self.args.only_csv_plots, min_cluster_size=self.args.min_selection_metric_cluster_size, dtr_path=self.args.dtr_path, add_aa_consensus_distance=True, add_aa_lb_metrics=True, include_relative_affy_plots=self.args.include_relative_affy_plots,
-                                         cluster_indices=self.args.cluster_indices, outfname=self.args.selection_metric_fname, only_use_best_partition=self.args.only_print_best_partition, glfo=self.glfo, queries_to_include=self.args.queries_to_include, debug=self.args.debug)
+                                         cluster_indices=self.args.cluster_indices, outfname=self.args.selection_metric_fname, only_use_best_partition=self.args.only_print_best_partition, glfo=self.glfo, queries_to_include=self.args.queries_to_include,
+                                         n_procs=self.args.n_procs, max_tasks_per_proc=self.args.selection_metric_max_tasks_per_proc, tree_cachefname=self.args.tree_cachefname, debug=self.args.debug)
 
     # ----------------------------------------------------------------------------------------
     def parse_existing_annotations(self, annotation_list, ignore_args_dot_queries=False, process_csv=False):
@@ -431,7 +447,7 @@ class PartitionDriver(object):
             if self.args.cluster_indices is not None:
                 sorted_annotations = [sorted_annotations[iclust] for iclust in self.args.cluster_indices]
             for iline, line in enumerate(sorted_annotations):
-                if self.args.only_print_best_partition and cpath is not None and cpath.i_best is not None and line['unique_ids'] not in cpath.partitions[cpath.i_best]:
+                if self.args.only_print_best_partition and cpath is not None and cpath.i_best is not None and line['unique_ids'] not in cpath.best(readonly=True):
                     continue
                 if (self.args.only_print_seed_clusters or self.args.seed_unique_id is not None) and seed_uid not in line['unique_ids']:  # we only use the seed id from the command line here, so you can print all the clusters even if you ran seed partitioning UPDATE wait did I change my mind? need to check
                     continue
@@ -477,7 +493,7 @@ class PartitionDriver(object):
                 if 'unique_ids' not in reader.fieldnames:
                     raise Exception('not an annotation file: %s' % outfname)
                 annotation_list = list(reader)
-        elif utils.getsuffix(outfname) == '.yaml':  # new way
+        elif utils.getsuffix(outfname) in ['.yaml', columnarfile.suffix]:  # new way
             # NOTE replaces <self.glfo>, which is definitely what we want (that's the point of putting glfo in the yaml file), but it's still different behavior than if reading a csv
             assert self.glfo is None  # make sure bin/partis successfully figured out that we would be reading the glfo from the yaml output file
             self.glfo, annotation_list, cpath = utils.read_yaml_output(outfname, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id)  # add implicit info below, so we can skip some of 'em
@@ -534,7 +550,9 @@ class PartitionDriver(object):
         print 'hmm'
 
         # pre-cache hmm naive seq for each single query NOTE <self.current_action> is still 'partition' for this (so that we build the correct bcrham command line)
-        if self.args.persistent_cachefname is None or not os.path.exists(self.hmm_cachefname):  # if the default (no persistent cache file), or if a not-yet-existing persistent cache file was specified
+        if self.resuming():
+            self.get_checkpoint().restore_cache(self.hmm_cachefname)  # has everything from the precache step and all completed clustering steps
+        elif self.args.persistent_cachefname is None or not os.path.exists(self.hmm_cachefname):  # if the default (no persistent cache file), or if a not-yet-existing persistent cache file was specified
             print 'caching all %d naive sequences' % len(self.sw_info['queries'])  # this used to be a speed optimization, but now it's so we have better naive sequences for the pre-bcrham collapse
             self.run_hmm('viterbi', self.sub_param_dir, n_procs=self.auto_nprocs(len(self.sw_info['queries'])), precache_all_naive_seqs=True)
 
@@ -551,6 +569,45 @@ class PartitionDriver(object):
 
         self.check_partition(cpath.partitions[cpath.i_best])
 
+    # ----------------------------------------------------------------------------------------
+    def get_checkpoint(self):
+        if self.args.checkpoint_dir is None:
+            return None
+        if self.checkpoint is None:
+            self.checkpoint = PartitionCheckpoint(self.args.checkpoint_dir, self.sw_info['queries'])
+            if not self.args.resume:
+                self.checkpoint.clear()
+        return self.checkpoint
+
+    # ----------------------------------------------------------------------------------------
+    def resuming(self):
+        return self.args.resume and self.get_checkpoint().exists()
+
+    # ----------------------------------------------------------------------------------------
+    def save_checkpoint(self, cpath, n_proc_list, next_n_procs, initial_nseqs, finished_clustering=False):
+        if self.get_checkpoint() is None:
+            return
+        start = time.time()
+        extra_state = {'initial-nseqs' : initial_nseqs, 'timing-info' : self.timing_info, 'unseeded-seqs' : self.unseeded_seqs, 'small-cluster-seqs' : self.small_cluster_seqs}
+        if self.nproc_scheduler is not None:
+            extra_state['nproc-scheduler'] = {'steps' : self.nproc_scheduler.steps, 'predictions' : self.nproc_scheduler.predictions}
+        progress_fnames = [self.get_cpath_progress_fname(i) for i in range(self.istep + (1 if finished_clustering else 0))]
+        self.get_checkpoint().save(self.istep, cpath, n_proc_list, next_n_procs, self.hmm_cachefname, progress_fnames, extra_state, finished_clustering=finished_clustering)
+        if self.args.debug:
+            print '      wrote checkpoint to %s (%.1f sec)' % (self.args.checkpoint_dir, time.time() - start)
+
+    # ----------------------------------------------------------------------------------------
+    def restore_checkpoint(self):  # returns (cpath, n_proc_list, next n_procs, initial_nseqs, finished_clustering)
+        state, cpath = self.get_checkpoint().restore(self.get_cpath_progress_fname, seed_unique_id=self.args.seed_unique_id)
+        if not os.path.exists(self.cpath_progress_dir):
+            os.makedirs(self.cpath_progress_dir)
+        self.istep = state['istep']
+        self.timing_info = state['timing-info']
+        self.unseeded_seqs, self.small_cluster_seqs = state['unseeded-seqs'], state['small-cluster-seqs']
+        if self.nproc_scheduler is not None and 'nproc-scheduler' in state:
+            self.nproc_scheduler.steps, self.nproc_scheduler.predictions = state['nproc-scheduler']['steps'], state['nproc-scheduler']['predictions']
+        return cpath, state['n-proc-list'], state['next-n-procs'], state['initial-nseqs'], state['finished-clustering']
+
     # ----------------------------------------------------------------------------------------
     def split_seeded_clusters(self, old_cpath):
         seeded_clusters, unseeded_clusters = utils.split_partition_with_criterion(old_cpath.partitions[old_cpath.i_best_minus_x], lambda cluster: self.args.seed_unique_id in cluster)
@@ -604,9 +661,14 @@ class PartitionDriver(object):
         last_n_procs = n_proc_list[-1]
         next_n_procs = last_n_procs
 
-        factor = 1.3
-        if self.shall_we_reduce_n_procs(last_n_procs, n_proc_list):
-            next_n_procs = int(next_n_procs / float(factor))
+        if self.nproc_scheduler is not None:
+            partition = cpath.partitions[cpath.i_best_minus_x]
+            self.nproc_scheduler.add_step(last_n_procs, self.timing_info[-1]['n_clusters'], len(partition), self.timing_info[-1]['mean_cluster_size'], self.bcrham_proc_info, self.timing_info[-1])
+            next_n_procs = self.nproc_scheduler.choose_n_procs(len(partition), sum(len(c) for c in partition) / float(len(partition)), n_proc_list)
+        else:
+            factor = 1.3
+            if self.shall_we_reduce_n_procs(last_n_procs, n_proc_list):
+                next_n_procs = int(next_n_procs / float(factor))
 
         def time_to_remove_some_seqs(n_proc_threshold):
             return len(n_proc_list) >= n_proc_threshold or next_n_procs == 1
@@ -614,9 +676,13 @@ class PartitionDriver(object):
         if self.args.small_clusters_to_ignore is not None and self.small_cluster_seqs is None and time_to_remove_some_seqs(self.args.n_steps_after_which_to_ignore_small_clusters):
             cpath = self.remove_small_clusters(cpath)
             next_n_procs = self.scale_n_procs_for_new_n_clusters(initial_nseqs, n_proc_list[0], cpath)
+            if self.nproc_scheduler is not None:
+                self.nproc_scheduler.predictions[-1] = None  # the prediction was for the old partition
         if self.args.seed_unique_id is not None and self.unseeded_seqs is None and time_to_remove_some_seqs(3):  # if we didn't already remove the unseeded clusters in a partition previous step
             cpath = self.split_seeded_clusters(cpath)
             next_n_procs = self.scale_n_procs_for_new_n_clusters(initial_nseqs, n_proc_list[0], cpath)
+            if self.nproc_scheduler is not None:
+                self.nproc_scheduler.predictions[-1] = None
 
         return next_n_procs, cpath
 
@@ -683,6 +749,7 @@ class PartitionDriver(object):
             partition.pop(iclust)
         for nclust in new_clusters:
             partition.append(nclust)
+        cpath.partitions[cpath.i_best] = partition  # <partition> is a copy, so we have to put it back
 
         if debug:
             cpath.print_partitions()
@@ -767,24 +834,40 @@ class PartitionDriver(object):
     def cluster_with_bcrham(self):
         tmpstart = time.time()
         n_procs = self.args.n_procs
-        cpath, initial_nseqs = self.init_cpath(n_procs)
-        n_proc_list = []
-        self.istep = 0
+        if self.args.adaptive_n_procs:
+            self.nproc_scheduler = NProcScheduler(n_procs if self.args.batch_system is not None else min(n_procs, multiprocessing.cpu_count()), max_reduction_factor=self.args.n_procs_max_reduction_factor, min_step_time=float(self.args.min_hmm_step_time), debug=self.args.debug)
+        if self.resuming():
+            cpath, n_proc_list, n_procs, initial_nseqs, finished_clustering = self.restore_checkpoint()
+            if finished_clustering:  # died during (or after) the final annotation step, so we already have the final cpath
+                return cpath
+        else:
+            cpath, initial_nseqs = self.init_cpath(n_procs)
+            n_proc_list = []
+            self.istep = 0
         start = time.time()
-        while n_procs > 0:
-            print '%d clusters with %d proc%s' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
-            cpath, _, _ = self.run_hmm('forward', self.sub_param_dir, n_procs=n_procs, partition=cpath.partitions[cpath.i_best_minus_x], shuffle_input=True)  # note that this annihilates the old <cpath>, which is a memory optimization (but we write all of them to the cpath progress dir)
-            n_proc_list.append(n_procs)
-            if self.are_we_finished_clustering(n_procs, cpath):
-                break
-            n_procs, cpath = self.prepare_next_iteration(n_proc_list, cpath, initial_nseqs)
-            self.istep += 1
+        if self.args.persistent_bcrham_workers and n_procs > 1:
+            self.bcrham_workers = BcrhamWorkerPool(self.args.partis_dir + '/packages/ham/bcrham', n_procs, self.args.workdir, debug=self.args.debug)
+        try:
+            while n_procs > 0:
+                print '%d clusters with %d proc%s' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
+                cpath, _, _ = self.run_hmm('forward', self.sub_param_dir, n_procs=n_procs, partition=cpath.partitions[cpath.i_best_minus_x], shuffle_input=True)  # note that this annihilates the old <cpath>, which is a memory optimization (but we write all of them to the cpath progress dir)
+                n_proc_list.append(n_procs)
+                if self.are_we_finished_clustering(n_procs, cpath):
+                    break
+                n_procs, cpath = self.prepare_next_iteration(n_proc_list, cpath, initial_nseqs)
+                self.istep += 1
+                self.save_checkpoint(cpath, n_proc_list, n_procs, initial_nseqs)
+        finally:
+            if self.bcrham_workers is not None:
+                self.bcrham_workers.close()
+                self.bcrham_workers = None
 
         if self.args.max_cluster_size is not None:
             print '   --max-cluster-size (partitiondriver): merging shared clusters'
             self.merge_shared_clusters(cpath)
 
         cpath = self.merge_cpaths_from_previous_steps(cpath)
+        self.save_checkpoint(cpath, n_proc_list, n_procs, initial_nseqs, finished_clustering=True)
 
         print '      loop time: %.1f' % (time.time()-start)
         return cpath
@@ -902,23 +985,10 @@ class PartitionDriver(object):
     def get_cached_hmm_naive_seqs(self, queries=None):
         # would be nice to merge this with self.read_hmm_cachefile()
         expected_queries = self.sw_info['queries'] if queries is None else queries
-        cached_naive_seqs = {}
-        with open(self.hmm_cachefname) as cachefile:
-            reader = csv.DictReader(cachefile)
-            for line in reader:
-                if ':' in line['unique_ids']:  # if it's a cache file left over from a previous partitioning, there'll be clusters in it, too
-                    continue
-                if line['unique_ids'] not in expected_queries:  # probably can only happen if self.args.persistent_cachefname is set
-                    continue
-                cached_naive_seqs[line['unique_ids']] = line['naive_seq']
-                if len(cached_naive_seqs) == len(expected_queries):  # already got everybody
-                    break
+        cached_naive_seqs = self.get_hmm_cache().get_naive_seqs(expected_queries)  # only looks up lines for the single-sequence uid strings we want (rather than reading the whole file)
 
         if set(cached_naive_seqs) != set(expected_queries):  # can happen if hmm can't find a path for a sequence for which sw *did* have an annotation (but in that case the annotation is almost certainly garbage)
-            extra = set(cached_naive_seqs) - set(expected_queries)
             missing = set(expected_queries) - set(cached_naive_seqs)
-            if len(extra) > 0:
-                print '    %s read %d extra queries from hmm cache file %s' % (utils.color('yellow', 'warning:'), len(extra), ' '.join(extra))
             if len(missing) > 0:
                 print '    %s missing %d queries from hmm cache file (using sw naive sequence instead): %s' % (utils.color('yellow', 'warning:'), len(missing), ' '.join(missing))
                 for uid in missing:
@@ -926,6 +996,12 @@ class PartitionDriver(object):
 
         return cached_naive_seqs
 
+    # ----------------------------------------------------------------------------------------
+    def get_hmm_cache(self):
+        if self.hmm_cache is None:
+            self.hmm_cache = HmmCacheStore(self.hmm_cachefname)
+        return self.hmm_cache
+
     # ----------------------------------------------------------------------------------------
     def cluster_with_naive_vsearch_or_swarm(self, parameter_dir=None):
         start = time.time()
@@ -943,15 +1019,19 @@ class PartitionDriver(object):
 
         print '    using hfrac bound for vsearch %.3f' % threshold
 
-        partition = []
-        print '    running vsearch %d times (once for each cdr3 length class):' % len(all_naive_seqs),
+        # small cdr3 classes (i.e. most of them) take much longer to start vsearch on than to cluster, so we do those in-process (naive seqs in a cdr3 class are all padded to the same length, and the no-indel greedy clustering is what vsearch does anyway)
+        hash_partition = []
+        vsearch_classes = []
         for cdr3_length, sub_naive_seqs in all_naive_seqs.items():
-            sub_hash_partition = utils.run_vsearch('cluster', sub_naive_seqs, self.args.workdir + '/vsearch', threshold, vsearch_binary=self.args.vsearch_binary)
-            sub_uid_partition = [[uid for hashstr in hashcluster for uid in naive_seq_hashes[hashstr]] for hashcluster in sub_hash_partition]
-            partition += sub_uid_partition
-            print '.',
-            sys.stdout.flush()
-        print ''
+            if len(sub_naive_seqs) <= self.args.max_in_process_vsearch_size and len(set(len(s) for s in sub_naive_seqs.values())) == 1:
+                hash_partition += utils.greedy_centroid_cluster(sub_naive_seqs, threshold, sizes={h : len(naive_seq_hashes[h]) for h in sub_naive_seqs})
+            else:
+                vsearch_classes.append(sub_naive_seqs)
+        print '    clustered %d cdr3 length class%s in-process, running vsearch on %d' % (len(all_naive_seqs) - len(vsearch_classes), utils.plural(len(all_naive_seqs) - len(vsearch_classes), prefix='e'), len(vsearch_classes))
+        if len(vsearch_classes) > 0:
+            for sub_hash_partition in utils.run_vsearch_clusters(vsearch_classes, self.args.workdir + '/vsearch', threshold, n_procs=self.args.n_procs, vsearch_binary=self.args.vsearch_binary):
+                hash_partition += sub_hash_partition
+        partition = [[uid for hashstr in hashcluster for uid in naive_seq_hashes[hashstr]] for hashcluster in hash_partition]
 
         ccfs = [None, None]
         if not self.args.is_data:  # it's ok to always calculate this since it's only ever for one partition
@@ -995,7 +1075,7 @@ class PartitionDriver(object):
         cmd_str += ' --outfile ' + csv_outfname
         cmd_str += ' --locus ' + self.args.locus
         cmd_str += ' --random-seed ' + str(self.args.seed)
-        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (initial cache file is copied to each subdir)
+        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (all procs read the main cache file, and we append their new info to it afterwards)
             cmd_str += ' --only-cache-new-vals'
 
         if self.args.dont_rescale_emissions:
@@ -1051,6 +1131,10 @@ class PartitionDriver(object):
                 self.subworkdirs.append(subworkdir)
             return subworkdir + '/hmm-' + str(iproc)
 
+    # ----------------------------------------------------------------------------------------
+    def use_bcrham_workers(self, n_procs):  # the workers keep reading new lines from the end of the main cache file, so for the last (single-process) step, which rewrites the whole cache file, we use a normal subprocess
+        return self.bcrham_workers is not None and n_procs > 1 and n_procs <= self.bcrham_workers.n_workers()
+
     # ----------------------------------------------------------------------------------------
     def print_partition_dbgfo(self):
         if self.bcrham_proc_info is None:
@@ -1088,11 +1172,14 @@ class PartitionDriver(object):
         def get_cmd_str(iproc):  # all this does at this point is replace workdir with sub-workdir in hmm input, output, and cache file arguments
             strlist = cmd_str.split()
             for istr in range(len(strlist)):
+                if strlist[istr - 1] == '--input-cachefname':  # all procs read the main cache file (it's only ever appended to while they're not running), rather than a copy
+                    continue
                 if strlist[istr] == self.hmm_infname or strlist[istr] == self.hmm_cachefname or strlist[istr] == self.hmm_outfname:
                     strlist[istr] = strlist[istr].replace(self.args.workdir, self.subworkdir(iproc, n_procs))
             return ' '.join(strlist)
 
-        print '    running %d proc%s' % (n_procs, utils.plural(n_procs))
+        use_workers = self.use_bcrham_workers(n_procs)
+        print '    running %d %s%s' % (n_procs, 'persistent worker' if use_workers else 'proc', utils.plural(n_procs))
         sys.stdout.flush()
         start = time.time()
 
@@ -1102,7 +1189,16 @@ class PartitionDriver(object):
                    'outfname' : get_outfname(iproc),
                    'dbgfo' : self.bcrham_proc_info[iproc]}
                   for iproc in range(n_procs)]
-        utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, debug='print' if self.args.debug else None)
+        if use_workers:
+            failed_iprocs = self.bcrham_workers.run(cmdfos, debug='print' if self.args.debug else None)
+            if not self.bcrham_workers.is_open():  # if any of them failed, the pool closes itself
+                self.bcrham_workers = None
+            cmdfos = [cmdfos[i] for i in failed_iprocs]  # rerun any failures as normal subprocesses
+        if len(cmdfos) > 0:
+            proc_records = utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, debug='print' if self.args.debug else None,
+                                          retry_fcn=utils.retry_killed_procs if self.args.batch_system is None else None)  # (batch systems already get several tries for any failure)
+            if self.args.debug:
+                print '      bcrham %s' % utils.proc_records_str(proc_records)
         self.print_partition_dbgfo()
 
         self.check_wait_times(time.time()-start)
@@ -1195,94 +1291,153 @@ class PartitionDriver(object):
                 utils.replace_seqs_in_line(self.reco_info[hashid], [{'name' : hashid, 'seq' : line['naive_seq']}], self.simglfo, try_to_fix_padding=True)  # i wish i could set refuse_to_align=True since it's slow, but sometimes it needs to align (when j length to right of tryp differs)
 
         # ----------------------------------------------------------------------------------------
+        def check_missing(cluster, failures):  # make sure a cluster missing from bcrham output is accounted for in <failures>
+            if len(set(cluster) - failures) > 0:
+                raise Exception('cluster missing from output with uids not in hmm failures: %s\n    missing uids: %s' % (skey(cluster), ' '.join(set(cluster) - failures)))
+
+        # ----------------------------------------------------------------------------------------
+        def queue_subclusters(sfo, subclusters):  # add a new round of subclusters for the big cluster <sfo>
+            sfo['history'].append(subclusters)
+            sfo['pending'] = set(skey(c) for c in subclusters)
+            for sclust in subclusters:
+                ready_tasks.append((sclust, sfo['uidstr']))
+
+        # ----------------------------------------------------------------------------------------
+        def finish_round(sfo):  # all subclusters from the latest round for the big cluster <sfo> are annotated, so either make the next round from their naive seqs, or (if there was only one) we're done
+            subclusters = sfo['history'][-1]
+            if len(subclusters) > 1:
+                naive_hashes = []
+                for sclust in subclusters:  # go in the order of <subclusters> (rather than the order in which they finished), which is important since getsubclusters() doesn't do any clustering (it relies on them being ordered by similarity)
+                    sline = sfo['annotations'][skey(sclust)]
+                    hashid = hashstr(sline['unique_ids'])
+                    naive_hashes.append(hashid)
+                    add_hash_seq(sline, hashid, naive_hashes)  # add it to stuff so it can get run on
+                sfo['annotations'] = {}
+                queue_subclusters(sfo, getsubclusters(naive_hashes))
+                if debug:
+                    print '      size %d cluster: round %d with %d subclusters: %s' % (len(sfo['uids']), len(sfo['history']) - 1, len(sfo['history'][-1]), ' '.join(str(len(c)) for c in sfo['history'][-1]))
+                return
+            sclust = sfo['uids']
+            if debug:
+                print '  %s cluster with original size %d and split history: %s' % (utils.color('blue', 'finishing'), len(sclust), '   '.join(' '.join(str(len(c)) for c in sclist) for sclist in sfo['history']))
+            line = sfo['annotations'][skey(subclusters[0])]
+            sfos_to_add = [{'name' : u, 'seq' : self.sw_info[u]['seqs'][0]} for u in sclust]  # original "leaf" seqs that we actually care about (i.e. not inferred hashid naive seqs)
+            utils.replace_seqs_in_line(line, sfos_to_add, self.glfo, try_to_fix_padding=True, refuse_to_align=True)  # i think aligning should be unnecessary here, and it's really slow so we don't want to do it by accident (but trimming Ns off the ends seems pretty harmless and it might be enough)
+            self.add_per_seq_sw_info(line)
+            final_annotations[sfo['uidstr']] = line
+            del subd_clusters[sfo['uidstr']]
+            counts['sub-finished'] += 1
+
+        # ----------------------------------------------------------------------------------------
+        def handle_result(cluster, owner, annotations, failures):  # process the annotation (or failure) for one task: add to final annotations if it's a simple/whole cluster, or store it (and maybe start the next round) if it's a subcluster
+            uidstr = skey(cluster)
+            if owner is None:  # simple/whole cluster
+                if uidstr in annotations:
+                    final_annotations[uidstr] = annotations[uidstr]
+                    counts['whole-finished'] += 1
+                else:
+                    check_missing(cluster, failures)
+                    print '      removing failed cluster for %s:' % uidstr
+                return
+            if owner not in subd_clusters:  # already gave up on it
+                return
+            sfo = subd_clusters[owner]
+            if uidstr not in annotations:
+                check_missing(cluster, failures)
+                print '    giving up on size %d cluster with failed seqs (was just split into %d subclusters): %s' % (len(sfo['uids']), len(sfo['history'][-1]), owner)
+                del subd_clusters[owner]
+                return
+            sfo['annotations'][uidstr] = annotations[uidstr]
+            sfo['pending'].remove(uidstr)
+            if len(sfo['pending']) == 0:
+                finish_round(sfo)
+
+        # ----------------------------------------------------------------------------------------
+        def start_task_batch():  # start a bcrham proc on the next batch of ready tasks (or, if they're all in the annotation cache, just process them)
+            n_free_procs = n_procs - len(running)
+            batch_size = int(math.ceil(len(ready_tasks) / float(n_free_procs)))
+            tasks = [ready_tasks.popleft() for _ in range(batch_size)]
+            ibatch = counts['batches']
+            counts['batches'] += 1
+            bworkdir = '%s/subcl-annotate/batch-%d' % (self.args.workdir, ibatch)
+            utils.prep_dir(bworkdir)
+            infname, outfname = '%s/%s' % (bworkdir, os.path.basename(self.hmm_infname)), '%s/%s' % (bworkdir, os.path.basename(self.hmm_outfname))
+            cachefo = self.init_annotation_cachefo(parameter_in_dir)
+            n_lines_written = self.write_to_single_input_file(infname, [c for c, _ in tasks], parameter_in_dir, cachefo=cachefo)
+            cmdfo = {'cmd_str' : self.get_hmm_cmd_str('viterbi', infname, outfname, parameter_dir=parameter_in_dir, precache_all_naive_seqs=False, n_procs=1),
+                     'workdir' : bworkdir, 'outfname' : outfname, 'logdir' : bworkdir, 'workfnames' : [infname]}
+            bfo = {'cmdfo' : cmdfo, 'tasks' : tasks, 'cachefo' : cachefo, 'n_tried' : 0}
+            if n_lines_written == 0 and cachefo is not None:  # everything was cached
+                open(outfname, 'w').close()
+                finish_task_batch(bfo)
+                return
+            running.append(bfo)
+            procs.append(None)
+            start_proc(len(running) - 1)
+
+        # ----------------------------------------------------------------------------------------
+        def start_proc(iproc):
+            procs[iproc] = utils.run_cmd(running[iproc]['cmdfo'], batch_system=self.args.batch_system, batch_options=self.args.batch_options)
+            running[iproc]['n_tried'] += 1
+
+        # ----------------------------------------------------------------------------------------
+        def finish_task_batch(bfo):
+            if bfo['cachefo'] is not None:
+                self.update_annotation_cache(bfo['cachefo'], outfname=bfo['cmdfo']['outfname'])
+            annotations, failures = self.read_annotation_output(bfo['cmdfo']['outfname'], is_subcluster_recursed=True)
+            all_hmm_failures.update(failures)
+            for ifn in bfo['cmdfo']['workfnames']:
+                if os.path.exists(ifn):
+                    os.remove(ifn)
+            if len(os.listdir(bfo['cmdfo']['workdir'])) == 0:  # should be empty, but we don't want to crash just because bcrham left something lying around
+                os.rmdir(bfo['cmdfo']['workdir'])
+            for cluster, owner in bfo['tasks']:
+                handle_result(cluster, owner, annotations, failures)
+
+        # ----------------------------------------------------------------------------------------
+        # Each cluster that needs splitting goes through several rounds (split into subclusters, annotate them, replace each with its inferred naive seq, split those...), where each round only depends on that cluster's previous round.
+        # So rather than running each round for all clusters together in one run_hmm() call (which leaves most procs idle for the later rounds of the biggest clusters), we treat each (sub)cluster annotation as a task, and run batches of whichever tasks are ready as procs free up.
         subc_start = time.time()
         final_annotations = {}
         all_hmm_failures = set()
         subcluster_hash_seqs = {}  # all hash-named naive seqs, i.e. that we only made as intermediate steps, but don't care about afterwards (we keep track here just so we can remove them from input sw, and reco info afterwards)
+        counts = {'batches' : 0, 'whole-finished' : 0, 'sub-finished' : 0}
 
-        istep = 0
         print '  subcluster annotating %d cluster%s: %s' % (len(init_partition), utils.plural(len(init_partition)), '' if not debug else ' '.join(utils.color('blue' if self.subcl_split(len(c)) else None, str(len(c))) for c in init_partition))
-        clusters_still_to_do = [copy.deepcopy(c) for c in init_partition]
-        subd_clusters = {}  # keeps track of all the extra info for clusters that we actually had to subcluster: for each such cluster, stores a list where each entry is the subclusters for that round (i.e. the first entry has subclusters composed of the actual seqs in the cluster, and after that it's intermediate naives/hashid seqs)
-        naive_ancestor_hashes = {}  # list of inferred naive "intermediate" (hashid) seqs, for each subclustered cluster, that we'll run on in the next step (if there is a next step)
-        while len(clusters_still_to_do) > 0:
-            if debug:
-                print '   %s %d cluster%s left with size%s %s' % (utils.color('green', 'istep %d:'%istep), len(clusters_still_to_do), utils.plural(len(clusters_still_to_do)), utils.plural(len(clusters_still_to_do)), ' '.join(str(len(c)) for c in clusters_still_to_do))
-                print '        init     N prior  current    N     mean pw   subcluster'  # we call it "mean pw hfrac", but it's pairwise *within* each cluster, then the weighted average over clusters (i.e. the smaller it is the tighter/better the clusters are)
-                print '        size     splits    size     subcl   hfrac     sizes'
-            clusters_to_run = []
-            for tclust in clusters_still_to_do:
-                if not self.subcl_split(len(tclust)):  # if <tclust> is small enough we don't need to split it up
-                    clusters_to_run.append(tclust)
-                    if debug:
-                        print '       %4d                   ' % len(tclust)
-                else:
-                    if skey(tclust) in subd_clusters:  # subsequent rounds: get subclusters from intermediate inferred naives (hashids) from the last round
-                        subclusters = getsubclusters(naive_ancestor_hashes[skey(tclust)])
-                        del naive_ancestor_hashes[skey(tclust)]
-                    else:  # first time through: add <tclust> to subd_clusters and get initial subclusters
-                        subd_clusters[skey(tclust)] = []
-                        subclusters = getsubclusters(tclust, shuffle=self.reco_info is not None and istep==0)  # the order of uids in each cluster that comes out of simulation is the order of leaves in the tree (i.e. they're sorted by similarity), so it's *extremely* important to shuffle them to get a fair comparison
-                    subd_clusters[skey(tclust)].append(subclusters)
-                    clusters_to_run += subclusters
-                    if debug:
-                        n_prev = len(subd_clusters[skey(tclust)]) - 1
-                        mphfracs = [utils.mean_pairwise_hfrac([self.sw_info[u]['seqs'][0] for u in c]) for c in subclusters]
-                        mean_weighted_pw_hfrac = numpy.average(mphfracs, weights=[len(c) / float(len(tclust)) for c in subclusters])
-                        print '       %4d      %s      %s      %3d      %4.2f      %s' % (len(tclust), '   ' if n_prev==0 else '%3d'%n_prev, '   ' if n_prev==0 else '%3d'%sum(len(c) for c in subclusters), len(subclusters), mean_weighted_pw_hfrac, ' '.join(str(len(c)) for c in subclusters))
-            _, annotations, step_failures = self.run_hmm('viterbi', parameter_in_dir, partition=clusters_to_run, n_procs=n_procs, is_subcluster_recursed=True)  # is_subcluster_recursed is really just a speed optimization so it doesn't have to check the length of every cluster
-            # make sure all missing cluster are accounted for in <step_failures>
-            missing_clusters = [c for c in clusters_to_run if skey(c) not in annotations]
-            if len(missing_clusters) > 0:
-                print '    missing %d annotations' % len(missing_clusters)
-            for mclust in missing_clusters:
-                if len(set(mclust) - step_failures) > 0:
-                    raise Exception('cluster missing from output with uids not in hmm failures: %s\n    missing uids: %s' % (skey(mclust), ' '.join(set(mclust) - step_failures)))
-                if mclust in clusters_still_to_do:  # i.e. if it's a simple/whole cluster
-                    print '      removing failed cluster for %s:' % skey(mclust)
-                    clusters_still_to_do.remove(mclust)
-            all_hmm_failures |= step_failures
-            # process each annotation that we just got back from bcrham: store inferred naive/hash seq if it's a subcluster, or add to final annotations if it's a simple/whole cluster
-            n_hashed, n_whole_finished = 0, 0
-            failed_super_clusters = []
-            for super_uidstr, subcluster_lists in subd_clusters.items():  # we used to loop over <annotations>, which was cleaner in some ways, but then it was hard to make sure the hashid seqs stayed in the same order, which is important if we're not using kmeans
-                if any(sclust in missing_clusters for sclust in subcluster_lists[-1]):
-                    failed_super_clusters.append(super_uidstr)
-                    continue
-                for sclust in subcluster_lists[-1]:
-                    sline = annotations[skey(sclust)]
-                    hashid = hashstr(sline['unique_ids'])
-                    if super_uidstr not in naive_ancestor_hashes:
-                        naive_ancestor_hashes[super_uidstr] = []
-                    naive_ancestor_hashes[super_uidstr].append(hashid)  # add it to the list of inferred naives that we need to run next time through (if there is a next time)
-                    add_hash_seq(sline, hashid, naive_ancestor_hashes[super_uidstr])  # add it to stuff so it can get run on
-                    n_hashed += 1
-            for fsclust in failed_super_clusters:
-                print '    giving up on size %d cluster with failed seqs (was just split into %d subclusters): %s' % (len(skey_inverse(fsclust)), len(subd_clusters[fsclust][-1]), fsclust)
-                clusters_still_to_do.remove(skey_inverse(fsclust))
-                del subd_clusters[fsclust]
-            for sclust in [c for c in clusters_still_to_do if skey(c) in annotations]:  # non-subclustered/simple/whole clusters (only happens first time through) [there's simpler ways to get these, but we need to account for failures]
-                final_annotations[skey(sclust)] = annotations[skey(sclust)]
-                clusters_still_to_do.remove(sclust)
-                n_whole_finished += 1
-            # finalize any subclustered clusters that're finished (i.e. that only had one subcluster this time through)
-            n_sub_finished = 0
-            for uidstr, subcluster_lists in subd_clusters.items():  # handle the ones that're done (at this point they should be an annotation of about length self.args.subcluster_annotation_size consisting of just inferred subcluster naives)
-                if len(subcluster_lists[-1]) > 1:  # not finished yet
+        subd_clusters = {}  # info for clusters that we actually have to subcluster: uids, split history (list of the subclusters for each round, where the first entry has subclusters of the actual seqs in the cluster, and after that it's intermediate naive/hashid seqs), and pending/finished annotations for the current round
+        ready_tasks = deque()  # (cluster, uidstr of the cluster it's a subcluster of [None if it's a simple/whole cluster]) for each cluster that's ready to be annotated
+        for tclust in init_partition:
+            if not self.subcl_split(len(tclust)):  # if <tclust> is small enough we don't need to split it up
+                ready_tasks.append((copy.deepcopy(tclust), None))
+                continue
+            sfo = {'uidstr' : skey(tclust), 'uids' : copy.deepcopy(tclust), 'history' : [], 'pending' : set(), 'annotations' : {}}
+            subd_clusters[sfo['uidstr']] = sfo
+            queue_subclusters(sfo, getsubclusters(tclust, shuffle=self.reco_info is not None))  # the order of uids in each cluster that comes out of simulation is the order of leaves in the tree (i.e. they're sorted by similarity), so it's *extremely* important to shuffle them to get a fair comparison
+
+        glutils.write_glfo(self.my_gldir, self.glfo)
+        running, procs = [], []  # info for each running batch, and its Popen
+        n_max_tries = 1 if self.args.batch_system is None else 3  # same as utils.run_cmds()
+        with utils.ChildProcWaiter() as waiter:
+            while len(ready_tasks) > 0 or len(running) > 0:
+                while len(ready_tasks) > 0 and len(running) < n_procs:
+                    start_task_batch()
+                if len(running) == 0:
                     continue
-                sclust = skey_inverse(uidstr)
-                if debug:
-                    print '  %s cluster with original size %d and split history: %s' % (utils.color('blue', 'finishing'), len(sclust), '   '.join(' '.join(str(len(c)) for c in sclist) for sclist in subcluster_lists))
-                line = annotations[skey(subcluster_lists[-1][0])]
-                sfos_to_add = [{'name' : u, 'seq' : self.sw_info[u]['seqs'][0]} for u in sclust]  # original "leaf" seqs that we actually care about (i.e. not inferred hashid naive seqs)
-                utils.replace_seqs_in_line(line, sfos_to_add, self.glfo, try_to_fix_padding=True, refuse_to_align=True)  # i think aligning should be unnecessary here, and it's really slow so we don't want to do it by accident (but trimming Ns off the ends seems pretty harmless and it might be enough)
-                self.add_per_seq_sw_info(line)
-                final_annotations[uidstr] = line
-                clusters_still_to_do.remove(sclust)
-                del subd_clusters[uidstr]
-                n_sub_finished += 1
-            print '    read %d new subcluster annotation%s: added hashid %d   whole finished %d   subcl finished %d' % (len(annotations), utils.plural(len(annotations)), n_hashed, n_whole_finished, n_sub_finished)
-            istep += 1
+                finished_iprocs = []
+                for iproc, _ in waiter.wait(procs):
+                    status = utils.finish_process(iproc, procs, running[iproc]['n_tried'], running[iproc]['cmdfo'], n_max_tries, batch_system=self.args.batch_system, debug='print' if self.args.debug else None, retry_fcn=utils.retry_killed_procs if self.args.batch_system is None else None)
+                    if status == 'restart':
+                        start_proc(iproc)
+                    else:
+                        finished_iprocs.append(iproc)
+                for iproc in sorted(finished_iprocs, reverse=True):  # remove them before processing, since processing can queue new tasks (but we can't start them until the finished procs are out of the lists)
+                    bfo = running.pop(iproc)
+                    procs.pop(iproc)
+                    finish_task_batch(bfo)
+        glutils.remove_glfo_files(self.my_gldir, self.args.locus)
+        if os.path.exists(self.args.workdir + '/subcl-annotate') and len(os.listdir(self.args.workdir + '/subcl-annotate')) == 0:
+            os.rmdir(self.args.workdir + '/subcl-annotate')
+        print '    ran %d bcrham batch%s: whole finished %d   subcl finished %d   (%d hashid seqs)' % (counts['batches'], utils.plural(counts['batches'], prefix='e'), counts['whole-finished'], counts['sub-finished'], len(subcluster_hash_seqs))
 
         for uid in subcluster_hash_seqs:
             del self.sw_info[uid]
@@ -1316,27 +1471,36 @@ class PartitionDriver(object):
             assert not shuffle_input
             return self.run_subcluster_annotate(nsets, parameter_in_dir, n_procs, count_parameters=count_parameters, parameter_out_dir=parameter_out_dir, dont_print_annotations=dont_print_annotations, debug=self.args.debug)
 
-        self.write_to_single_input_file(self.hmm_infname, nsets, parameter_in_dir, shuffle_input=shuffle_input)  # single file gets split up later if we've got more than one process
+        cachefo = self.init_annotation_cachefo(parameter_in_dir) if algorithm == 'viterbi' and self.current_action != 'partition' else None
+        n_lines_written = self.write_to_single_input_file(self.hmm_infname, nsets, parameter_in_dir, shuffle_input=shuffle_input, cachefo=cachefo)  # single file gets split up later if we've got more than one process
         glutils.write_glfo(self.my_gldir, self.glfo)
         if time.time() - start > 0.1:
             print '        hmm prep time: %.1f' % (time.time() - start)
 
-        cmd_str = self.get_hmm_cmd_str(algorithm, self.hmm_infname, self.hmm_outfname, parameter_dir=parameter_in_dir, precache_all_naive_seqs=precache_all_naive_seqs, n_procs=n_procs)
-
-        if n_procs > 1:
-            self.split_input(n_procs, self.hmm_infname)
-
         exec_start = time.time()
-        self.execute(cmd_str, n_procs)
+        run_bcrham = n_lines_written > 0 or cachefo is None
+        if run_bcrham:
+            if cachefo is not None:  # don't start procs that'd have nothing to do
+                n_procs = min(n_procs, max(1, n_lines_written))
+            cmd_str = self.get_hmm_cmd_str(algorithm, self.hmm_infname, self.hmm_outfname, parameter_dir=parameter_in_dir, precache_all_naive_seqs=precache_all_naive_seqs, n_procs=n_procs)
+            if n_procs > 1:
+                self.split_input(n_procs, self.hmm_infname)
+            self.execute(cmd_str, n_procs)
+        else:  # everything was in the annotation cache
+            print '    all %d clusters in annotation cache, not running bcrham' % len(cachefo['hits'])
+            n_procs = 1
+            open(self.hmm_outfname, 'w').close()
         exec_time = time.time() - exec_start
 
         glutils.remove_glfo_files(self.my_gldir, self.args.locus)
 
         cpath, annotations, hmm_failures = None, None, None
-        if self.current_action == 'partition' or n_procs > 1:
+        if run_bcrham and (self.current_action == 'partition' or n_procs > 1):
             cpath = self.merge_all_hmm_outputs(n_procs, precache_all_naive_seqs)
             if cpath is not None:
                 cpath.write(self.get_cpath_progress_fname(self.istep), self.args.is_data, reco_info=self.reco_info, true_partition=utils.get_partition_from_reco_info(self.reco_info) if not self.args.is_data else None)
+        if cachefo is not None:
+            self.update_annotation_cache(cachefo)  # add the new lines to the cache, and the cached ones to the output file
 
         if algorithm == 'viterbi' and not precache_all_naive_seqs:
             annotations, hmm_failures = self.read_annotation_output(self.hmm_outfname, count_parameters=count_parameters, parameter_out_dir=parameter_out_dir, print_annotations=self.args.debug and not dont_print_annotations, is_subcluster_recursed=is_subcluster_recursed)
@@ -1349,6 +1513,8 @@ class PartitionDriver(object):
             print '         infra time: %.1f' % (step_time - exec_time)  # i.e. time for non-executing, infrastructure time
         print '      hmm step time: %.1f' % step_time
         self.timing_info.append({'exec' : exec_time, 'total' : step_time})  # NOTE in general, includes pre-cache step
+        if partition is not None:  # cluster size distribution of the step's input (for the n_procs scheduler)
+            self.timing_info[-1].update({'n_clusters' : len(nsets), 'mean_cluster_size' : sum(len(c) for c in nsets) / float(max(1, len(nsets)))})
 
         return cpath, annotations, hmm_failures
 
@@ -1585,21 +1751,18 @@ class PartitionDriver(object):
             return open(self.subworkdir(siproc, n_procs) + '/' + os.path.basename(infname), mode)
         def get_writer(sub_outfile):
             return csv.DictWriter(sub_outfile, reader.fieldnames, delimiter=' ')
-        def copy_cache_files(n_procs):
-            cmdfos = [{'cmd_str' : 'cp ' + self.hmm_cachefname + ' ' + self.subworkdir(iproc, n_procs) + '/',
-                       'workdir' : self.subworkdir(iproc, n_procs),
-                       'outfname' : self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname)}
-                      for iproc in range(n_procs)]
-            utils.run_cmds(cmdfos)
-
-        # initialize output/cache files
+
+        # initialize output files
         for iproc in range(n_procs):
             utils.prep_dir(self.subworkdir(iproc, n_procs))
             sub_outfile = get_sub_outfile(iproc, 'w')
             get_writer(sub_outfile).writeheader()
             sub_outfile.close()  # can't leave 'em all open the whole time 'cause python has the thoroughly unreasonable idea that one oughtn't to have thousands of files open at once
-        if self.current_action == 'partition' and os.path.exists(self.hmm_cachefname):  # copy cachefile to this subdir (first clause is just for so when we're getting cluster annotations we don't copy over the cache files)
-            copy_cache_files(n_procs)
+
+        if self.args.balance_split_input:
+            proc_infos = self.split_input_by_cost(info, n_procs)
+        else:
+            proc_infos = [[info[iq] for iq in range(iproc, len(info), n_procs)] for iproc in range(n_procs)]
 
         seed_clusters_to_write = seeded_clusters.keys()  # the keys in <seeded_clusters> that we still need to write
         for iproc in range(n_procs):
@@ -1618,12 +1781,29 @@ class PartitionDriver(object):
                     writer.writerow(seeded_clusters[smallest_seed_cluster_str])
 
             # then loop over the non-seeded clusters
-            for iquery in range(len(info)):
-                if iquery % n_procs != iproc:
-                    continue
-                writer.writerow(info[iquery])
+            for line in proc_infos[iproc]:
+                writer.writerow(line)
             sub_outfile.close()
 
+    # ----------------------------------------------------------------------------------------
+    def split_input_by_cost(self, info, n_procs):  # split hmm input lines <info> among procs so that each proc's estimated bcrham time is about the same, while keeping clusters with similar naive seqs on the same proc
+        def cost(line):  # forward/viterbi on a multi-seq hmm scales with the number of seqs times their length, and the number of those calculations goes up with cluster size, as well
+            n_seqs = line['names'].count(':') + 1
+            return len(line['seqs'].split(':')[0]) * n_seqs**self.args.split_cost_exponent
+        naive_seqs = self.get_hmm_cache().get_naive_seqs([line['names'].split(':')[0] for line in info])  # just use the first seq's naive seq (and don't warn about missing ones, since e.g. the precache step won't have any)
+        def sortkey(line):  # clusters can only be merged if they have the same cdr3 length, and if their naive seqs are close (so sorting by naive seq within cdr3 length will tend to put mergeable clusters next to each other)
+            uid = line['names'].split(':')[0]
+            if uid in naive_seqs:
+                nseq = naive_seqs[uid]
+            else:
+                nseq = self.sw_info[uid]['naive_seq'] if uid in self.sw_info else ''
+            return int(line['cdr3_length']), nseq
+        proc_infos = utils.split_by_cost(info, n_procs, cost, sortkey=sortkey, rotate=True)  # rotate so the chunk boundaries move between clustering steps
+        if self.args.debug:
+            proc_costs = [sum(cost(l) for l in pinfo) for pinfo in proc_infos]
+            print '      split input by cost among %d procs: min-max total cost %.0f - %.0f' % (n_procs, min(proc_costs), max(proc_costs))
+        return proc_infos
+
     # ----------------------------------------------------------------------------------------
     def merge_subprocess_files(self, fname, n_procs, include_outfile=False):
         subfnames = []
@@ -1639,56 +1819,49 @@ class PartitionDriver(object):
         Merge <infnames> into <outfname>.
         NOTE that <outfname> is overwritten with the zero-length file if it exists, otherwise it is created.
         Some of <infnames> may not exist.
+        If <outfname> is in <infnames>, the others get tacked onto the end of it (and we use its header).
+        Everything is streamed line by line, and if <dereplicate> is set we skip lines that we've already written (using a hash of each line, so we don't have to keep the lines themselves in memory).
         """
-        # check_call(['wc', ] + [fn for fn in infnames if fn != outfname])
-        # if os.path.exists(outfname):
-        #     check_call(['wc', outfname])
-        # else:
-        #     print '  outfname d.n.e.'
-
-        header = ''
-        outfile = None
-        one_real_file = False
-        if outfname not in infnames or not os.path.exists(outfname):  # if it *is* in <infnames> we assume we can just tack the other infnames onto the end of it and use <outfname>'s header
-            outfile = open(outfname, 'w')
-        for fname in infnames:
-            if not os.path.exists(fname) or os.stat(fname).st_size == 0:
-                continue
-            one_real_file = True
-            with open(fname) as headfile:
-                reader = csv.DictReader(headfile)
-                header = ','.join(reader.fieldnames)
-                if outfile is not None:
-                    writer = csv.DictWriter(outfile, reader.fieldnames)
-                    writer.writeheader()
-            break  # kinda weird to do it this way, but we just need one of the infiles to get the header info (and some may be zero length)
-        if outfile is not None:
-            outfile.close()
-        if not one_real_file:
+        real_infnames = [fn for fn in infnames if os.path.exists(fn) and os.stat(fn).st_size > 0]
+        if len(real_infnames) == 0:
             print '    nothing to merge into %s' % outfname
+            if outfname not in infnames or not os.path.exists(outfname):
+                open(outfname, 'w').close()
             return
-
-        assert header != ''
-
-        non_out_infnames = [fn for fn in infnames if fn != outfname]
-        if len(non_out_infnames) == 0:
+        if len([fn for fn in infnames if fn != outfname]) == 0:
             raise Exception('merge_files() called with <infnames> consisting only of <outfname>')
-        cmd = 'cat ' + ' '.join(non_out_infnames) + ' | grep -v \'' + header + '\''
-        cmd += ' >>' + outfname
-        try:
-            check_call(cmd, shell=True)
-        except CalledProcessError:
-            print '    nothing to merge into %s' % outfname
-            # raise Exception('only read headers from %s', ' '.join([fn for fn in infnames if fn != outfname]))
 
-        if dereplicate:
-            tmpfname = outfname + '.tmp'
-            check_call('echo ' + header + ' >' + tmpfname, shell=True)
-            check_call('grep -v \'' + header + '\' ' + outfname + ' | sort | uniq >>' + tmpfname, shell=True)  # NOTE there can be multiple lines with the same uid string, but this is ok -- the c++ handles it
-            check_call(['mv', tmpfname, outfname])
+        with open(real_infnames[0]) as headfile:  # just need one of the infiles to get the header (and some may be zero length)
+            header = headfile.readline()
+        if not header.endswith('\n'):
+            header += '\n'
+
+        append_to_outfile = outfname in real_infnames and not dereplicate  # if we're not dereplicating, we can just tack the other files onto the end of the existing <outfname>
+        tmpfname = outfname if append_to_outfile else outfname + '.tmp'
+        seen_hashes = set()
+        with open(tmpfname, 'a' if append_to_outfile else 'w') as outfile:
+            if not append_to_outfile:
+                outfile.write(header)
+            for fname in real_infnames:
+                if append_to_outfile and fname == outfname:
+                    continue
+                with open(fname) as infile:
+                    for line in infile:
+                        if not line.endswith('\n'):
+                            line += '\n'
+                        if line == header:
+                            continue
+                        if dereplicate:  # NOTE there can be multiple lines with the same uid string, but this is ok -- the c++ handles it
+                            lhash = hashlib.md5(line).digest()
+                            if lhash in seen_hashes:
+                                continue
+                            seen_hashes.add(lhash)
+                        outfile.write(line)
+        if not append_to_outfile:
+            os.rename(tmpfname, outfname)
 
         for infname in infnames:
-            if infname != outfname:
+            if infname != outfname and os.path.exists(infname):
                 os.remove(infname)
 
     # ----------------------------------------------------------------------------------------
@@ -1697,7 +1870,7 @@ class PartitionDriver(object):
         cpath = None  # it would be nice to figure out a cleaner way to do this
         if self.current_action == 'partition':  # merge partitions from several files
             if n_procs > 1:
-                self.merge_subprocess_files(self.hmm_cachefname, n_procs, include_outfile=True)  # sub cache files only have new info
+                self.get_hmm_cache().append_files([self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname) for iproc in range(n_procs)])  # sub cache files only have new info, so we just append them to the main one
 
             if not precache_all_naive_seqs:
                 if n_procs == 1:
@@ -1738,18 +1911,20 @@ class PartitionDriver(object):
         if self.args.debug:
             print 'to %s' % parameter_dir + '/hmms',
 
-        if multiprocessing.cpu_count() * utils.memory_usage_fraction() > 0.8:  # already using a lot of memory, so don't to call multiprocessing, which will duplicate all the memory for each process
+        if multiprocessing.cpu_count() * utils.memory_usage_fraction() > 0.8:  # already using a lot of memory, so don't to call multiprocessing, which will duplicate all the memory for each process (the shared buffer below only has the germline info, so it doesn't help with e.g. sw info)
             for region in utils.regions:
                 for gene in self.glfo['seqs'][region]:
                     writer = HmmWriter(parameter_dir, hmm_dir, gene, self.glfo, self.args)
                     writer.write()
-        else:
+        else:  # put the germline info in a shared read-only buffer, so the forked children don't need to touch (and thus copy) our big dicts
+            shinfo = sharedinfo.SharedInfo(self.glfo)
             def write_single_hmm(gene):
-                writer = HmmWriter(parameter_dir, hmm_dir, gene, self.glfo, self.args)
+                writer = HmmWriter(parameter_dir, hmm_dir, gene, shinfo.glfo(), self.args)
                 writer.write()
-            procs = [multiprocessing.Process(target=write_single_hmm, args=(gene,))
-                     for region in utils.regions for gene in self.glfo['seqs'][region]]
-            utils.run_proc_functions(procs)  # uses all the cores (should only be for a little bit, though)
+            try:
+                sharedinfo.run_forked_fcns(write_single_hmm, [(gene,) for region in utils.regions for gene in shinfo.genes[region]])  # uses all the cores (should only be for a little bit, though)
+            finally:
+                shinfo.close()
 
         print '(%.1f sec)' % (time.time()-start)
         sys.stdout.flush()
@@ -1840,7 +2015,42 @@ class PartitionDriver(object):
                 })
 
     # ----------------------------------------------------------------------------------------
-    def write_to_single_input_file(self, fname, nsets, parameter_dir, shuffle_input=False):
+    def init_annotation_cachefo(self, parameter_dir):  # returns None if we're not caching annotations
+        if self.annotation_cache is None:
+            fname = self.args.annotation_cachefname
+            if fname is None and self.args.checkpoint_dir is not None:
+                fname = self.args.checkpoint_dir + '/annotation-cache.txt'
+            if fname is None:
+                return None
+            if not os.path.exists(os.path.dirname(os.path.abspath(fname))):
+                os.makedirs(os.path.dirname(os.path.abspath(fname)))
+            self.annotation_cache = KeyedJsonCache(fname)
+        extra_strs = [self.args.locus, str(self.args.seed), str(self.args.dont_rescale_emissions), utils.ambig_base]
+        return {'context' : KeyedJsonCache.context_hash(parameter_dir, self.glfo, extra_strs), 'keys' : {}, 'hits' : []}  # 'keys': cache key for each uid str that we're running, 'hits': cached bcrham output lines for clusters we aren't running
+
+    # ----------------------------------------------------------------------------------------
+    def update_annotation_cache(self, cachefo, outfname=None):  # add newly-calculated (and successful) lines in bcrham output to the annotation cache, then append the cached lines that we didn't rerun to the output file
+        if outfname is None:
+            outfname = self.hmm_outfname
+        with open(outfname) as outfile:
+            reader = csv.DictReader(outfile)
+            fieldnames = reader.fieldnames
+            new_lines = [(cachefo['keys'][line['unique_ids']], line) for line in reader if line['errors'] == '' and line['unique_ids'] in cachefo['keys']]
+        self.annotation_cache.add_lines(new_lines)
+        if len(cachefo['hits']) == 0:
+            return
+        print '    using %d cached annotation%s (ran bcrham on %d)' % (len(cachefo['hits']), utils.plural(len(cachefo['hits'])), len(cachefo['keys']))
+        if fieldnames is None:  # didn't run bcrham, so the file is empty
+            fieldnames = sorted(cachefo['hits'][0].keys())
+        with open(outfname, 'a' if os.stat(outfname).st_size > 0 else 'w') as outfile:
+            writer = csv.DictWriter(outfile, fieldnames)
+            if os.stat(outfname).st_size == 0:
+                writer.writeheader()
+            for line in cachefo['hits']:
+                writer.writerow(line)
+
+    # ----------------------------------------------------------------------------------------
+    def write_to_single_input_file(self, fname, nsets, parameter_dir, shuffle_input=False, cachefo=None):  # returns number of lines written (if <cachefo> is set, we skip any clusters that are in the annotation cache)
         csvfile = open(fname, 'w')
         header = ['names', 'k_v_min', 'k_v_max', 'k_d_min', 'k_d_max', 'mut_freq', 'cdr3_length', 'only_genes', 'seqs']
         writer = csv.DictWriter(csvfile, header, delimiter=' ')
@@ -1863,11 +2073,12 @@ class PartitionDriver(object):
             print '    skipping matches from %d genes without enough counts: %s' % (len(glfo_genes - genes_with_enough_counts), utils.color_genes(glfo_genes - genes_with_enough_counts))
         available_genes = genes_with_hmm_files & genes_with_enough_counts
 
+        n_lines_written = 0
         for query_name_list in nsets:  # NOTE in principle I think I should remove duplicate singleton <seed_unique_id>s here. But I think they in effect get removed 'cause in bcrham everything's stored as hash maps, so any duplicates just overwites the original upon reading its input
             combined_query = self.combine_queries(query_name_list, available_genes)
             if len(combined_query) == 0:  # didn't find all regions
                 continue
-            writer.writerow({
+            inline = {
                 'names' : ':'.join([qn for qn in query_name_list]),
                 'k_v_min' : combined_query['k_v']['min'],
                 'k_v_max' : combined_query['k_v']['max'],
@@ -1877,9 +2088,19 @@ class PartitionDriver(object):
                 'cdr3_length' : combined_query['cdr3_length'],
                 'only_genes' : ':'.join(combined_query['only_genes']),
                 'seqs' : ':'.join(combined_query['seqs'])
-            })
+            }
+            if cachefo is not None:
+                key = KeyedJsonCache.line_key(cachefo['context'], inline, header)
+                cached_line = self.annotation_cache.get_line(key)
+                if cached_line is not None:
+                    cachefo['hits'].append(cached_line)
+                    continue
+                cachefo['keys'][inline['names']] = key
+            writer.writerow(inline)
+            n_lines_written += 1
 
         csvfile.close()
+        return n_lines_written
 
     # ----------------------------------------------------------------------------------------
     # @utils.timeprinter
@@ -1899,9 +2120,12 @@ class PartitionDriver(object):
                 nsets = [qlist]
                 nsets = utils.split_clusters_by_cdr3(nsets, self.sw_info, warn=True)  # arg, have to split some clusters apart by cdr3, for rare cases where we call an shm indel in j within the cdr3
             elif self.args.n_simultaneous_seqs is not None:  # set number of simultaneous seqs
-                nlen = self.args.n_simultaneous_seqs  # shorthand
-                # nsets = [qlist[iq : min(iq + nlen, len(qlist))] for iq in range(0, len(qlist), nlen)]  # this way works fine, but it's hard to get right 'cause it's hard to understand 
-                nsets = [list(group) for _, group in itertools.groupby(qlist, key=lambda q: qlist.index(q) / nlen)]  # integer division
+                keyfunc, sizefunc = None, None
+                if self.args.group_simultaneous_seqs:  # put seqs with the same cdr3 length and v gene together, so each set (mostly) shares hmms
+                    keyfunc = lambda q: (self.sw_info[q]['cdr3_length'], self.sw_info[q]['v_gene'])
+                if self.args.max_simultaneous_seq_length is not None:  # limit the total sequence length in each set, so sets of long sequences have fewer of them
+                    sizefunc = lambda q: len(self.sw_info[q]['seqs'][0])
+                nsets = utils.get_batches(qlist, self.args.n_simultaneous_seqs, keyfunc=keyfunc, sizefunc=sizefunc, max_total_size=self.args.max_simultaneous_seq_length)
             else:  # plain ol' singletons
                 nsets = [[q] for q in qlist]
 
@@ -2290,7 +2514,7 @@ class PartitionDriver(object):
         partition_lines = None
         if cpath is not None:
             true_partition = utils.get_partition_from_reco_info(self.reco_info) if not self.args.is_data else None
-            partition_lines = cpath.get_partition_lines(self.args.is_data, reco_info=self.reco_info, true_partition=true_partition, n_to_write=self.args.n_partitions_to_write, calc_missing_values=('all' if (len(annotation_list) < 500) else 'best'))
+            partition_lines = cpath.get_partition_lines(self.args.is_data, reco_info=self.reco_info, true_partition=true_partition, n_to_write=self.args.n_partitions_to_write, calc_missing_values=('all' if (len(annotation_list) < 500) else 'best'), compact=self.args.compact_partition_output and utils.getsuffix(outfname) != '.csv')  # csv needs the full partitions
 
         if self.args.extra_annotation_columns is not None and 'linearham-info' in self.args.extra_annotation_columns:  # it would be nice to do this in utils.add_extra_column(), but it requires sw info, which would then have to be passed through all the output infrastructure
             utils.add_linearham_info(self.sw_info, annotation_list, self.args.min_selection_metric_cluster_size)
@@ -2304,7 +2528,7 @@ class PartitionDriver(object):
                 cpath.write(outfname, self.args.is_data, partition_lines=partition_lines)  # don't need to pass in reco_info/true_partition since we passed them when we got the partition lines
             annotation_fname = outfname if cpath is None else self.args.cluster_annotation_fname
             utils.write_annotations(annotation_fname, self.glfo, annotation_list, headers, failed_queries=failed_queries)
-        elif utils.getsuffix(outfname) == '.yaml':
+        elif utils.getsuffix(outfname) in ['.yaml', columnarfile.suffix]:
             utils.write_annotations(outfname, self.glfo, annotation_list, headers, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=self.args.write_full_yaml_output, dont_write_git_info=self.args.dont_write_git_info)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
@@ -5,6 +5,7 @@ import subprocess
 
 import utils
 import glutils
+import columnarfile
 
 def get_dummy_outfname(workdir, locus=None):
     return '%s/XXX-dummy-simu%s.yaml' % (workdir, '-'+locus if locus is not None else '')
@@ -183,6 +184,8 @@ def process(args):
             raise Exception('can\'t set --simultaneous-true-clonal-seqs when partitioning')
     if args.n_simultaneous_seqs is not None and args.all_seqs_simultaneous:
         raise Exception('doesn\'t make sense to set both --n-simultaneous-seqs and --all-seqs-simultaneous.')
+    if (args.group_simultaneous_seqs or args.max_simultaneous_seq_length is not None) and args.n_simultaneous_seqs is None:
+        raise Exception('--group-simultaneous-seqs and --max-simultaneous-seq-length only make sense if --n-simultaneous-seqs is set')
 
     if args.no_indels:
         print 'forcing --gap-open-penalty to %d to prevent indels, since --no-indels was specified (you can also adjust this penalty directly)' % args.no_indel_gap_open_penalty
@@ -211,17 +214,23 @@ def process(args):
     if os.path.exists(args.workdir):
         raise Exception('workdir %s already exists' % args.workdir)
 
+    if args.resume and args.checkpoint_dir is None:
+        raise Exception('--resume requires --checkpoint-dir')
+
+    if args.persistent_bcrham_workers and args.batch_system is not None:
+        raise Exception('--persistent-bcrham-workers can\'t be used with --batch-system (the workers run on the local machine)')
+
     if args.batch_system == 'sge' and args.batch_options is not None:
         if '-e' in args.batch_options or '-o' in args.batch_options:
             print '%s --batch-options contains \'-e\' or \'-o\', but we add these automatically since we need to be able to parse each job\'s stdout and stderr. You can control the directory under which they\'re written with --workdir (which is currently %s).' % (utils.color('red', 'warning'), args.workdir)
 
     if args.outfname is not None and not args.presto_output and not args.airr_output and not args.generate_trees:
-        if utils.getsuffix(args.outfname) not in ['.csv', '.yaml']:
+        if utils.getsuffix(args.outfname) not in ['.csv', '.yaml', columnarfile.suffix]:
             raise Exception('unhandled --outfname suffix %s' % utils.getsuffix(args.outfname))
-        if utils.getsuffix(args.outfname) != '.yaml':
+        if utils.getsuffix(args.outfname) == '.csv':
             print '  %s --outfname uses deprecated file format %s. This will still mostly work ok, but the new default .yaml format doesn\'t have to do all the string conversions by hand (so is less buggy), and includes annotations, partitions, and germline info in the same file (so you don\'t get crashes or inconsistent results if you don\'t keep track of what germline info goes with what output file).' % (utils.color('yellow', 'note:'), utils.getsuffix(args.outfname))
-        if args.action in ['view-annotations', 'view-partitions'] and utils.getsuffix(args.outfname) == '.yaml':
-            raise Exception('have to use \'view-output\' action to view .yaml output files')
+        if args.action in ['view-annotations', 'view-partitions'] and utils.getsuffix(args.outfname) != '.csv':
+            raise Exception('have to use \'view-output\' action to view %s output files' % utils.getsuffix(args.outfname))
 
     if args.presto_output:
         if args.outfname is None:
@@ -240,7 +249,7 @@ def process(args):
             raise Exception('have to set --outfname if --airr-output is set')
         if utils.getsuffix(args.outfname) == '.tsv':
             print '  note: writing only airr .tsv to %s' % args.outfname
-        elif utils.getsuffix(args.outfname) in ['.yaml', '.csv']:
+        elif utils.getsuffix(args.outfname) in ['.yaml', '.csv', columnarfile.suffix]:
             print '  note: writing both partis %s to %s and airr .tsv to %s' % (utils.getsuffix(args.outfname), args.outfname, utils.replace_suffix(args.outfname, '.tsv'))
         else:
             raise Exception('--outfname suffix has to be either .tsv or .yaml if --airr-output is set (got %s)' % utils.getsuffix(args.outfname))
@@ -755,7 +755,9 @@ class Recombinator(object):
         assert len(cmdfos) == 1  # used to be one cmd for each region
 
         start = time.time()
-        utils.run_cmds(cmdfos, sleep=False, clean_on_success=True)
+        proc_records = utils.run_cmds(cmdfos, sleep=False, clean_on_success=True, retry_fcn=utils.retry_killed_procs)
+        if self.args.debug:
+            print '    bppseqgen %s' % utils.proc_records_str(proc_records)
         self.validation_values['bpp-times'].append(time.time()-start)
 
         self.read_bppseqgen_output(cmdfos[0], reco_event)
@@ -161,12 +161,16 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
     # NOTE renamed this from get_seqfile_info() since I'm changing the return values, but I don't want to update the calls everywhere (e.g. in compareutils)
     yaml_glfo = None
     suffix = utils.getsuffix(infname)
+    if suffix in utils.compression_suffixes:  # gzip'd (or bgzip'd) or bzip2'd csv/tsv/fasta/fastq
+        suffix = utils.getsuffix(os.path.splitext(infname)[0])
+        if suffix == '.yaml':
+            raise Exception('compressed yaml input files not supported: %s' % infname)
     if suffix in delimit_info:
-        seqfile = open(infname)  # closes on function exit. no, this isn't the best way to do this
+        seqfile = utils.open_possibly_compressed(infname)  # closes on function exit. no, this isn't the best way to do this
         reader = csv.DictReader(seqfile, delimiter=delimit_info[suffix])
     elif suffix in ['.fa', '.fasta', '.fq', '.fastq', '.fastx']:
         add_info = args is not None and args.name_column is not None and 'fasta-info-index' in args.name_column
-        reader = utils.read_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=add_info, sanitize_uids=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below
+        reader = utils.iter_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=add_info, sanitize_uids=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below (also, it's a generator, so we only ever have the one <input_info> copy of everything in memory)
                                   queries=(args.queries if (args is not None and not args.abbreviate) else None))  # NOTE also can't filter on args.queries here if we're also translating
     elif suffix == '.yaml':
         yaml_glfo, reader, _ = utils.read_yaml_output(infname, n_max_queries=n_max_queries, synth_single_seqs=True, dont_add_implicit_info=True)  # not really sure that long term I want to synthesize single seq lines, but for backwards compatibility it's nice a.t.m.
@@ -246,7 +250,7 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
         if uid in input_info:
             raise Exception('found uid \'%s\' twice in input file %s' % (uid, infname))
 
-        if any(c not in utils.alphabet for c in inseq):  # NOTE should really be integrated with sanitize_seqs arg in utils.read_fastx()
+        if not utils.alphabet.issuperset(inseq):  # NOTE should really be integrated with sanitize_seqs arg in utils.iter_fastx()
             unexpected_chars = set([ch for ch in inseq if ch not in utils.alphabet])
             raise Exception('unexpected character%s %s (not among %s) in input sequence with id %s:\n  %s' % (utils.plural(len(unexpected_chars)), ', '.join([('\'%s\'' % ch) for ch in unexpected_chars]), utils.alphabet, uid, inseq))
 
@@ -0,0 +1,81 @@
+import gc
+import mmap
+import numpy
+import multiprocessing
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class SharedInfo(object):
+    """
+    Compact, read-only copy of germline info in a shared memory buffer, for use by forked worker processes.
+    Everything is packed into numpy arrays (codon positions, and seqs as one big byte string with offsets), all of which live in one anonymous shared mmap.
+    Forked children only make numpy views of this buffer, so unlike when they use the parent's dicts (where just touching an object changes its refcount, and thus copies its page) nothing gets copied.
+    Create it in the parent before forking, then in the child use glfo() (or run the children with run_forked_fcns(), which also turns off garbage collection in the child so it doesn't walk all of the parent's objects).
+    """
+    def __init__(self, glfo, locus=None):
+        self.locus = glfo['locus'] if locus is None else locus
+        arrays = {}  # name : array, for everything that goes in the buffer
+
+        self.genes = {r : sorted(glfo['seqs'][r]) for r in utils.regions}  # gene names are small, so we just keep them as normal lists (in the same order as the seqs and positions in the arrays)
+        for region in utils.regions:
+            self.add_strings(arrays, 'glseqs-' + region, [glfo['seqs'][region][g] for g in self.genes[region]])
+        self.codons = utils.conserved_codons[self.locus]
+        for region, codon in self.codons.items():
+            arrays['%s-positions' % codon] = numpy.array([glfo['%s-positions' % codon][g] for g in self.genes[region]], dtype=numpy.int32)
+
+        self.layout, total_size = {}, 0  # name : (offset, dtype, shape) for each array in the buffer
+        for name, array in sorted(arrays.items()):
+            self.layout[name] = (total_size, array.dtype, array.shape)
+            total_size += array.nbytes + (-array.nbytes % 8)  # keep everything 8-byte aligned
+        self.buf = mmap.mmap(-1, max(1, total_size))  # anonymous, so shared with any children forked after this
+        for name, array in arrays.items():
+            self.array(name)[...] = array
+        self.views = {}
+
+    # ----------------------------------------------------------------------------------------
+    def add_strings(self, arrays, name, strlist):  # store <strlist> as one byte array plus offsets
+        arrays[name + '-chars'] = numpy.frombuffer(''.join(str(s) for s in strlist), dtype=numpy.uint8) if len(strlist) > 0 else numpy.zeros(0, dtype=numpy.uint8)
+        arrays[name + '-offsets'] = numpy.cumsum([0] + [len(s) for s in strlist], dtype=numpy.int64)
+
+    # ----------------------------------------------------------------------------------------
+    def array(self, name):  # numpy view into the shared buffer (no copy)
+        offset, dtype, shape = self.layout[name]
+        return numpy.frombuffer(self.buf, dtype=dtype, count=int(numpy.prod(shape)), offset=offset).reshape(shape)
+
+    # ----------------------------------------------------------------------------------------
+    def view(self, name):  # cached version of array(), so we only make each view once per process
+        if name not in self.views:
+            self.views[name] = self.array(name)
+        return self.views[name]
+
+    # ----------------------------------------------------------------------------------------
+    def get_string(self, name, index):
+        offsets = self.view(name + '-offsets')
+        return self.view(name + '-chars')[offsets[index] : offsets[index + 1]].tostring()
+
+    # ----------------------------------------------------------------------------------------
+    def glfo(self):  # new glfo-style dict with germline seqs and codon positions (not all the keys in a normal glfo, but enough for e.g. HmmWriter)
+        glfo = {'locus' : self.locus, 'seqs' : {r : {g : self.get_string('glseqs-' + r, i) for i, g in enumerate(self.genes[r])} for r in utils.regions}}
+        for region, codon in self.codons.items():
+            glfo['%s-positions' % codon] = {g : int(p) for g, p in zip(self.genes[region], self.view('%s-positions' % codon))}
+        return glfo
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        self.views = {}
+        self.buf.close()
+
+# ----------------------------------------------------------------------------------------
+def run_detached(fcn, args):  # target for forked children: turn off garbage collection first, since a full collection would touch (and thus copy) every one of the parent's objects
+    gc.disable()
+    fcn(*args)
+
+# ----------------------------------------------------------------------------------------
+def run_forked_fcns(fcn, arglists, n_procs=None):  # run fcn(*args) in a forked child process for each <args> in <arglists> (at most <n_procs> at a time)
+    procs = [multiprocessing.Process(target=run_detached, args=(fcn, args)) for args in arglists]
+    all_procs = list(procs)  # run_proc_functions() pops them off <procs> as it starts them
+    utils.run_proc_functions(procs, n_procs=n_procs)
+    failed_procs = [p for p in all_procs if p.exitcode != 0]
+    if len(failed_procs) > 0:
+        raise Exception('%d / %d forked procs failed (exit codes: %s)' % (len(failed_procs), len(all_procs), ' '.join(str(p.exitcode) for p in failed_procs)))
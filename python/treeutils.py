@@ -7,7 +7,6 @@ import collections
 import random
 import csv
 from cStringIO import StringIO
-import subprocess
 import tempfile
 import os
 import numpy
@@ -20,6 +19,8 @@ import json
 import pickle
 import warnings
 import traceback
+import multiprocessing
+import hashlib
 if StrictVersion(dendropy.__version__) < StrictVersion('4.0.0'):  # not sure on the exact version I need, but 3.12.0 is missing lots of vital tree fcns
     raise RuntimeError("dendropy version 4.0.0 or later is required (found version %s)." % dendropy.__version__)
 try:
@@ -28,6 +29,7 @@ except ImportError:
     from yaml import Loader, Dumper
 
 import utils
+from keyedjsoncache import KeyedJsonCache
 
 lb_metrics = collections.OrderedDict(('lb' + let, 'lb ' + lab) for let, lab in (('i', 'index'), ('r', 'ratio')))
 typical_bcr_seq_len = 400
@@ -35,8 +37,6 @@ default_lb_tau = 0.0025
 default_lbr_tau_factor = 20
 default_min_selection_metric_cluster_size = 10
 
-dummy_str = 'x-dummy-x'
-
 # ----------------------------------------------------------------------------------------
 def add_cons_seqs(line, aa=False):
     ckey = 'consensus_seq'
@@ -292,7 +292,7 @@ def get_dendro_tree(treestr=None, treefname=None, taxon_namespace=None, schema='
         if taxon_namespace is not None:
             print '     and taxon namespace:  %s' % ' '.join([t.label for t in taxon_namespace])
     # dendropy doesn't make taxons for internal nodes by default, so it puts the label for internal nodes in node.label instead of node.taxon.label, but it crashes if it gets duplicate labels, so you can't just always turn off internal node taxon suppression
-    dtree = dendropy.Tree.get_from_string(treestr, schema, taxon_namespace=taxon_namespace, suppress_internal_node_taxa=(ignore_existing_internal_node_labels or suppress_internal_node_taxa), preserve_underscores=True, rooting='force-rooted')  # make sure the tree is rooted, to avoid nodes disappearing in remove_dummy_branches() (and proably other places as well)
+    dtree = dendropy.Tree.get_from_string(treestr, schema, taxon_namespace=taxon_namespace, suppress_internal_node_taxa=(ignore_existing_internal_node_labels or suppress_internal_node_taxa), preserve_underscores=True, rooting='force-rooted')  # make sure the tree is rooted, to avoid nodes disappearing when rerooting (and proably other places as well)
     if dtree.seed_node.edge_length > 0:
         # this would be easy to fix, but i think it only happens from simulation trees from treegenerator
         print '  %s seed/root node has non-zero edge length (i.e. there\'s a branch above it)' % utils.color('red', 'warning')
@@ -656,21 +656,90 @@ def collapse_zero_length_leaves(dtree, sequence_uids, debug=False):  # <sequence
         # print get_ascii_tree(dendro_tree=dtree, extra_str='      ', width=350)
         # print dtree.as_string(schema='newick').strip()
 
+# ----------------------------------------------------------------------------------------
+fasttree_cmd = os.path.dirname(os.path.realpath(__file__)).replace('/python', '') + '/bin/FastTree -gtr -nt'
+fasttree_cache = {'newicks' : {}, 'file' : None, 'owner-pid' : None, 'unwritten' : []}  # FastTree newick strings keyed by fasttree_key(), both in memory and (if set_fasttree_cachefname() has been called) in a persistent file
+# NOTE only the process that called set_fasttree_cachefname() writes to the file, since forked children would all append to it starting from the same offset (new trees in children instead go in 'unwritten', and the parent adds them with add_fasttree_newicks())
+
+# ----------------------------------------------------------------------------------------
+def set_fasttree_cachefname(fname):
+    if fname is None:
+        fasttree_cache['file'] = None
+        return
+    if not os.path.exists(os.path.dirname(os.path.abspath(fname))):
+        os.makedirs(os.path.dirname(os.path.abspath(fname)))
+    fasttree_cache['file'] = KeyedJsonCache(fname)
+    fasttree_cache['owner-pid'] = os.getpid()
+
+# ----------------------------------------------------------------------------------------
+def add_fasttree_newicks(keyed_newicks):  # add (key, newick) pairs to the cache (writing them to the file if we're the process that owns it)
+    for key, treestr in keyed_newicks:
+        fasttree_cache['newicks'][key] = treestr
+    if fasttree_cache['file'] is None:
+        return
+    if os.getpid() == fasttree_cache['owner-pid']:
+        fasttree_cache['file'].add_lines(keyed_newicks)
+    else:
+        fasttree_cache['unwritten'] += keyed_newicks
+
+# ----------------------------------------------------------------------------------------
+def fasttree_key(seqfos, naive_seq, naive_seq_name):  # FastTree's output depends a bit on the order of the input seqs, but we don't care about that, so the key is for the set of seqs
+    md5 = hashlib.md5()
+    md5.update('%s\n%s %s\n' % (fasttree_cmd.split('/')[-1], naive_seq_name, naive_seq))
+    for name, seq in sorted((sfo['name'], sfo['seq']) for sfo in seqfos):
+        md5.update('%s %s\n' % (name, seq))
+    return md5.hexdigest()
+
+# ----------------------------------------------------------------------------------------
+def get_fasttree_newicks(seqfo_lists, naive_seqs, naive_seq_name='XnaiveX', n_procs=1, debug=False):  # return list of FastTree newick strings, one for each list of seqfos in <seqfo_lists> (with corresponding naive seq from <naive_seqs>, which can be None), running up to <n_procs> FastTree procs at once for any that aren't in the cache
+    keys = [fasttree_key(sfos, nseq, naive_seq_name) for sfos, nseq in zip(seqfo_lists, naive_seqs)]
+    if fasttree_cache['file'] is not None:
+        for key in [k for k in keys if k not in fasttree_cache['newicks']]:
+            treestr = fasttree_cache['file'].get_line(key)
+            if treestr is not None:
+                fasttree_cache['newicks'][key] = treestr
+    to_run, keys_to_run = [], set()  # indices in <seqfo_lists> that we need to run (only the first one, if there's duplicate keys)
+    for ifo, key in enumerate(keys):
+        if key not in fasttree_cache['newicks'] and key not in keys_to_run:
+            to_run.append(ifo)
+            keys_to_run.add(key)
+    if debug or len(seqfo_lists) > 1:
+        print '      running FastTree on %d / %d cluster%s (%d cached)' % (len(to_run), len(seqfo_lists), utils.plural(len(seqfo_lists)), len(seqfo_lists) - len(to_run))
+    if len(to_run) > 0:
+        workdir = tempfile.mkdtemp()
+        cmdfos = []
+        for ifo in to_run:
+            uid_list = [sfo['name'] for sfo in seqfo_lists[ifo]]
+            if len(set(uid_list)) < len(uid_list):
+                raise Exception('duplicate uid(s) in seqfos for FastTree, which\'ll make it crash: %s' % ' '.join(u for u in set(uid_list) if uid_list.count(u) > 1))
+            subworkdir = '%s/fasttree-%d' % (workdir, ifo)
+            os.makedirs(subworkdir)
+            infname, outfname = subworkdir + '/input.fa', subworkdir + '/tree.nwk'
+            with open(infname, 'w') as infile:
+                if naive_seqs[ifo] is not None:
+                    infile.write('>%s\n%s\n' % (naive_seq_name, naive_seqs[ifo]))
+                for sfo in seqfo_lists[ifo]:
+                    infile.write('>%s\n%s\n' % (sfo['name'], sfo['seq']))
+            cmdfos.append({'cmd_str' : '%s -out %s %s' % (fasttree_cmd, outfname, infname), 'workdir' : subworkdir, 'outfname' : outfname, 'workfnames' : [infname, outfname]})
+        utils.run_cmds(cmdfos, n_max_procs=n_procs, ignore_stderr=True)
+        new_lines = []
+        for ifo, cmdfo in zip(to_run, cmdfos):
+            with open(cmdfo['outfname']) as outfile:
+                treestr = outfile.read()
+            new_lines.append((keys[ifo], treestr))
+            for fname in cmdfo['workfnames']:
+                os.remove(fname)
+            os.rmdir(cmdfo['workdir'])
+        os.rmdir(workdir)
+        add_fasttree_newicks(new_lines)
+    return [fasttree_cache['newicks'][k] for k in keys]
+
 # ----------------------------------------------------------------------------------------
 def get_fasttree_tree(seqfos, naive_seq=None, naive_seq_name='XnaiveX', taxon_namespace=None, suppress_internal_node_taxa=False, debug=False):
     if debug:
         print '    running FastTree on %d sequences plus a naive' % len(seqfos)
     uid_list = [sfo['name'] for sfo in seqfos]
-    if any(uid_list.count(u) > 1 for u in uid_list):
-        raise Exception('duplicate uid(s) in seqfos for FastTree, which\'ll make it crash: %s' % ' '.join(u for u in uid_list if uid_list.count(u) > 1))
-    with tempfile.NamedTemporaryFile() as tmpfile:
-        if naive_seq is not None:
-            tmpfile.write('>%s\n%s\n' % (naive_seq_name, naive_seq))
-        for sfo in seqfos:
-            tmpfile.write('>%s\n%s\n' % (sfo['name'], sfo['seq']))  # NOTE the order of the leaves/names is checked when reading bppseqgen output
-        tmpfile.flush()  # BEWARE if you forget this you are fucked
-        with open(os.devnull, 'w') as fnull:
-            treestr = subprocess.check_output('./bin/FastTree -gtr -nt ' + tmpfile.name, shell=True, stderr=fnull)
+    treestr = get_fasttree_newicks([seqfos], [naive_seq], naive_seq_name=naive_seq_name)[0]  # probably already in the cache if we're calculating tree metrics
     if debug:
         print '      converting FastTree newick string to dendro tree'
     dtree = get_dendro_tree(treestr=treestr, taxon_namespace=taxon_namespace, ignore_existing_internal_node_labels=not suppress_internal_node_taxa, suppress_internal_node_taxa=suppress_internal_node_taxa, debug=debug)
@@ -684,172 +753,123 @@ def get_fasttree_tree(seqfos, naive_seq=None, naive_seq_name='XnaiveX', taxon_na
     return dtree
 
 # ----------------------------------------------------------------------------------------
-# copied from https://github.com/nextstrain/augur/blob/master/base/scores.py
-# also see explanation here https://photos.app.goo.gl/gtjQziD8BLATQivR6
-def set_lb_values(dtree, tau, only_calc_metric=None, dont_normalize=False, multifo=None, debug=False):
+class ArrayTree(object):
     """
-    traverses <dtree> in postorder and preorder to calculate the up and downstream tree length exponentially weighted by distance, then adds them as LBI (and divides as LBR)
+    Compact array version of a dendropy tree, for fast calculations that need every node (e.g. lb values on very large trees).
+    Nodes are numbered in breadth-first order starting from the root, so each node's children are a contiguous range of indices [child_ptr[i], child_ptr[i+1]) (i.e. compressed sparse row child lists without needing a separate index array), and each level (number of edges from root) is a contiguous range [level_starts[d], level_starts[d+1]).
     """
-    def getmulti(node):  # number of reads with the same sequence
-        if multifo is None or node.taxon.label not in multifo or multifo[node.taxon.label] is None:  # most all of them should be in there, but for instance I'm not adding the dummy branch nodes
-            return 1
-        return multifo[node.taxon.label]
+    def __init__(self, dtree):
+        nodes = [dtree.seed_node]
+        parents, lengths, child_ptr, depths = [-1], [0.], [], [0]
+        inode = 0
+        while inode < len(nodes):
+            child_ptr.append(len(nodes))
+            for child in nodes[inode].child_node_iter():
+                nodes.append(child)
+                parents.append(inode)
+                lengths.append(0. if child.edge.length is None else child.edge.length)  # same as distance_from_root() difference
+                depths.append(depths[inode] + 1)
+            inode += 1
+        child_ptr.append(len(nodes))
+        self.labels = [n.taxon.label for n in nodes]
+        self.parents = numpy.array(parents, dtype=int)
+        self.lengths = numpy.array(lengths, dtype=float)
+        self.child_ptr = numpy.array(child_ptr, dtype=int)
+        self.level_starts = numpy.searchsorted(numpy.array(depths), numpy.arange(depths[-1] + 2))  # depths are sorted since we're breadth-first
 
-    metrics_to_calc = lb_metrics.keys() if only_calc_metric is None else [only_calc_metric]
-    if debug:
-        print '    setting %s values with tau %.4f' % (' and '.join(metrics_to_calc), tau)
+    # ----------------------------------------------------------------------------------------
+    def n_nodes(self):
+        return len(self.labels)
 
-    initial_labels = set([n.taxon.label for n in dtree.preorder_node_iter()])
-    dtree = get_tree_with_dummy_branches(dtree, tau)  # this returns a new dtree, but the old tree is a subtree of the new one (or at least its collection of nodes are), and these nodes get modified by the process (hence the reversal fcn below)
+    # ----------------------------------------------------------------------------------------
+    def n_levels(self):
+        return len(self.level_starts) - 1
 
-    # calculate clock length (i.e. for each node, the distance to that node's parent)
-    for node in dtree.postorder_node_iter():  # postorder vs preorder doesn't matter, but I have to choose one
-        if node.parent_node is None:  # root node
-            node.clock_length = 0.
-        for child in node.child_node_iter():
-            child.clock_length = child.distance_from_root() - node.distance_from_root()
+    # ----------------------------------------------------------------------------------------
+    def level(self, depth):  # slice of node indices at <depth>
+        return slice(self.level_starts[depth], self.level_starts[depth + 1])
 
-    # lbi is the sum of <node.down_polarizer> (downward message from <node>'s parent) and its children's up_polarizers (upward messages)
+# ----------------------------------------------------------------------------------------
+# adapted from https://github.com/nextstrain/augur/blob/master/base/scores.py
+# also see explanation here https://photos.app.goo.gl/gtjQziD8BLATQivR6
+def calculate_lb_arrays(atree, taus, multis, n_tau_lengths=10):
+    """
+    Pass messages up and down <atree> (an ArrayTree) to calculate the up and downstream tree length exponentially weighted by distance, for each of <taus> at once (<multis> is an array with the multiplicity of each node).
+    Returns dict with arrays of shape (len(taus), n nodes) for lbi, lbr, and the down polarizer (lbr denominator).
+    Instead of adding a dummy branch of length <n_tau_lengths> * tau above the root (so that the root isn't treated as having zero fitness), we set the root's down polarizer to what it would get from that branch.
+    """
+    taus = numpy.array(taus, dtype=float).reshape(-1, 1)
+    decays = numpy.exp(-atree.lengths / taus)  # exponential decay over the branch between each node and its parent, shape (n taus, n nodes)
+    contribs = multis * taus * (1 - decays)  # contribution of each node to its parent's lbi: zero if the two are very close, increasing toward asymptote of <tau> for distances near 1/tau (integral from 0 to l of decaying exponential)
+    up_polarizers = numpy.zeros(decays.shape)  # message from each node to its parent (used for its parent's lbi, but not its own)
+    child_sums = numpy.zeros(decays.shape)  # sum of each node's children's up polarizers
+    down_polarizers = numpy.zeros(decays.shape)  # message from each node's parent (used for its own lbi)
+
+    # traverse the tree one level at a time from the leaves (children first) to calculate message to parents
+    for depth in reversed(range(atree.n_levels())):
+        lslice = atree.level(depth)
+        up_polarizers[:, lslice] = decays[:, lslice] * child_sums[:, lslice] + contribs[:, lslice]  # sum of child up polarizers weighted by an exponential decayed by the distance to the node's parent, plus the node's own contribution
+        if depth == 0:
+            break
+        parent_slice = atree.level(depth - 1)
+        inodes = numpy.arange(parent_slice.start, parent_slice.stop)
+        inodes = inodes[atree.child_ptr[inodes] < atree.child_ptr[inodes + 1]]  # parents with children (reduceat() doesn't handle empty ranges)
+        child_sums[:, inodes] = numpy.add.reduceat(up_polarizers[:, lslice], atree.child_ptr[inodes] - lslice.start, axis=1)
+
+    # then from the root down (parents first) to calculate message to children: parent's down polarizer plus its other children's up polarizers, decayed by the distance to the parent, plus the child's own contribution
+    down_polarizers[:, 0] = multis[0] * taus[:, 0] * (1 - numpy.exp(-n_tau_lengths))
+    for depth in range(1, atree.n_levels()):
+        lslice = atree.level(depth)
+        iparents = atree.parents[lslice]
+        down_polarizers[:, lslice] = decays[:, lslice] * (down_polarizers[:, iparents] + child_sums[:, iparents] - up_polarizers[:, lslice]) + contribs[:, lslice]
+
+    lbis = down_polarizers + child_sums
+    lbrs = numpy.where(down_polarizers > 0., child_sums / numpy.where(down_polarizers > 0., down_polarizers, 1.), child_sums)  # it might make more sense to not include the branch between the node and its parent in either the numerator or denominator (here it's included in the denominator), but this way I don't have to change any of the calculations above
+    lbrs[:, 0] = 0.  # root
+    return {'lbi' : lbis, 'lbr' : lbrs, 'down' : down_polarizers}
 
-    # traverse the tree in postorder (children first) to calculate message to parents (i.e. node.up_polarizer)
-    for node in dtree.postorder_node_iter():
-        node.down_polarizer = 0  # used for <node>'s lbi (this probabably shouldn't be initialized here, since it gets reset in the next loop [at least I think they all do])
-        node.up_polarizer = 0  # used for <node>'s parent's lbi (but not <node>'s lbi)
-        for child in node.child_node_iter():
-            node.up_polarizer += child.up_polarizer
-        bl = node.clock_length / tau
-        node.up_polarizer *= numpy.exp(-bl)  # sum of child <up_polarizer>s weighted by an exponential decayed by the distance to <node>'s parent
-        node.up_polarizer += getmulti(node) * tau * (1 - numpy.exp(-bl))  # add the actual contribution (to <node>'s parent's lbi) of <node>: zero if the two are very close, increasing toward asymptote of <tau> for distances near 1/tau (integral from 0 to l of decaying exponential)
-
-    # traverse the tree in preorder (parents first) to calculate message to children (i.e. child1.down_polarizer)
-    for node in dtree.preorder_internal_node_iter():
-        for child1 in node.child_node_iter():  # calculate down_polarizer for each of <node>'s children
-            child1.down_polarizer = node.down_polarizer  # first sum <node>'s down_polarizer...
-            for child2 in node.child_node_iter():  # and the *up* polarizers of any other children of <node>
-                if child1 != child2:
-                    child1.down_polarizer += child2.up_polarizer  # add the contribution of <child2> to its parent's (<node>'s) lbi (i.e. <child2>'s contribution to the lbi of its *siblings*)
-            bl = child1.clock_length / tau
-            child1.down_polarizer *= numpy.exp(-bl)  # and decay the previous sum by distance between <child1> and its parent (<node>)
-            child1.down_polarizer += getmulti(child1) * tau * (1 - numpy.exp(-bl))  # add contribution of <child1> to its own lbi: zero if it's very close to <node>, increasing to max of <tau> (integral from 0 to l of decaying exponential)
+# ----------------------------------------------------------------------------------------
+def set_lb_values(dtree, taufo, dont_normalize=False, multifo=None, atree=None, debug=False):
+    """
+    calculate lb metrics for each node in <dtree> (without modifying it), where <taufo> is a dict with the tau value for each metric that we want (e.g. {'lbi' : 0.0025, 'lbr' : 0.05}). All metrics are calculated in one pass over the tree.
+    """
+    if atree is None:
+        atree = ArrayTree(dtree)
+    metrics_to_calc = [m for m in lb_metrics if m in taufo]
+    taus = sorted(set(taufo.values()))
+    if debug:
+        print '    setting %s values with tau%s %s' % (' and '.join(metrics_to_calc), utils.plural(len(taus)), ' '.join('%.4f' % t for t in taus))
+
+    multis = numpy.ones(atree.n_nodes())
+    if multifo is not None:
+        for inode, label in enumerate(atree.labels):
+            if multifo.get(label) is not None:
+                multis[inode] = multifo[label]
+    lbarrays = calculate_lb_arrays(atree, taus, multis)
 
     returnfo = {m : {} for m in metrics_to_calc}
-    # go over all nodes and calculate lb metrics (can be done in any order)
-    for node in dtree.postorder_node_iter():
-        vals = {'lbi' : node.down_polarizer, 'lbr' : 0.}
-        for child in node.child_node_iter():
-            vals['lbi'] += child.up_polarizer
-            vals['lbr'] += child.up_polarizer
-        if node.down_polarizer > 0.:
-            vals['lbr'] /= node.down_polarizer  # it might make more sense to not include the branch between <node> and its parent in either the numerator or denominator (here it's included in the denominator), but this way I don't have to change any of the calculations above
-
-        if dummy_str in node.taxon.label:
-            continue
-        if node is dtree.seed_node or node.parent_node is dtree.seed_node:  # second clause is only because of dummy root addition (well, and if we are adding dummy root the first clause doesn't do anything)
-            vals['lbr'] = 0.
-        for metric in metrics_to_calc:
-            returnfo[metric][node.taxon.label] = float(vals[metric]) if dont_normalize else normalize_lb_val(metric, float(vals[metric]), tau)
+    for metric in metrics_to_calc:
+        itau = taus.index(taufo[metric])
+        for label, val in zip(atree.labels, lbarrays[metric][itau].tolist()):
+            returnfo[metric][label] = val if dont_normalize else normalize_lb_val(metric, val, taufo[metric])
 
     if debug:
-        max_width = str(max([len(n.taxon.label) for n in dtree.postorder_node_iter()]))
+        max_width = str(max([len(l) for l in atree.labels]))
         print ('   %'+max_width+'s %s%s      multi') % ('node', ''.join('     %s' % m for m in metrics_to_calc), 16*' ' if 'lbr' in metrics_to_calc else '')
-        for node in dtree.preorder_node_iter():
-            if dummy_str in node.taxon.label:
-                continue
+        for inode, label in enumerate(atree.labels):
             multi_str = ''
             if multifo is not None:
-                multi_str = str(getmulti(node))
-                if getmulti(node) > 1:
+                multi_str = str(int(multis[inode]))
+                if multis[inode] > 1:
                     multi_str = utils.color('blue', multi_str, width=3)
-            lbstrs = ['%8.3f' % returnfo[m][node.taxon.label] for m in metrics_to_calc]
+            lbstrs = ['%8.3f' % returnfo[m][label] for m in metrics_to_calc]
             if 'lbr' in metrics_to_calc:
-                lbstrs += [' = %-5.3f / %-5.3f' % (returnfo['lbr'][node.taxon.label] * node.down_polarizer, node.down_polarizer)]
-            print ('    %' + max_width + 's  %s    %3s') % (node.taxon.label, ''.join(lbstrs), multi_str)
-
-    # this is maybe time consuming, but I want to leave the tree that was passed in as unmodified as I can (especially since I have to run this fcn twice for lbi/lbr since they need different tau values)
-    for node in dtree.postorder_node_iter():
-        delattr(node, 'clock_length')
-        delattr(node, 'up_polarizer')
-        delattr(node, 'down_polarizer')
-
-    remove_dummy_branches(dtree, initial_labels)
+                down_pol = lbarrays['down'][taus.index(taufo['lbr'])][inode]
+                lbstrs += [' = %-5.3f / %-5.3f' % (returnfo['lbr'][label] * down_pol, down_pol)]
+            print ('    %' + max_width + 's  %s    %3s') % (label, ''.join(lbstrs), multi_str)
 
     return returnfo
 
-# ----------------------------------------------------------------------------------------
-def get_tree_with_dummy_branches(old_dtree, tau, n_tau_lengths=10, add_dummy_leaves=False, debug=False): # add long branches above root and/or below each leaf, since otherwise we're assuming that (e.g.) leaf node fitness is zero
-    # commenting this since I'm pretty sure I've fixed it, but not removing it since if a similar problem surfaces with dummy branch addition, deep copying is an easy way out
-    # zero_length_edges = [e for e in old_dtree.preorder_edge_iter() if e.length == 0 and not e.head_node.is_leaf()]
-    # if len(zero_length_edges) > 0:  # rerooting to remove dummy branches screws up the tree in some cases with zero length branches (see comment in that fcn)
-    #     old_dtree = copy.deepcopy(old_dtree)  # could maybe do this by default, but it'll probably be really slow on large trees (at least iterating through the trees is; although I suppose maybe deepcopy is smater than that)
-    #     print '    %s found %d zero length branches in tree, so deep copying before adding dummy branches (this is probably ok ish, but in general it\'s a bad idea to have zero length branches in your trees): %s' % (utils.color('yellow', 'warning'), len(zero_length_edges), ' '.join([e.head_node.taxon.label for e in zero_length_edges]))
-
-    dummy_edge_length = n_tau_lengths * tau
-
-    new_root_taxon = dendropy.Taxon(dummy_str + '-root')
-    old_dtree.taxon_namespace.add_taxon(new_root_taxon)
-    new_root_node = dendropy.Node(taxon=new_root_taxon)
-    new_dtree = dendropy.Tree(seed_node=new_root_node, taxon_namespace=old_dtree.taxon_namespace, is_rooted=True)
-
-    # then add the entire old tree under this new tree
-    new_root_node.add_child(old_dtree.seed_node)
-    for edge in new_root_node.child_edge_iter():
-        edge.length = dummy_edge_length
-
-    if add_dummy_leaves:  # add dummy child branches to each leaf
-        for lnode in new_dtree.leaf_node_iter():
-            new_label = '%s-%s' % (dummy_str, lnode.taxon.label)
-            tns.add_taxon(dendropy.Taxon(new_label))
-            new_child_node = lnode.new_child(taxon=tns.get_taxon(new_label), edge_length=dummy_edge_length)
-
-    # TODO commenting this because it gets triggered way too much, but I'm not actually sure that I can really just ignore the problem (but maybe I can)
-    # zero_len_edge_nodes = [e.head_node for n in new_dtree.preorder_node_iter() for e in n.child_edge_iter() if e.length == 0 and not e.head_node.is_leaf()]  # zero len edges above leaves are fine, since leaves don't count for lbr
-    # if len(zero_len_edge_nodes) > 0:
-    #     print '    %s found %d zero length internal edges in tree, which means lb ratio may mis-categorize branches: %s' % (utils.color('red', 'warning'), len(zero_len_edge_nodes), ' '.join([n.taxon.label for n in zero_len_edge_nodes]))
-    #     # for node in zero_len_edge_nodes:  # we don't really want to modify the tree this drastically here (and a.t.m. this causes a crash later on), but I'm leaving it as a placeholder for how to remove zero length edges
-    #     #     collapse_nodes(new_dtree, node.taxon.label, node.parent_node.taxon.label)  # keep the child, since it can be a leaf
-    #     # print utils.pad_lines(get_ascii_tree(dendro_tree=new_dtree))
-
-    new_dtree.update_bipartitions(suppress_unifurcations=False)  # not sure if I need this? (suppress_unifurcations is because otherwise it removes the branch between the old and new root nodes)
-
-    if debug:
-        print '    added dummy branches to tree:'
-        print get_ascii_tree(dendro_tree=new_dtree, extra_str='      ', width=350)
-
-    return new_dtree
-
-# ----------------------------------------------------------------------------------------
-def remove_dummy_branches(dtree, initial_labels, add_dummy_leaves=False, debug=False):
-    if add_dummy_leaves:
-        raise Exception('not implemented (shouldn\'t be too hard, but a.t.m. I don\'t think I\'ll need it)')
-
-    if len(dtree.seed_node.child_nodes()) != 1:
-        print '  %s root node has more than one child when removing dummy branches: %s' % (utils.color('yellow', 'warning'), ' '.join([n.taxon.label for n in dtree.seed_node.child_nodes()]))
-    new_root_node = dtree.seed_node.child_nodes()[0]
-    if debug:
-        print '  rerooting at %s' % new_root_node.taxon.label
-        print '            current children: %s' % ' '.join([n.taxon.label for n in new_root_node.child_node_iter()])
-    # NOTE if the new root has a child separated by a zero-length edge, this reroot call for some reason deletes that child from the tree (both with and without suppress_unifurcations set). After messing around a bunch to try to fix it, the message I'm taking is just that zero length branches (and unifurcations) are a bad idea and I should just forbid them
-    # UPDATE I think I was just missing the suppress_unifurcations=False in update_bipartitions(), but leaving these comments here in case there was another problem
-    # UPDATE actually the reroot still seems to eat a node sometimes if the tree is unrooted (so adding the extra reroot above)
-    # UPDATE this is more or less expectd, from dendropy's perspective; see https://github.com/jeetsukumaran/DendroPy/issues/118
-    assert dtree.is_rooted  # make sure it's rooted, to avoid unifurcations getting suppressed (even with the arg set to false)
-    dtree.reroot_at_node(new_root_node, suppress_unifurcations=False)  # reroot at old root node
-    if debug:
-        print '       children after reroot: %s' % ' '.join([n.taxon.label for n in new_root_node.child_node_iter()])
-    dtree.prune_taxa_with_labels([dummy_str + '-root'], suppress_unifurcations=False)
-    dtree.purge_taxon_namespace()  # I'm sure there's a good reason the previous line doesn't do this
-    dtree.update_bipartitions(suppress_unifurcations=False)
-    if debug:
-        print '        children after purge: %s' % ' '.join([n.taxon.label for n in new_root_node.child_node_iter()])
-
-    final_labels = set([n.taxon.label for n in dtree.preorder_node_iter()])
-    if initial_labels != final_labels:  # this was only happening with a zero-length node hanging off root (see above), which probably won't happen any more since I'm now removing zero length (non-leaf) branches in bcr-phylo simulator.py
-        print '    %s nodes after dummy branch addition and removal not the same as before:' % utils.color('red', 'error')
-        print '       missing: %s' % ' '.join(initial_labels - final_labels)
-        print '       extra:   %s' % ' '.join(final_labels - initial_labels)
-        print '       tree:'
-        print utils.pad_lines(get_ascii_tree(dendro_tree=dtree, width=400))
-
 # ----------------------------------------------------------------------------------------
 def get_aa_tree(dtree, annotation, extra_str=None, debug=False):
     very_different_frac = 0.5
@@ -956,7 +976,6 @@ def compare_tree_distance_to_shm(dtree, annotation, max_frac_diff=0.5, min_warn_
 def calculate_lb_values(dtree, tau, lbr_tau_factor=None, only_calc_metric=None, dont_normalize=False, annotation=None, extra_str=None, iclust=None, debug=False):
     # if <only_calc_metric> is None, we use <tau> and <lbr_tau_factor> to calculate both lbi and lbr (i.e. with different tau)
     #   - whereas if <only_calc_metric> is set, we use <tau> to calculate only the given metric
-    # note that it's a little weird to do all this tree manipulation here, but then do the dummy branch tree manipulation in set_lb_values(), but the dummy branch stuff depends on tau so it's better this way
     # <iclust> is just to give a little more granularity in dbg
 
     # TODO this is too slow (although it would be easy to have an option for it to only spot check a random subset of nodes)
@@ -979,21 +998,19 @@ def calculate_lb_values(dtree, tau, lbr_tau_factor=None, only_calc_metric=None,
         for node in dtree.postorder_node_iter():
             multifo[node.taxon.label] = utils.get_multiplicity(annotation, uid=node.taxon.label) if node.taxon.label in annotation['unique_ids'] else 1  # if it's not in there, it could be from wonky names from lonr.r, also could be from FastTree tree where we don't get inferred intermediate sequences
 
-    treestr = dtree.as_string(schema='newick')  # get this before the dummy branch stuff to make more sure it isn't modified
+    treestr = dtree.as_string(schema='newick')
     normstr = 'unnormalized' if dont_normalize else 'normalized'
 
     if only_calc_metric is None:
         assert lbr_tau_factor is not None  # has to be set if we're calculating both metrics
         if iclust is None or iclust == 0:
             print '    %scalculating %s lb metrics with tau values %.4f (lbi) and %.4f * %d = %.4f (lbr)' % ('' if extra_str is None else '%s: '%extra_str, normstr, tau, tau, lbr_tau_factor, tau*lbr_tau_factor)
-        lbvals = set_lb_values(dtree, tau, only_calc_metric='lbi', dont_normalize=dont_normalize, multifo=multifo, debug=debug)
-        tmpvals = set_lb_values(dtree, tau*lbr_tau_factor, only_calc_metric='lbr', dont_normalize=dont_normalize, multifo=multifo, debug=debug)
-        lbvals['lbr'] = tmpvals['lbr']
+        lbvals = set_lb_values(dtree, {'lbi' : tau, 'lbr' : tau*lbr_tau_factor}, dont_normalize=dont_normalize, multifo=multifo, debug=debug)
     else:
         assert lbr_tau_factor is None or dont_normalize  # we need to make sure that we weren't accidentally called with lbr_tau_factor set, but then we ignore it because the caller forgot that we ignore it if only_calc_metric is also set
         if iclust is None or iclust == 0:
             print '    calculating %s %s with tau %.4f' % (normstr, lb_metrics[only_calc_metric], tau)
-        lbvals = set_lb_values(dtree, tau, only_calc_metric=only_calc_metric, dont_normalize=dont_normalize, multifo=multifo, debug=debug)
+        lbvals = set_lb_values(dtree, {only_calc_metric : tau}, dont_normalize=dont_normalize, multifo=multifo, debug=debug)
     lbvals['tree'] = treestr
 
     return lbvals
@@ -1410,7 +1427,7 @@ def get_tree_metric_lines(annotations, cpath, reco_info, use_true_clusters, min_
         inf_lines_to_use = annotations.values()  # we used to restrict it to clusters in the best partition, but I'm switching since I think whenever there are extra ones in <annotations> we always actually want their tree metrics (at the moment there will only be extra ones if either --calculate-alternative-annotations or --write-additional-cluster-annotations are set, but in the future it could also be the default)
         if only_use_best_partition:
             assert cpath is not None and cpath.i_best is not None
-            inf_lines_to_use = [l for l in inf_lines_to_use if l['unique_ids'] in cpath.partitions[cpath.i_best]]
+            inf_lines_to_use = [l for l in inf_lines_to_use if l['unique_ids'] in cpath.best(readonly=True)]
         if only_plot_uids_with_affinity_info:
             assert False  # should work fine as is, but needs to be checked and integrated with things
             tmplines = []
@@ -1495,6 +1512,10 @@ def plot_tree_metrics(base_plotdir, inf_lines_to_use, true_lines_to_use, ete_pat
 
     print '    selection metric plotting time: %.1f sec' % (time.time() - start)
 
+# ----------------------------------------------------------------------------------------
+def use_cpath_tree(line, cpath, use_true_clusters):  # if this is true, get_tree_for_line() gets the tree from the cpath history (rather than fasttree)
+    return cpath is not None and cpath.i_best is not None and not use_true_clusters and line['unique_ids'] in cpath.best(readonly=True)
+
 # ----------------------------------------------------------------------------------------
 def get_tree_for_line(line, treefname=None, cpath=None, annotations=None, use_true_clusters=False, debug=False):
     # figure out how we want to get the inferred tree
@@ -1509,9 +1530,9 @@ def get_tree_for_line(line, treefname=None, cpath=None, annotations=None, use_tr
         dtree = get_dendro_tree(treestr=lonr_info['tree'])
         # line['tree-info']['lonr'] = lonr_info
         origin = 'lonr'
-    elif cpath is not None and cpath.i_best is not None and not use_true_clusters and line['unique_ids'] in cpath.partitions[cpath.i_best]:  # if <use_true_clusters> is set, then the clusters in <inf_lines_to_use> won't correspond to the history in <cpath>, so this won't work NOTE now that I've added the direct check if the unique ids are in the best partition, i can probably remove the use_true_clusters check, but I don't want to mess with it a.t.m.
+    elif use_cpath_tree(line, cpath, use_true_clusters):  # if <use_true_clusters> is set, then the clusters in <inf_lines_to_use> won't correspond to the history in <cpath>, so this won't work NOTE now that I've added the direct check if the unique ids are in the best partition, i can probably remove the use_true_clusters check, but I don't want to mess with it a.t.m.
         assert annotations is not None
-        i_only_cluster = cpath.partitions[cpath.i_best].index(line['unique_ids'])
+        i_only_cluster = cpath.best(readonly=True).index(line['unique_ids'])
         cpath.make_trees(annotations=annotations, i_only_cluster=i_only_cluster, get_fasttrees=True, debug=False)
         dtree = cpath.trees[i_only_cluster]  # as we go through the loop, the <cpath> is presumably filling all of these in
         origin = 'cpath'
@@ -1580,12 +1601,75 @@ def get_aa_lb_metrics(line, nuc_dtree, lb_tau, lbr_tau_factor=None, only_calc_me
     for nuc_metric in [k for k in aa_lb_info if k != 'tree']:
         line['tree-info']['lb']['aa-'+nuc_metric] = aa_lb_info[nuc_metric]
 
+# ----------------------------------------------------------------------------------------
+def calculate_line_metrics(iclust, line, mfo):  # get tree and calculate selection metrics for inferred cluster <line>, adding them to <line> (<mfo> has the options from calculate_tree_metrics()). Returns the tree origin
+    debug = mfo['debug']
+    if debug:
+        print '  %s sequence cluster' % utils.color('green', str(len(line['unique_ids'])))
+    treefo = get_tree_for_line(line, treefname=mfo['treefname'], cpath=mfo['cpath'], annotations=mfo['annotations'], use_true_clusters=mfo['use_true_clusters'], debug=debug)
+    if treefo['tree'] is None and treefo['origin'] == 'no-uids':
+        return treefo['origin']
+    line['tree-info'] = {}  # NOTE <treefo> has a dendro tree, but what we put in the <line> (at least for now) is a newick string
+    line['tree-info']['lb'] = calculate_lb_values(treefo['tree'], mfo['lb_tau'], lbr_tau_factor=mfo['lbr_tau_factor'], annotation=line, dont_normalize=mfo['dont_normalize_lbi'], extra_str='inf tree', iclust=iclust, debug=debug)
+    check_lb_values(line, line['tree-info']['lb'])  # would be nice to remove this eventually, but I keep runnining into instances where dendropy is silently removing nodes
+    if mfo['add_aa_consensus_distance']:
+        add_cdists_to_lbfo(line, line['tree-info']['lb'], 'cons-dist-aa', debug=debug)  # this adds the values both directly to the <line>, and to <line['tree-info']['lb']>, but the former won't end up in the output file unless the corresponding keys are specified as extra annotation columns (this distinction/duplication is worth having, although it's not ideal)
+    if mfo['add_aa_lb_metrics']:
+        get_aa_lb_metrics(line, treefo['tree'], mfo['lb_tau'], lbr_tau_factor=mfo['lbr_tau_factor'], dont_normalize_lbi=mfo['dont_normalize_lbi'], extra_str='(AA inf tree, iclust %d)'%iclust, iclust=iclust, debug=debug)
+    if mfo['pmml_models'] is not None:
+        calc_dtr(False, line, line['tree-info']['lb'], treefo['tree'], None, mfo['pmml_models'], mfo['dtr_cfgvals'])  # adds predicted dtr values to lbfo (hardcoded False and None are to make sure we don't train on data)
+    return treefo['origin']
+
+# ----------------------------------------------------------------------------------------
+forked_metric_info = None  # lines and options for forked calculate_line_metrics() processes (they inherit it when they're forked, so we don't have to pickle the lines, cpath, models, etc.)
+def run_forked_line_metrics_single(iclust):
+    line = forked_metric_info['lines'][iclust]
+    line_before = copy.deepcopy(line)  # so we can tell which keys get added or changed (some of them, e.g. cons_dists_aa, may already be in the line, but get overwritten)
+    fasttree_cache['unwritten'] = []
+    origin = calculate_line_metrics(iclust, line, forked_metric_info['mfo'])
+    sys.stdout.flush()
+    changed_info = {k : line[k] for k in line if k not in line_before or line[k] != line_before[k]}  # only send back the stuff that's different
+    removed_keys = [k for k in line_before if k not in line]
+    return iclust, origin, changed_info, removed_keys, fasttree_cache['unwritten']  # (also send any new FastTree trees, so the parent can write them to the cache file)
+
+# ----------------------------------------------------------------------------------------
+def run_forked_line_metrics(lines, iclusts, mfo, n_procs, max_tasks_per_proc=None):  # run calculate_line_metrics() for each of <iclusts> in a pool of <n_procs> forked processes, adding the results to <lines> as they finish. Returns the tree origin for each iclust
+    global forked_metric_info
+    forked_metric_info = {'lines' : lines, 'mfo' : mfo}
+    sorted_iclusts = sorted(iclusts, key=lambda i: len(lines[i]['unique_ids']), reverse=True)  # start the biggest ones first, so we don't end up waiting for one big one at the end
+    if mfo['treefname'] is None and any(use_cpath_tree(lines[i], mfo['cpath'], mfo['use_true_clusters']) for i in iclusts):
+        mfo['cpath'].init_sub_paths()  # do the whole-path pass here, so the forked procs inherit it (otherwise each one redoes it, and nothing they cache gets back to us)
+    n_procs = min(n_procs, len(iclusts))
+    print '      running %d cluster%s with %d procs%s' % (len(iclusts), utils.plural(len(iclusts)), n_procs, '' if max_tasks_per_proc is None else ' (replacing each proc after %d clusters)' % max_tasks_per_proc)
+    sys.stdout.flush()
+    origins = {}
+    pool = multiprocessing.Pool(n_procs, maxtasksperchild=max_tasks_per_proc)
+    try:
+        for iclust, origin, changed_info, removed_keys, new_newicks in pool.imap_unordered(run_forked_line_metrics_single, sorted_iclusts, chunksize=1):  # chunksize 1 so they get handed out in order of decreasing size
+            origins[iclust] = origin
+            lines[iclust].update(changed_info)
+            for key in removed_keys:
+                del lines[iclust][key]
+            add_fasttree_newicks(new_newicks)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        forked_metric_info = None
+    return origins
+
 # ----------------------------------------------------------------------------------------
 def calculate_tree_metrics(annotations, lb_tau, lbr_tau_factor=None, cpath=None, treefname=None, reco_info=None, use_true_clusters=False, base_plotdir=None,
                            ete_path=None, workdir=None, dont_normalize_lbi=False, only_csv=False, min_cluster_size=default_min_selection_metric_cluster_size,
                            dtr_path=None, train_dtr=False, dtr_cfg=None, add_aa_consensus_distance=False, add_aa_lb_metrics=False, true_lines_to_use=None, include_relative_affy_plots=False,
-                           cluster_indices=None, outfname=None, only_use_best_partition=False, glfo=None, queries_to_include=None, debug=False):
+                           cluster_indices=None, outfname=None, only_use_best_partition=False, glfo=None, queries_to_include=None, n_procs=1, max_tasks_per_proc=None, tree_cachefname=None, debug=False):
+    # if <n_procs> is greater than 1, the inferred clusters are done in a pool of forked processes, biggest first (if <max_tasks_per_proc> is set, each process is replaced after it's done that many clusters, which bounds memory usage on huge repertoires)
+    # if <tree_cachefname> is set, FastTree trees are cached there, so we only rerun FastTree for clusters that've changed
     print 'getting selection metrics'
+    if tree_cachefname is not None:
+        set_fasttree_cachefname(tree_cachefname)
     if reco_info is not None:
         if not use_true_clusters:
             print '    note: getting selection metrics on simulation without setting <use_true_clusters> (i.e. probably without setting --simultaneous-true-clonal-seqs)'
@@ -1615,31 +1699,31 @@ def calculate_tree_metrics(annotations, lb_tau, lbr_tau_factor=None, cpath=None,
                 raise Exception('invalid cluster indices %s for partition with %d clusters' % (cluster_indices, len(inf_lines_to_use)))
             print '      skipped all iclusts except %s (size%s %s)' % (' '.join(str(i) for i in cluster_indices), utils.plural(len(cluster_indices)), ' '.join(str(len(inf_lines_to_use[i]['unique_ids'])) for i in cluster_indices))
         n_already_there, n_skipped_uid = 0, 0
-        final_inf_lines = []
-        for iclust, line in enumerate(inf_lines_to_use):
-            if cluster_indices is not None and iclust not in cluster_indices:
-                continue
-            if debug:
-                print '  %s sequence cluster' % utils.color('green', str(len(line['unique_ids'])))
-            treefo = get_tree_for_line(line, treefname=treefname, cpath=cpath, annotations=annotations, use_true_clusters=use_true_clusters, debug=debug)
-            if treefo['tree'] is None and treefo['origin'] == 'no-uids':
-                n_skipped_uid += 1
-                continue
-            tree_origin_counts[treefo['origin']]['count'] += 1
-            if 'tree-info' in line:  # NOTE we used to continue here, but now I've decided we really want to overwrite what's there (although I'm a little worried that there was a reason I'm forgetting not to overwrite them)
+        iclusts_to_run = [i for i in range(len(inf_lines_to_use)) if cluster_indices is None or i in cluster_indices]
+        for iclust in iclusts_to_run:
+            if 'tree-info' in inf_lines_to_use[iclust]:  # NOTE we used to skip these, but now I've decided we really want to overwrite what's there (although I'm a little worried that there was a reason I'm forgetting not to overwrite them)
                 if debug:
                     print '       %s overwriting selection metric info that was already in <line>' % utils.color('yellow', 'warning')
                 n_already_there += 1
-            line['tree-info'] = {}  # NOTE <treefo> has a dendro tree, but what we put in the <line> (at least for now) is a newick string
-            line['tree-info']['lb'] = calculate_lb_values(treefo['tree'], lb_tau, lbr_tau_factor=lbr_tau_factor, annotation=line, dont_normalize=dont_normalize_lbi, extra_str='inf tree', iclust=iclust, debug=debug)
-            check_lb_values(line, line['tree-info']['lb'])  # would be nice to remove this eventually, but I keep runnining into instances where dendropy is silently removing nodes
-            if add_aa_consensus_distance:
-                add_cdists_to_lbfo(line, line['tree-info']['lb'], 'cons-dist-aa', debug=debug)  # this adds the values both directly to the <line>, and to <line['tree-info']['lb']>, but the former won't end up in the output file unless the corresponding keys are specified as extra annotation columns (this distinction/duplication is worth having, although it's not ideal)
-            if add_aa_lb_metrics:
-                get_aa_lb_metrics(line, treefo['tree'], lb_tau, lbr_tau_factor=lbr_tau_factor, dont_normalize_lbi=dont_normalize_lbi, extra_str='(AA inf tree, iclust %d)'%iclust, iclust=iclust, debug=debug)
-            if dtr_path is not None and not train_dtr:  # don't want to train on data
-                calc_dtr(False, line, line['tree-info']['lb'], treefo['tree'], None, pmml_models, dtr_cfgvals)  # adds predicted dtr values to lbfo (hardcoded False and None are to make sure we don't train on data)
-            final_inf_lines.append(line)
+        mfo = {'treefname' : treefname, 'cpath' : cpath, 'annotations' : annotations, 'use_true_clusters' : use_true_clusters, 'lb_tau' : lb_tau, 'lbr_tau_factor' : lbr_tau_factor, 'dont_normalize_lbi' : dont_normalize_lbi,
+               'add_aa_consensus_distance' : add_aa_consensus_distance, 'add_aa_lb_metrics' : add_aa_lb_metrics, 'pmml_models' : None, 'dtr_cfgvals' : None, 'debug' : debug}
+        if dtr_path is not None and not train_dtr:  # don't want to train on data
+            mfo.update({'pmml_models' : pmml_models, 'dtr_cfgvals' : dtr_cfgvals})
+        if treefname is None:  # run FastTree on all the clusters that'll need it at once (get_tree_for_line() then gets them from the cache)
+            ft_lines = [inf_lines_to_use[i] for i in iclusts_to_run if not use_cpath_tree(inf_lines_to_use[i], cpath, use_true_clusters)]
+            if len(ft_lines) > 0:
+                get_fasttree_newicks([[{'name' : u, 'seq' : s} for u, s in zip(l['unique_ids'], l['seqs'])] for l in ft_lines], [l['naive_seq'] for l in ft_lines], n_procs=n_procs, debug=debug)
+        if n_procs > 1 and len(iclusts_to_run) > 1:
+            origins = run_forked_line_metrics(inf_lines_to_use, iclusts_to_run, mfo, n_procs, max_tasks_per_proc=max_tasks_per_proc)
+        else:
+            origins = {i : calculate_line_metrics(i, inf_lines_to_use[i], mfo) for i in iclusts_to_run}
+        final_inf_lines = []
+        for iclust in iclusts_to_run:  # keep them in the original order
+            if origins[iclust] == 'no-uids':
+                n_skipped_uid += 1
+                continue
+            tree_origin_counts[origins[iclust]]['count'] += 1
+            final_inf_lines.append(inf_lines_to_use[iclust])
         print '      tree origins: %s' % ',  '.join(('%d %s' % (nfo['count'], nfo['label'])) for n, nfo in tree_origin_counts.items() if nfo['count'] > 0)
         if n_skipped_uid > 0:
             print '    skipped %d/%d clusters that had no uids in common with tree in %s' % (n_skipped_uid, n_after, treefname)
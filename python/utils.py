@@ -21,8 +21,16 @@ import copy
 import traceback
 import json
 import types
+import io
+import gzip
+import bz2
 import collections
 import operator
+import heapq
+import select
+import signal
+import errno
+import fcntl
 import yaml
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
@@ -32,6 +40,7 @@ except ImportError:
 import indelutils
 import clusterpath
 import treeutils
+import columnarfile
 
 # ----------------------------------------------------------------------------------------
 def get_partis_dir():
@@ -347,6 +356,7 @@ adaptive_headers = {
 }
 
 # ----------------------------------------------------------------------------------------
+compression_suffixes = ['.gz', '.bz2']
 forbidden_characters = set([':', ';', ','])  # strings that are not allowed in sequence ids
 forbidden_character_translations = string.maketrans(':;,', 'csm')
 ambig_translations = string.maketrans(''.join(all_ambiguous_bases), ambig_base * len(all_ambiguous_bases))
@@ -1025,9 +1035,10 @@ def write_airr_output(outfname, annotation_list, cpath, failed_queries, debug=Fa
     with open(outfname, 'w') as outfile:
         writer = csv.DictWriter(outfile, airr_headers.keys(), delimiter='\t')
         writer.writeheader()
+        best_partition = cpath.best(readonly=True) if cpath is not None else None
         for line in annotation_list:
             for iseq in range(len(line['unique_ids'])):
-                aline = get_airr_line(line, iseq, partition=cpath.partitions[cpath.i_best] if cpath is not None else None, debug=debug)
+                aline = get_airr_line(line, iseq, partition=best_partition, debug=debug)
                 writer.writerow(aline)
 
         # and write empty lines for seqs that failed either in sw or the hmm
@@ -2024,6 +2035,104 @@ def get_linearham_bounds(sw_info, line, vj_flexbounds_shift=10, debug=False):
 
     return {'flexbounds' : fbounds, 'relpos' : rpos}
 
+# ----------------------------------------------------------------------------------------
+def replace_duplicate_gene_names(glfo, line):
+    for region in regions:  # backwards compatibility with old simulation files should be removed when you're no longer running on them
+        if line[region + '_gene'] not in glfo['seqs'][region]:
+            alternate_name = glutils.convert_to_duplicate_name(glfo, line[region + '_gene'])
+            # print ' using alternate name %s instead of %s' % (alternate_name, line[region + '_gene'])
+            line[region + '_gene'] = alternate_name
+
+# ----------------------------------------------------------------------------------------
+lazy_implicit_keys = implicit_linekeys | set(['indelfos'])  # keys that add_implicit_info() adds (if they're already in a lazy annotation, we return what's there, since add_implicit_info() would just recalculate the same thing)
+lazy_modified_keys = set(['has_shm_indels', 'qr_gap_seqs', 'gl_gap_seqs'] + [r + '_per_gene_support' for r in regions])  # keys that add_implicit_info() removes or rearranges, so we have to add implicit info before returning them
+class LazyAnnotation(dict):
+    """
+    Annotation (i.e. <line>) dict for which add_implicit_info() isn't run until it's needed, i.e. until you ask for an implicit key that isn't already there, or do anything that looks at or modifies all the keys (iterating, copying, setting, comparing, etc.).
+    Keys that are already there (e.g. from an output file: uids, genes, 'naive_seq', 'cdr3_length') are returned without adding implicit info, so e.g. making a cluster size histogram doesn't pay for per-sequence hamming distances and indel reconstruction.
+    Once implicit info is added, it switches its class to a plain dict subclass, so after that it's just as fast as a normal annotation.
+    We keep our own copy of the germline info for the line's genes, so modifying <glfo> after reading doesn't change the implicit info we add later.
+    NOTE CPython's C-level dict copies (dict(line), {}.update(line), f(**line)) read the stored keys directly, so they don't see implicit keys that haven't been added yet -- use line.copy() or copy.deepcopy(line), or call line.add_implicit_info() first.
+    """
+    __slots__ = ['glfo']
+    def __init__(self, glfo, line):
+        dict.__init__(self, line)
+        self.glfo = None
+        replace_duplicate_gene_names(glfo, self)  # cheap, and changes keys that we don't otherwise check
+        self.glfo = {'locus' : glfo['locus'], 'seqs' : {r : {} for r in regions}}  # only what add_implicit_info() needs (seqs and codon positions are immutable, so we don't need to deep copy them)
+        for region in regions:
+            gene = dict.__getitem__(self, region + '_gene')
+            self.glfo['seqs'][region][gene] = glfo['seqs'][region][gene]
+        for region, codon in conserved_codons[glfo['locus']].items():
+            gene = dict.__getitem__(self, region + '_gene')
+            self.glfo[codon + '-positions'] = {gene : glfo[codon + '-positions'][gene]}
+
+    # ----------------------------------------------------------------------------------------
+    def add_implicit_info(self):
+        if self.glfo is None:
+            return
+        glfo, self.glfo = self.glfo, None  # have to unset it first, since add_implicit_info() modifies us
+        self.__class__ = ImplicitInfoAnnotation
+        add_implicit_info(glfo, self)
+
+    # ----------------------------------------------------------------------------------------
+    def check_key(self, key):
+        if key in lazy_modified_keys or (key in lazy_implicit_keys and not dict.__contains__(self, key)):
+            self.add_implicit_info()
+
+    # ----------------------------------------------------------------------------------------
+    def __getitem__(self, key):
+        self.check_key(key)
+        return dict.__getitem__(self, key)
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, key, default=None):
+        self.check_key(key)
+        return dict.get(self, key, default)
+
+    # ----------------------------------------------------------------------------------------
+    def __contains__(self, key):
+        self.check_key(key)
+        return dict.__contains__(self, key)
+
+    # ----------------------------------------------------------------------------------------
+    def has_key(self, key):
+        return self.__contains__(key)
+
+    # ----------------------------------------------------------------------------------------
+    def __eq__(self, other):
+        self.add_implicit_info()
+        if isinstance(other, LazyAnnotation):
+            other.add_implicit_info()
+        return dict.__eq__(self, other)
+
+    # ----------------------------------------------------------------------------------------
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    # ----------------------------------------------------------------------------------------
+    def __reduce__(self):  # pickles (and copies) as a plain dict
+        self.add_implicit_info()
+        return (dict, (dict(self), ))
+
+# ----------------------------------------------------------------------------------------
+def add_lazy_annotation_method(name):  # set up LazyAnnotation.<name> to add implicit info, then call the dict method
+    dict_method = getattr(dict, name)
+    def lazy_method(self, *args, **kwargs):
+        self.add_implicit_info()
+        return dict_method(self, *args, **kwargs)
+    setattr(LazyAnnotation, name, lazy_method)
+for name in ['keys', 'values', 'items', 'iterkeys', 'itervalues', 'iteritems', 'viewkeys', 'viewvalues', 'viewitems', '__iter__', '__len__', '__repr__', 'copy',
+             '__setitem__', '__delitem__', 'pop', 'popitem', 'setdefault', 'update', 'clear']:
+    add_lazy_annotation_method(name)
+
+# ----------------------------------------------------------------------------------------
+class ImplicitInfoAnnotation(dict):  # what a LazyAnnotation turns into once it's added implicit info (has to be a dict subclass with the same layout so we can switch classes)
+    __slots__ = ['glfo']
+    # ----------------------------------------------------------------------------------------
+    def __reduce__(self):
+        return (dict, (dict(self), ))
+
 # ----------------------------------------------------------------------------------------
 def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, reset_indel_genes=False):  # should turn on <check_line_keys> for a bit if you change anything
     """ Add to <line> a bunch of things that are initially only implicit. """
@@ -2038,11 +2147,7 @@ def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, r
         # then keep track of the keys we got to start with
         pre_existing_implicit_info = {ek : copy.deepcopy(line[ek]) for ek in implicit_linekeys if ek in line}
 
-    for region in regions:  # backwards compatibility with old simulation files should be removed when you're no longer running on them
-        if line[region + '_gene'] not in glfo['seqs'][region]:
-            alternate_name = glutils.convert_to_duplicate_name(glfo, line[region + '_gene'])
-            # print ' using alternate name %s instead of %s' % (alternate_name, line[region + '_gene'])
-            line[region + '_gene'] = alternate_name
+    replace_duplicate_gene_names(glfo, line)
 
     # add the regional germline seqs and their lengths
     line['lengths'] = {}  # length of each match (including erosion)
@@ -2533,6 +2638,164 @@ def find_replacement_genes(param_dir, min_counts, gene_name=None, debug=False, a
     # print '    \nWARNING return default gene %s \'cause I couldn\'t find anything remotely resembling %s' % (color_gene(hackey_default_gene_versions[region]), color_gene(gene_name))
     # return hackey_default_gene_versions[region]
 
+# ----------------------------------------------------------------------------------------
+# vectorized hamming distance stuff: sequences are encoded as rows of a uint8 array (just the ascii codes), with a boolean mask that's True at ambiguous/gap positions (which are excluded from both the distance and the length)
+hamming_skip_tables = {}
+for _aa in [False, True]:
+    hamming_skip_tables[_aa] = numpy.zeros(256, dtype=numpy.bool_)
+    hamming_skip_tables[_aa][[ord(c) for c in (ambiguous_amino_acids if _aa else all_ambiguous_bases) + gap_chars]] = True
+
+# ----------------------------------------------------------------------------------------
+def encode_seqs(seqs, amino_acid=False):  # return (codes, ambig_mask) for list of equal-length <seqs>, both with shape (len(seqs), seq length)
+    seqlen = len(seqs[0]) if len(seqs) > 0 else 0
+    if any(len(s) != seqlen for s in seqs):
+        raise Exception('unequal length sequences: %s' % ' '.join(str(len(s)) for s in seqs))
+    if seqlen == 0:
+        codes = numpy.zeros((len(seqs), 0), dtype=numpy.uint8)
+    else:
+        codes = numpy.frombuffer(''.join(str(s) for s in seqs), dtype=numpy.uint8).reshape(len(seqs), seqlen)
+    return codes, hamming_skip_tables[amino_acid][codes]
+
+# ----------------------------------------------------------------------------------------
+def hamming_one_vs_many_encoded(codes, ambig_mask, other_codes, other_ambig_mask):  # <codes>/<ambig_mask> are for one sequence (1d), <other_*> for many (2d); returns arrays of (distances, lengths excluding ambiguous positions)
+    ok_positions = ~(other_ambig_mask | ambig_mask)
+    return numpy.count_nonzero((other_codes != codes) & ok_positions, axis=1), numpy.count_nonzero(ok_positions, axis=1)
+
+# ----------------------------------------------------------------------------------------
+def hamming_one_vs_many(seq, other_seqs, amino_acid=False):  # return arrays of hamming distances and non-ambiguous lengths between <seq> and each of <other_seqs>
+    codes, ambig_mask = encode_seqs([seq] + list(other_seqs), amino_acid=amino_acid)
+    return hamming_one_vs_many_encoded(codes[0], ambig_mask[0], codes[1:], ambig_mask[1:])
+
+# ----------------------------------------------------------------------------------------
+def hamming_all_pairs(seqs, amino_acid=False):  # return condensed arrays of hamming distances and non-ambiguous lengths for each pair of seqs, in the same order as itertools.combinations(seqs, 2) (so each array has len(seqs) * (len(seqs) - 1) / 2 entries, but we only ever encode the seqs once)
+    codes, ambig_mask = encode_seqs(seqs, amino_acid=amino_acid)
+    n_pairs = len(seqs) * (len(seqs) - 1) // 2
+    distances, lengths = numpy.zeros(n_pairs, dtype=int), numpy.zeros(n_pairs, dtype=int)
+    istart = 0
+    for iseq in range(len(seqs) - 1):
+        istop = istart + len(seqs) - iseq - 1
+        distances[istart : istop], lengths[istart : istop] = hamming_one_vs_many_encoded(codes[iseq], ambig_mask[iseq], codes[iseq + 1:], ambig_mask[iseq + 1:])
+        istart = istop
+    return distances, lengths
+
+# ----------------------------------------------------------------------------------------
+def greedy_centroid_cluster(seqdict, threshold, sizes=None):  # in-process approximation of vsearch's --cluster_fast (for equal-length seqs, without alignment, and we take the closest centroid rather than the first kmer-ranked hit): go through seqs in order of decreasing <sizes> (e.g. number of seqs with each naive seq), adding each to the closest existing centroid if its hamming fraction is at most <threshold>, otherwise making it a new centroid. Returns partition of keys in <seqdict>
+    names = sorted(seqdict, key=lambda n: -sizes[n]) if sizes is not None else list(seqdict)
+    codes, ambig_mask = encode_seqs([seqdict[n] for n in names])
+    centroid_indices, partition = [], []  # index in <names> of each centroid, and the corresponding cluster
+    centroid_codes, centroid_ambig = numpy.zeros(codes.shape, dtype=codes.dtype), numpy.zeros(ambig_mask.shape, dtype=numpy.bool_)  # allocate for the worst case (all centroids) so we don't have to keep resizing
+    for iseq, name in enumerate(names):
+        if len(centroid_indices) > 0:
+            n_cent = len(centroid_indices)
+            distances, lengths = hamming_one_vs_many_encoded(codes[iseq], ambig_mask[iseq], centroid_codes[:n_cent], centroid_ambig[:n_cent])
+            hfracs = numpy.where(lengths > 0, distances / numpy.maximum(lengths, 1).astype(float), 1.)  # no unambiguous overlap (e.g. an all-N naive seq) means we can't tell, so never merge
+            ibest = int(numpy.argmin(hfracs))  # first of the closest ones, i.e. the biggest one
+            if hfracs[ibest] <= threshold:
+                partition[ibest].append(name)
+                continue
+        centroid_codes[len(centroid_indices)], centroid_ambig[len(centroid_indices)] = codes[iseq], ambig_mask[iseq]
+        centroid_indices.append(iseq)
+        partition.append([name])
+    return partition
+
+# ----------------------------------------------------------------------------------------
+minimizer_hash_base, minimizer_hash_mult = numpy.uint64(1000003), numpy.uint64(0x9e3779b97f4a7c15)  # arithmetic is mod 2^64 (numpy arrays wrap silently)
+def get_minimizers(seq, kmer_len=16, window_len=8):  # return set of minimizers of <seq>, i.e. the smallest k-mer hash in each window of <window_len> consecutive k-mers (None if <seq> is too short for even one window)
+    # since each minimizer only depends on the contents of its window, if seq a is a substring of seq b then a's minimizers are a subset of b's
+    n_kmers = len(seq) - kmer_len + 1
+    if n_kmers < window_len:
+        return None
+    codes = numpy.frombuffer(str(seq), dtype=numpy.uint8).astype(numpy.uint64)
+    hashes = numpy.zeros(n_kmers, dtype=numpy.uint64)
+    for ipos in range(kmer_len):
+        hashes = hashes * minimizer_hash_base + codes[ipos : ipos + n_kmers]
+    hashes *= minimizer_hash_mult  # scramble, so the minimizers aren't just the lexicographically smallest k-mers
+    mins = hashes[ : n_kmers - window_len + 1].copy()
+    for ipos in range(1, window_len):
+        numpy.minimum(mins, hashes[ipos : ipos + n_kmers - window_len + 1], out=mins)
+    return set(mins.tolist())
+
+# ----------------------------------------------------------------------------------------
+class SubstringIndex(object):
+    """
+    Set of sequences that can quickly find which of its members contain, or are contained in, a query sequence (i.e. the results of 'qseq in seq' and 'seq in qseq', but without checking every member).
+    Each member is indexed by its minimizers (see get_minimizers()): members that contain the query have to have all of the query's minimizers, while members contained in the query have to have their rarest minimizer among the query's.
+    Candidates are then checked with actual substring comparisons, so hash collisions can only cost time, not change results.
+    """
+    def __init__(self, kmer_len=16, window_len=8):
+        self.kmer_len, self.window_len = kmer_len, window_len
+        self.postings = {}  # map from each minimizer to the set of member seqs that have it
+        self.anchors = {}  # map from each minimizer to the set of member seqs for which it's the anchor (rarest minimizer when they were added)
+        self.seqfo = {}  # map from each member seq to (minimizers, anchor)
+        self.short_seqs = set()  # members too short to have minimizers (have to be checked one by one)
+        self.last_minimizers = (None, None)  # (seq, minimizers) for the most recent seq, since we usually add a seq right after querying with it
+
+    # ----------------------------------------------------------------------------------------
+    def minimizers(self, seq):
+        if self.last_minimizers[0] != seq:
+            self.last_minimizers = (seq, get_minimizers(seq, kmer_len=self.kmer_len, window_len=self.window_len))
+        return self.last_minimizers[1]
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.seqfo) + len(self.short_seqs)
+
+    # ----------------------------------------------------------------------------------------
+    def __contains__(self, seq):
+        return seq in self.seqfo or seq in self.short_seqs
+
+    # ----------------------------------------------------------------------------------------
+    def add(self, seq):
+        if seq in self:
+            return
+        mzrs = self.minimizers(seq)
+        if mzrs is None:
+            self.short_seqs.add(seq)
+            return
+        anchor = min(mzrs, key=lambda m: (len(self.postings.get(m, ())), m))
+        for mzr in mzrs:
+            self.postings.setdefault(mzr, set()).add(seq)
+        self.anchors.setdefault(anchor, set()).add(seq)
+        self.seqfo[seq] = (mzrs, anchor)
+
+    # ----------------------------------------------------------------------------------------
+    def remove(self, seq):
+        if seq in self.short_seqs:
+            self.short_seqs.remove(seq)
+            return
+        mzrs, anchor = self.seqfo.pop(seq)
+        for mzr in mzrs:
+            self.postings[mzr].remove(seq)
+            if len(self.postings[mzr]) == 0:
+                del self.postings[mzr]
+        self.anchors[anchor].remove(seq)
+        if len(self.anchors[anchor]) == 0:
+            del self.anchors[anchor]
+
+    # ----------------------------------------------------------------------------------------
+    def containing(self, qseq):  # return set of members that contain <qseq> (including <qseq> itself, if it's a member)
+        qmzrs = self.minimizers(qseq)
+        if qmzrs is None:  # have to check everybody
+            candidates = set(self.seqfo) | self.short_seqs
+        else:  # short seqs can't contain a long one
+            plists = sorted((self.postings.get(m, set()) for m in qmzrs), key=len)
+            candidates = set(plists[0])
+            for plist in plists[1:]:
+                if len(candidates) == 0:
+                    break
+                candidates &= plist
+        return set(s for s in candidates if qseq in s)
+
+    # ----------------------------------------------------------------------------------------
+    def contained(self, qseq):  # return set of members that are contained in <qseq> (including <qseq> itself, if it's a member)
+        qmzrs = self.minimizers(qseq)
+        candidates = set(self.short_seqs)
+        if qmzrs is not None:  # long members can't be contained in a short seq
+            for mzr in qmzrs:
+                if mzr in self.anchors:
+                    candidates |= self.anchors[mzr]
+        return set(s for s in candidates if s in qseq)
+
 # ----------------------------------------------------------------------------------------
 def hamming_distance(seq1, seq2, extra_bases=None, return_len_excluding_ambig=False, return_mutated_positions=False, align=False, align_if_necessary=False, amino_acid=False):
     if extra_bases is not None:
@@ -2549,21 +2812,12 @@ def hamming_distance(seq1, seq2, extra_bases=None, return_len_excluding_ambig=Fa
         else:
             return 0
 
-    if amino_acid:
-        skip_chars = set(ambiguous_amino_acids + gap_chars)
-    else:
-        skip_chars = set(all_ambiguous_bases + gap_chars)
-
-    distance, len_excluding_ambig = 0, 0
-    mutated_positions = []
-    for ich in range(len(seq1)):  # already made sure they're the same length
-        if seq1[ich] in skip_chars or seq2[ich] in skip_chars:
-            continue
-        len_excluding_ambig += 1
-        if seq1[ich] != seq2[ich]:
-            distance += 1
-            if return_mutated_positions:
-                mutated_positions.append(ich)
+    codes, ambig_mask = encode_seqs([seq1, seq2], amino_acid=amino_acid)
+    ok_positions = ~(ambig_mask[0] | ambig_mask[1])
+    mutated = (codes[0] != codes[1]) & ok_positions
+    distance, len_excluding_ambig = int(numpy.count_nonzero(mutated)), int(numpy.count_nonzero(ok_positions))
+    if return_mutated_positions:
+        mutated_positions = numpy.flatnonzero(mutated).tolist()
 
     if return_len_excluding_ambig and return_mutated_positions:
         return distance, len_excluding_ambig, mutated_positions
@@ -2591,7 +2845,8 @@ def hamming_fraction(seq1, seq2, extra_bases=None, also_return_distance=False, a
 def mean_pairwise_hfrac(seqlist):
     if len(seqlist) < 2:
         return 0.
-    return numpy.mean([hamming_fraction(s1, s2) for s1, s2 in itertools.combinations(seqlist, 2)])
+    distances, lengths = hamming_all_pairs(seqlist)
+    return numpy.mean(numpy.where(lengths > 0, distances / numpy.maximum(lengths, 1).astype(float), 0.))
 
 # ----------------------------------------------------------------------------------------
 def subset_sequences(line, restrict_to_region=None, exclusion_3p=None, iseq=None):
@@ -3530,8 +3785,11 @@ cmdfo_defaults = {  # None means by default it's absent
 #  - unlike everywhere else, <debug> is not a boolean, and is either None (swallow out, print err)), 'print' (print out and err), 'write' (write out and err to file called 'log' in logdir), or 'write:<log file name>' (same as 'write', but you set your own base name)
 #  - if both <n_max_procs> and <proc_limit_str> are set, it uses limit_procs() (i.e. a ps call) to count the total number of <proc_limit_str> running on the machine; whereas if only <n_max_procs> is set, it counts only subprocesses that it is itself running
 #  - debug: can be None (stdout mostly gets ignored), 'print' (printed), 'write' (written to file 'log' in logdir), or 'write:<logfname>' (same, but use <logfname>)
+#  - if only <n_max_procs> is set, the remaining procs are started as running ones finish (we wait for SIGCHLD, see ChildProcWaiter, rather than polling)
+#  - <retry_fcn>: if set, called as retry_fcn(cmdfo, n_tried, returncode) when a proc fails, and it's restarted if this returns True (instead of the default of restarting if n_tried < <n_max_tries>), e.g. retry_killed_procs()
+#  - returns a list (one for each cmdfo) of dicts with 'cmd_str' and a list 'tries' of per-try dicts with keys 'start', 'wall_time', 'returncode', 'user_time', 'sys_time', and 'max_rss' (MB, None if we couldn't sample it, see ChildProcWaiter.sample_rss()) (summarize them with proc_records_str())
 def run_cmds(cmdfos, shell=False, n_max_tries=None, clean_on_success=False, batch_system=None, batch_options=None, batch_config_fname=None,
-             debug=None, ignore_stderr=False, sleep=True, n_max_procs=None, proc_limit_str=None, allow_failure=False):
+             debug=None, ignore_stderr=False, sleep=True, n_max_procs=None, proc_limit_str=None, allow_failure=False, retry_fcn=None):
     if len(cmdfos) == 0:
         raise Exception('zero length cmdfos')
     if n_max_tries is None:
@@ -3551,27 +3809,166 @@ def run_cmds(cmdfos, shell=False, n_max_tries=None, clean_on_success=False, batc
     if batch_system == 'slurm' and batch_config_fname is not None:
         set_slurm_nodelist(cmdfos, batch_config_fname)
 
-    procs, n_tries_list = [], []
-    for iproc in range(len(cmdfos)):
-        procs += [run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell)]
-        n_tries_list.append(1)
-        if sleep:
-            time.sleep(per_proc_sleep_time)
-        if n_max_procs is not None:
-            limit_procs(proc_limit_str, n_max_procs, procs=procs)  # NOTE now that I've added the <procs> arg, I should remove all the places where I'm using the old cmd str method (I mean, it works fine, but it's hackier/laggier, and in cases where several different parent procs are running a log of the same-named subprocs on the same machine, the old way will be wrong [i.e. limit_procs was originally intended as a global machine-wide limit, whereas in this fcn we usually call it wanting to set a specific number of subproces for this process])
-
-    while procs.count(None) != len(procs):  # we set each proc to None when it finishes
-        for iproc in range(len(cmdfos)):
-            if procs[iproc] is None:  # already finished
-                continue
-            if procs[iproc].poll() is not None:  # it just finished
-                status = finish_process(iproc, procs, n_tries_list[iproc], cmdfos[iproc], n_max_tries, dbgfo=cmdfos[iproc].get('dbgfo'), batch_system=batch_system, debug=debug, ignore_stderr=ignore_stderr, clean_on_success=clean_on_success, allow_failure=allow_failure)
+    procs = [None for _ in cmdfos]  # set to None when each finishes (or before it starts)
+    n_tries_list = [0 for _ in cmdfos]
+    proc_records = [{'cmd_str' : cfo['cmd_str'], 'tries' : []} for cfo in cmdfos]
+    procs_to_start = collections.deque(range(len(cmdfos)))
+
+    # ----------------------------------------------------------------------------------------
+    def start_proc(iproc):
+        procs[iproc] = run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell)
+        n_tries_list[iproc] += 1
+        proc_records[iproc]['tries'].append({'start' : time.time()})
+
+    # ----------------------------------------------------------------------------------------
+    def n_running():
+        return len(procs) - procs.count(None)
+
+    with ChildProcWaiter() as waiter:
+        while len(procs_to_start) > 0 or n_running() > 0:
+            while len(procs_to_start) > 0 and (n_max_procs is None or proc_limit_str is not None or n_running() < n_max_procs):  # if <proc_limit_str> is set, the limit is machine-wide, so we use limit_procs() (i.e. ps) to wait for other procs to finish
+                if n_max_procs is not None and proc_limit_str is not None:
+                    limit_procs(proc_limit_str, n_max_procs)
+                start_proc(procs_to_start.popleft())
+                if sleep:
+                    time.sleep(per_proc_sleep_time)
+            for iproc, rusage in waiter.wait(procs):  # blocks until at least one proc finishes
+                add_proc_record(proc_records[iproc]['tries'][-1], procs[iproc].returncode, rusage, getattr(procs[iproc], 'max_rss', None))
+                status = finish_process(iproc, procs, n_tries_list[iproc], cmdfos[iproc], n_max_tries, dbgfo=cmdfos[iproc].get('dbgfo'), batch_system=batch_system, debug=debug, ignore_stderr=ignore_stderr, clean_on_success=clean_on_success, allow_failure=allow_failure, retry_fcn=retry_fcn)
                 if status == 'restart':
-                    procs[iproc] = run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell)
-                    n_tries_list[iproc] += 1
-        sys.stdout.flush()
-        if sleep:
-            time.sleep(per_proc_sleep_time)
+                    start_proc(iproc)
+            sys.stdout.flush()
+
+    return proc_records
+
+# ----------------------------------------------------------------------------------------
+def add_proc_record(recfo, returncode, rusage, max_rss):  # add timing and resource usage info for a finished proc to <recfo> (<rusage> is None if someone else reaped it, so we don't know its resource usage)
+    # NOTE we don't use rusage.ru_maxrss, since it includes the memory of the forked python parent from before the child exec'd
+    recfo['wall_time'] = time.time() - recfo['start']
+    recfo['returncode'] = returncode
+    recfo['user_time'] = None if rusage is None else rusage.ru_utime
+    recfo['sys_time'] = None if rusage is None else rusage.ru_stime
+    recfo['max_rss'] = max_rss
+
+# ----------------------------------------------------------------------------------------
+def proc_records_str(proc_records):  # one-line summary of the records returned by run_cmds()
+    tries = [t for r in proc_records for t in r['tries']]
+    n_retries = len(tries) - len(proc_records)
+    def maxstr(key, fmt):
+        vals = [t[key] for t in tries if t.get(key) is not None]
+        return '?' if len(vals) == 0 else fmt % max(vals)
+    cpu_times = [t['user_time'] + t['sys_time'] for t in tries if t.get('user_time') is not None]
+    return '%d proc%s (%d retr%s): max wall %s  total cpu %.1fs  max rss %s' % (len(proc_records), plural(len(proc_records)), n_retries, 'y' if n_retries == 1 else 'ies',
+                                                                                  maxstr('wall_time', '%.1fs'), sum(cpu_times), maxstr('max_rss', '%.0f MB'))
+
+# ----------------------------------------------------------------------------------------
+def retry_killed_procs(cmdfo, n_tried, returncode, n_max_tries=2):  # retry policy for run_cmds()/finish_process(): restart procs that were killed by a signal (e.g. by the oom killer when a lot of procs were running at once), but not ones that exited with an error (which would presumably just fail again)
+    return returncode < 0 and n_tried < n_max_tries
+
+# ----------------------------------------------------------------------------------------
+class ChildProcWaiter(object):
+    """
+    Wait for subprocesses (Popen objects) to exit by sleeping until we get a SIGCHLD, rather than polling them all in a sleep loop.
+    The signal handler writes to a pipe on which we select() (the "self-pipe trick"), so we can't miss a child that exits just before we start waiting. We only reap the specific pids we're asked about, so any other children (e.g. bcrham workers) are left alone.
+    Use it as a context manager, so the previous SIGCHLD handler gets restored. If we're not in the main thread (so can't set signal handlers), falls back to polling.
+    """
+    def __init__(self, max_wait=1., fallback_sleep=0.005):
+        self.max_wait = max_wait  # seconds to wait in select() before checking again anyway (shouldn't be necessary, but just in case) (also the max interval between memory samples)
+        self.fallback_sleep = fallback_sleep
+        self.rfd, self.wfd = None, None
+        self.old_handler = None
+
+    # ----------------------------------------------------------------------------------------
+    def __enter__(self):
+        rfd, wfd = os.pipe()
+        for fd in [rfd, wfd]:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            self.old_handler = signal.signal(signal.SIGCHLD, self.handle_sigchld)
+        except ValueError:  # not in the main thread
+            os.close(rfd)
+            os.close(wfd)
+            return self
+        signal.siginterrupt(signal.SIGCHLD, False)  # restart interrupted system calls (otherwise e.g. reads from other pipes can fail with EINTR)
+        self.rfd, self.wfd = rfd, wfd
+        return self
+
+    # ----------------------------------------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.rfd is None:
+            return
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL if self.old_handler is None else self.old_handler)
+        os.close(self.rfd)
+        os.close(self.wfd)
+        self.rfd, self.wfd = None, None
+
+    # ----------------------------------------------------------------------------------------
+    def handle_sigchld(self, signum, frame):
+        try:
+            os.write(self.wfd, '.')
+        except OSError as err:  # pipe is full (so we'll wake up anyway) or already closed
+            if err.errno not in [errno.EAGAIN, errno.EBADF]:
+                raise
+
+    # ----------------------------------------------------------------------------------------
+    def reap(self, proc):  # if <proc> has finished, set its returncode and return (True, resource usage), otherwise (False, None)
+        if proc.returncode is not None:
+            return True, None
+        try:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        except OSError as err:
+            if err.errno != errno.ECHILD:
+                raise
+            return proc.poll() is not None, None  # someone else already reaped it
+        if pid == 0:  # still running
+            return False, None
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)  # same as Popen does
+        return True, rusage
+
+    # ----------------------------------------------------------------------------------------
+    def sleep(self):  # sleep until we get a SIGCHLD (or <self.max_wait> goes by)
+        if self.rfd is None:
+            time.sleep(self.fallback_sleep)
+            return
+        try:
+            select.select([self.rfd], [], [], self.max_wait)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+        try:
+            while len(os.read(self.rfd, 4096)) > 0:
+                pass
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    # ----------------------------------------------------------------------------------------
+    def sample_rss(self, proc):  # set proc.max_rss to the peak rss (MB) of <proc> from its VmHWM in /proc, i.e. just its own memory since it exec'd (Popen doesn't return until the child has exec'd, so we don't see the forked copy of our memory)
+        # NOTE only works on linux, and misses any peak after the last sample (we sample every time we wake up, so at least every <self.max_wait> seconds). Also, this is the memory of the proc we started, so it's e.g. the shell's or srun's if <shell> or <batch_system> are set
+        try:
+            with open('/proc/%d/status' % proc.pid) as sfile:
+                for line in sfile:
+                    if line.startswith('VmHWM:'):
+                        proc.max_rss = max(getattr(proc, 'max_rss', 0.), int(line.split()[1]) / 1024.)  # kB to MB
+                        break
+        except IOError:  # not linux, or it's already exited
+            pass
+
+    # ----------------------------------------------------------------------------------------
+    def wait(self, procs):  # block until at least one of <procs> (a list of Popen objects, or None for ones that aren't running) has finished, then return list of (index in <procs>, resource usage) for the finished ones
+        while True:
+            finished = []
+            for iproc, proc in enumerate(procs):
+                if proc is None:
+                    continue
+                is_done, rusage = self.reap(proc)
+                if is_done:
+                    finished.append((iproc, rusage))
+                else:
+                    self.sample_rss(proc)
+            if len(finished) > 0 or procs.count(None) == len(procs):
+                return finished
+            self.sleep()
 
 # ----------------------------------------------------------------------------------------
 def pad_lines(linestr, padwidth=8):
@@ -3609,7 +4006,7 @@ def get_slurm_node(errfname):
 
 # ----------------------------------------------------------------------------------------
 # deal with a process once it's finished (i.e. check if it failed, and tell the calling fcn to restart it if so)
-def finish_process(iproc, procs, n_tried, cmdfo, n_max_tries, dbgfo=None, batch_system=None, debug=None, ignore_stderr=False, clean_on_success=False, allow_failure=False):
+def finish_process(iproc, procs, n_tried, cmdfo, n_max_tries, dbgfo=None, batch_system=None, debug=None, ignore_stderr=False, clean_on_success=False, allow_failure=False, retry_fcn=None):
     procs[iproc].communicate()
     outfname = cmdfo['outfname']
 
@@ -3668,12 +4065,15 @@ def finish_process(iproc, procs, n_tried, cmdfo, n_max_tries, dbgfo=None, batch_
                 returnstr += [pad_lines(subprocess.check_output(['cat', logfname(ltype)]), padwidth=12)]
         return '\n'.join(returnstr)
 
-    if n_tried < n_max_tries:
+    if (n_tried < n_max_tries) if retry_fcn is None else retry_fcn(cmdfo, n_tried, procs[iproc].returncode):
         print getlogstrs(['err'])
         print '      restarting proc %d' % iproc
         return 'restart'
     else:
-        failstr = 'exceeded max number of tries (%d >= %d) for subprocess with command:\n        %s\n' % (n_tried, n_max_tries, cmdfo['cmd_str'])
+        if retry_fcn is None:
+            failstr = 'exceeded max number of tries (%d >= %d) for subprocess with command:\n        %s\n' % (n_tried, n_max_tries, cmdfo['cmd_str'])
+        else:
+            failstr = 'retry function declined to retry after %d tr%s for subprocess with command:\n        %s\n' % (n_tried, 'y' if n_tried == 1 else 'ies', cmdfo['cmd_str'])
         tmpstr = getlogstrs(['err'])
         if len(tmpstr.strip()) == 0:  # bppseqgen puts it in stdout, so we have to look there
             tmpstr += 'std out tail (err was empty):\n'
@@ -4557,6 +4957,56 @@ def split_partition_with_criterion(partition, criterion_fcn):  # this would prob
 def group_seqs_by_value(queries, keyfunc):  # don't have to be related seqs at all, only requirement is that the things in the iterable <queries> have to be valid arguments to <keyfunc()>
     return [list(group) for _, group in itertools.groupby(sorted(queries, key=keyfunc), key=keyfunc)]
 
+# ----------------------------------------------------------------------------------------
+def get_batches(items, max_n_per_batch, keyfunc=None, sizefunc=None, max_total_size=None):  # split <items> into consecutive batches of at most <max_n_per_batch>, and (if set) total size (sum of <sizefunc()>) at most <max_total_size> (but always at least one item), after first grouping with group_seqs_by_value() if <keyfunc> is set
+    groups = [items] if keyfunc is None else group_seqs_by_value(items, keyfunc)
+    batches = []
+    for group in groups:
+        if sizefunc is None:
+            batches += [group[i : i + max_n_per_batch] for i in range(0, len(group), max_n_per_batch)]
+            continue
+        batch, batch_size = [], 0
+        for item in group:
+            isize = sizefunc(item)
+            if len(batch) > 0 and (len(batch) >= max_n_per_batch or batch_size + isize > max_total_size):
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(item)
+            batch_size += isize
+        if len(batch) > 0:
+            batches.append(batch)
+    return batches
+
+# ----------------------------------------------------------------------------------------
+def split_by_cost(items, n_bins, costfunc, sortkey=None, n_chunks_per_bin=4, rotate=False):  # split <items> into <n_bins> lists with (roughly) equal total cost (sum of <costfunc()>)
+    # if <sortkey> is set, we first sort by it, then cut the sorted list into consecutive chunks of (about) 1/<n_chunks_per_bin> of a bin's cost, so that items with similar keys end up in the same bin
+    # chunks are then assigned to bins largest first, each to the bin with the lowest total cost so far (i.e. longest-processing-time greedy). If <rotate> is set, we start the chunk boundaries at a random point in the sorted list, so that repeated calls don't always split things in the same place
+    costs = [float(costfunc(item)) for item in items]
+    order = range(len(items))
+    if sortkey is not None:
+        order = sorted(order, key=lambda i: sortkey(items[i]))
+    if rotate and len(order) > 0:
+        ioffset = random.randint(0, len(order) - 1)
+        order = order[ioffset:] + order[:ioffset]
+    max_chunk_cost = sum(costs) / (n_bins * n_chunks_per_bin) if sortkey is not None else 0.  # if not sorting, each item is its own chunk
+    chunks, chunk, chunk_cost = [], [], 0.
+    for i in order:
+        if len(chunk) > 0 and chunk_cost + costs[i] > max_chunk_cost:
+            chunks.append((chunk_cost, chunk))
+            chunk, chunk_cost = [], 0.
+        chunk.append(i)
+        chunk_cost += costs[i]
+    if len(chunk) > 0:
+        chunks.append((chunk_cost, chunk))
+
+    bins = [[] for _ in range(n_bins)]
+    bin_heap = [(0., ibin) for ibin in range(n_bins)]  # (total cost, bin index), so the cheapest bin is always at the front
+    for chunk_cost, chunk in sorted(chunks, key=lambda c: c[0], reverse=True):
+        bin_cost, ibin = heapq.heappop(bin_heap)
+        bins[ibin] += [items[i] for i in chunk]
+        heapq.heappush(bin_heap, (bin_cost + chunk_cost, ibin))
+    return bins
+
 # ----------------------------------------------------------------------------------------
 def collapse_naive_seqs(swfo, queries=None, split_by_cdr3=False, debug=None):  # <split_by_cdr3> is only needed when we're getting synthetic sw info that's a mishmash of hmm and sw annotations
     start = time.time()
@@ -4601,62 +5051,69 @@ def write_fasta(fname, seqfos, name_key='name', seq_key='seq'):  # should have w
             seqfile.write('>%s\n%s\n' % (sfo[name_key], sfo[seq_key]))
 
 # ----------------------------------------------------------------------------------------
-def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize_uids=False, sanitize_seqs=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):
+def open_possibly_compressed(fname):  # gzip (which also handles bgzip) or bzip2 if the suffix says so, otherwise plain text
+    suffix = getsuffix(fname)
+    if suffix == '.gz':
+        return io.BufferedReader(gzip.GzipFile(fname))  # buffered reader is much faster than GzipFile's own readline()
+    elif suffix == '.bz2':
+        return bz2.BZ2File(fname)
+    else:
+        return open(fname)
+
+# ----------------------------------------------------------------------------------------
+def get_fastx_ftype(fname):
+    suffix = getsuffix(fname)
+    if suffix in compression_suffixes:
+        suffix = getsuffix(os.path.splitext(fname)[0])
+    if suffix == '.fa' or suffix == '.fasta':
+        return 'fa'
+    elif suffix == '.fq' or suffix == '.fastq':
+        return 'fq'
+    else:
+        raise Exception('unhandled file type: %s' % suffix)
+
+# ----------------------------------------------------------------------------------------
+def iterate_fastx_records(fastxfile, ftype, fname):  # yield (header line, sequence) for each record in <fastxfile>, reading straight through (i.e. no seek()ing, so it also works on compressed files)
+    lines = iter(fastxfile)
+    if ftype == 'fa':
+        headline, seqlines = None, []
+        for line in lines:
+            if line[0] == '>':
+                if headline is not None:
+                    yield headline, ''.join(seqlines)
+                headline, seqlines = line.lstrip('>'), []
+            elif headline is not None:
+                seqlines.append(line.strip())
+            elif line.strip() != '':  # blank lines before the first header are fine
+                raise Exception('invalid fasta header line in %s:\n    %s' % (fname, line))
+        if headline is not None:
+            yield headline, ''.join(seqlines)
+    elif ftype == 'fq':
+        for headline in lines:
+            if headline.strip() == '':  # skip a blank line
+                continue
+            if headline[0] != '@':
+                raise Exception('invalid fastq header line in %s:\n    %s' % (fname, headline))
+            seqline = next(lines, '')  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
+            plusline = next(lines, '').strip()
+            if plusline[:1] != '+':
+                raise Exception('invalid fastq quality header in %s:\n    %s' % (fname, plusline))
+            next(lines, '')  # quality line
+            yield headline.lstrip('@'), seqline.strip()
+    else:
+        raise Exception('unhandled ftype %s' % ftype)
+
+# ----------------------------------------------------------------------------------------
+def iter_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize_uids=False, sanitize_seqs=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None):  # generator version of read_fastx(), i.e. only one sequence is in memory at a time
     if ftype is None:
-        suffix = getsuffix(fname)
-        if suffix == '.fa' or suffix == '.fasta':
-            ftype = 'fa'
-        elif suffix == '.fq' or suffix == '.fastq':
-            ftype = 'fq'
-        else:
-            raise Exception('unhandled file type: %s' % suffix)
+        ftype = get_fastx_ftype(fname)
 
-    finfo = []
     iline = -1  # index of the query/seq that we're currently reading in the fasta
-    n_fasta_queries = 0  # number of queries so far added to <finfo> (I guess I could just use len(finfo) at this point)
+    n_fasta_queries = 0  # number of queries so far yielded
     missing_queries = set(queries) if queries is not None else None
     already_printed_forbidden_character_warning = False
-    with open(fname) as fastafile:
-        startpos = None
-        while True:
-            if startpos is not None:  # rewind since the last time through we had to look to see when the next header line appeared
-                fastafile.seek(startpos)
-            headline = fastafile.readline()
-            if not headline:
-                break
-            if headline.strip() == '':  # skip a blank line
-                headline = fastafile.readline()
-
-            if ftype == 'fa':
-                if headline[0] != '>':
-                    raise Exception('invalid fasta header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('>')
-
-                seqlines = []
-                nextline = fastafile.readline()
-                while True:
-                    if not nextline:
-                        break
-                    if nextline[0] == '>':
-                        break
-                    else:
-                        startpos = fastafile.tell()  # i.e. very line that doesn't begin with '>' increments <startpos>
-                    seqlines.append(nextline)
-                    nextline = fastafile.readline()
-                seqline = ''.join([l.strip() for l in seqlines]) if len(seqlines) > 0 else None
-            elif ftype == 'fq':
-                if headline[0] != '@':
-                    raise Exception('invalid fastq header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('@')
-
-                seqline = fastafile.readline()  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
-                plusline = fastafile.readline().strip()
-                if plusline[0] != '+':
-                    raise Exception('invalid fastq quality header in %s:\n    %s' % (fname, plusline))
-                qualityline = fastafile.readline()
-            else:
-                raise Exception('unhandled ftype %s' % ftype)
-
+    with open_possibly_compressed(fname) as fastafile:
+        for headline, seqline in iterate_fastx_records(fastafile, ftype, fname):
             if not seqline:
                 break
 
@@ -4665,7 +5122,7 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
                 if iline < istartstop[0]:
                     continue
                 elif iline >= istartstop[1]:
-                    continue
+                    break
 
             if dont_split_infostrs:  # if this is set, we let the calling fcn handle all the infostr parsing (e.g. for imgt germline fasta files)
                 infostrs = headline
@@ -4689,15 +5146,15 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
                     continue
                 missing_queries.remove(uid)
 
-            seqfo = {name_key : uid, seq_key : seqline.strip().upper()}
+            seqfo = {name_key : uid, seq_key : seqline.upper()}
             if add_info:
                 seqfo['infostrs'] = infostrs
             if sanitize_seqs:
                 seqfo[seq_key] = seqfo[seq_key].translate(ambig_translations)
-                if any(c not in alphabet for c in seqfo[seq_key]):
+                if not alphabet.issuperset(seqfo[seq_key]):
                     unexpected_chars = set([ch for ch in seqfo[seq_key] if ch not in alphabet])
                     raise Exception('unexpected character%s %s (not among %s) in input sequence with id %s:\n  %s' % (plural(len(unexpected_chars)), ', '.join([('\'%s\'' % ch) for ch in unexpected_chars]), alphabet, seqfo[name_key], seqfo[seq_key]))
-            finfo.append(seqfo)
+            yield seqfo
 
             n_fasta_queries += 1
             if n_max_queries > 0 and n_fasta_queries >= n_max_queries:
@@ -4705,9 +5162,23 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
             if queries is not None and len(missing_queries) == 0:
                 break
 
+# ----------------------------------------------------------------------------------------
+def iter_fastx_chunks(fname, chunk_size, **kwargs):  # yield lists of (up to) <chunk_size> seqfos (kwargs are passed to iter_fastx())
+    chunk = []
+    for seqfo in iter_fastx(fname, **kwargs):
+        chunk.append(seqfo)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+# ----------------------------------------------------------------------------------------
+def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize_uids=False, sanitize_seqs=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):
+    finfo = list(iter_fastx(fname, name_key=name_key, seq_key=seq_key, add_info=add_info, dont_split_infostrs=dont_split_infostrs, sanitize_uids=sanitize_uids, sanitize_seqs=sanitize_seqs,
+                            queries=queries, n_max_queries=n_max_queries, istartstop=istartstop, ftype=ftype))
     if n_random_queries is not None:
         finfo = numpy.random.choice(finfo, n_random_queries, replace=False)
-
     return finfo
 
 # ----------------------------------------------------------------------------------------
@@ -4930,29 +5401,8 @@ def run_vsearch(action, seqdict, workdir, threshold, match_mismatch='2:-4', no_i
         for name, seq in seqdict.items():
             fastafile.write('>' + name + '\n' + seq + '\n')
 
-    # figure out which vsearch binary to use
-    if vsearch_binary is None:
-        vsearch_binary = os.path.dirname(os.path.realpath(__file__)).replace('/python', '') + '/bin'
-        if platform.system() == 'Linux':
-            vsearch_binary += '/vsearch-2.4.3-linux-x86_64'
-        elif platform.system() == 'Darwin':
-            vsearch_binary += '/vsearch-2.4.3-macos-x86_64'
-        else:
-            raise Exception('%s no vsearch binary in bin/ for platform \'%s\' (you can specify your own full vsearch path with --vsearch-binary)' % (color('red', 'error'), platform.system()))
-
     # build command
-    cmd = vsearch_binary
-    cmd += ' --id ' + str(1. - threshold)  # reject if identity lower than this
-    match, mismatch = [int(m) for m in match_mismatch.split(':')]
-    assert mismatch < 0  # if you give it a positive one it doesn't complain, so presumably it's actually using that positive  (at least for v identification it only makes a small difference, but vsearch's default is negative)
-    cmd += ' --match %d'  % match  # default 2
-    cmd += ' --mismatch %d' % mismatch  # default -4
-    # cmd += ' --gapext %dI/%dE' % (2, 1)  # default: (2 internal)/(1 terminal)
-    # it would be nice to clean this up
-    gap_open = 1000 if no_indels else 50
-    cmd += ' --gapopen %dI/%dE' % (gap_open, 2)  # default: (20 internal)/(2 terminal)
-    if minseqlength is not None:
-        cmd += ' --minseqlength %d' % minseqlength
+    cmd = get_vsearch_cmd_prefix(threshold, match_mismatch=match_mismatch, no_indels=no_indels, minseqlength=minseqlength, vsearch_binary=vsearch_binary)
     if action == 'cluster':
         outfname = workdir + '/vsearch-clusters.txt'
         cmd += ' --cluster_fast ' + infname
@@ -4982,7 +5432,7 @@ def run_vsearch(action, seqdict, workdir, threshold, match_mismatch='2:-4', no_i
     }]
 
     # run
-    run_cmds(cmdfos)
+    run_cmds(cmdfos, retry_fcn=retry_killed_procs)
 
     # read output
     if action == 'cluster':
@@ -5011,6 +5461,57 @@ def run_vsearch(action, seqdict, workdir, threshold, match_mismatch='2:-4', no_i
 
     return returnfo
 
+# ----------------------------------------------------------------------------------------
+def get_vsearch_cmd_prefix(threshold, match_mismatch='2:-4', no_indels=False, minseqlength=None, vsearch_binary=None):  # binary plus the options that are the same for all actions
+    # figure out which vsearch binary to use
+    if vsearch_binary is None:
+        vsearch_binary = os.path.dirname(os.path.realpath(__file__)).replace('/python', '') + '/bin'
+        if platform.system() == 'Linux':
+            vsearch_binary += '/vsearch-2.4.3-linux-x86_64'
+        elif platform.system() == 'Darwin':
+            vsearch_binary += '/vsearch-2.4.3-macos-x86_64'
+        else:
+            raise Exception('%s no vsearch binary in bin/ for platform \'%s\' (you can specify your own full vsearch path with --vsearch-binary)' % (color('red', 'error'), platform.system()))
+
+    cmd = vsearch_binary
+    cmd += ' --id ' + str(1. - threshold)  # reject if identity lower than this
+    match, mismatch = [int(m) for m in match_mismatch.split(':')]
+    assert mismatch < 0  # if you give it a positive one it doesn't complain, so presumably it's actually using that positive  (at least for v identification it only makes a small difference, but vsearch's default is negative)
+    cmd += ' --match %d'  % match  # default 2
+    cmd += ' --mismatch %d' % mismatch  # default -4
+    # cmd += ' --gapext %dI/%dE' % (2, 1)  # default: (2 internal)/(1 terminal)
+    # it would be nice to clean this up
+    gap_open = 1000 if no_indels else 50
+    cmd += ' --gapopen %dI/%dE' % (gap_open, 2)  # default: (20 internal)/(2 terminal)
+    if minseqlength is not None:
+        cmd += ' --minseqlength %d' % minseqlength
+    return cmd
+
+# ----------------------------------------------------------------------------------------
+def run_vsearch_clusters(seqdicts, workdir, threshold, n_procs=1, vsearch_binary=None, **kwargs):  # run 'cluster' action on each of <seqdicts> (i.e. same as calling run_vsearch('cluster', ...) for each), with up to <n_procs> vsearch processes at once, returning list of partitions
+    n_threads = max(1, multiprocessing.cpu_count() / max(1, min(n_procs, len(seqdicts))))  # divide up the cores among the simultaneous procs (vsearch uses all of them by default)
+    cmdfos = []
+    for iclust, seqdict in enumerate(seqdicts):
+        subworkdir = '%s/cluster-%d' % (workdir, iclust)
+        prep_dir(subworkdir)
+        infname, outfname = subworkdir + '/input.fa', subworkdir + '/vsearch-clusters.txt'
+        with open(infname, 'w') as fastafile:
+            for name, seq in seqdict.items():
+                fastafile.write('>' + name + '\n' + seq + '\n')
+        cmd = get_vsearch_cmd_prefix(threshold, vsearch_binary=vsearch_binary, **kwargs)
+        cmd += ' --cluster_fast %s --uc %s --threads %d --quiet' % (infname, outfname, n_threads)
+        cmdfos.append({'cmd_str' : cmd, 'outfname' : outfname, 'workdir' : subworkdir, 'workfnames' : [infname]})
+    run_cmds(cmdfos, n_max_procs=n_procs, retry_fcn=retry_killed_procs)
+    partitions = []
+    for cmdfo in cmdfos:
+        partitions.append(read_vsearch_cluster_file(cmdfo['outfname']))
+        for fname in cmdfo['workfnames'] + [cmdfo['outfname']]:
+            os.remove(fname)
+        os.rmdir(cmdfo['workdir'])
+    if len(seqdicts) > 0 and os.path.isdir(workdir) and len(os.listdir(workdir)) == 0:
+        os.rmdir(workdir)
+    return partitions
+
 # ----------------------------------------------------------------------------------------
 def run_swarm(seqs, workdir, differences=1, n_procs=1):
     # groups together all sequence pairs that have <d> or fewer differences (--differences, default 1)
@@ -5174,7 +5675,7 @@ def write_annotations(fname, glfo, annotation_list, headers, synth_single_seqs=F
     if getsuffix(fname) == '.csv':
         assert partition_lines is None
         write_csv_annotations(fname, headers, annotation_list, synth_single_seqs=synth_single_seqs, glfo=glfo, failed_queries=failed_queries)
-    elif getsuffix(fname) == '.yaml':
+    elif getsuffix(fname) in ['.yaml', columnarfile.suffix]:
         if partition_lines is None:
             partition_lines = clusterpath.ClusterPath(partition=get_partition_from_annotation_list(annotation_list)).get_partition_lines(True)  # setting is_data to True here since we can't pass in reco_info and whatnot anyway
         write_yaml_output(fname, headers, glfo=glfo, annotation_list=annotation_list, synth_single_seqs=synth_single_seqs, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=use_pyyaml, dont_write_git_info=dont_write_git_info)
@@ -5229,6 +5730,9 @@ def write_yaml_output(fname, headers, glfo=None, annotation_list=None, synth_sin
                 'germline-info' : glfo,
                 'partitions' : partition_lines,
                 'events' : yaml_annotations}
+    if getsuffix(fname) == columnarfile.suffix:  # same info, but laid out so it can be read lazily by column and/or event
+        columnarfile.write_columnar_file(fname, yamldata)
+        return
     with open(fname, 'w') as yamlfile:
         if use_pyyaml:  # slower, but easier to read by hand for debugging (use this instead of the json version to make more human-readable files)
             yaml.dump(yamldata, yamlfile, width=400, Dumper=Dumper, default_flow_style=False, allow_unicode=False)  # set <allow_unicode> to false so the file isn't cluttered up with !!python.unicode stuff
@@ -5245,7 +5749,7 @@ def parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_
             if 'all_matches' in line and isinstance(line['all_matches'], dict):  # it used to be per-family, but then I realized it should be per-sequence, so any old cache files lying around have it as per-family
                 line['all_matches'] = [line['all_matches']]  # also, yes, it makes me VERY ANGRY that this needs to be here, but i just ran into a couple of these old files and otherwise they cause crashes
             if not dont_add_implicit_info:  # it's kind of slow, although most of the time you probably want all the extra info
-                add_implicit_info(glfo, line)  # don't use the germline info in <yamlfo>, in case we decide we want to modify it in the calling fcn
+                line = LazyAnnotation(glfo, line)  # implicit info gets added the first time it's needed NOTE don't use the germline info in <yamlfo>, in case we decide we want to modify it in the calling fcn
         if synth_single_seqs and len(line['unique_ids']) > 1:
             for iseq in range(len(line['unique_ids'])):
                 annotation_list.append(synthesize_single_seq_line(line, iseq))
@@ -5292,7 +5796,7 @@ def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_impli
                     if n_max_queries > 0 and n_queries_read >= n_max_queries:
                         break
 
-    elif getsuffix(fname) == '.yaml':  # NOTE this replaces any <glfo> that was passed (well, only within the local name table of this fcn, unless the calling fcn replaces it themselves, since we return this glfo)
+    elif getsuffix(fname) in ['.yaml', columnarfile.suffix]:  # NOTE this replaces any <glfo> that was passed (well, only within the local name table of this fcn, unless the calling fcn replaces it themselves, since we return this glfo)
         glfo, annotation_list, cpath = read_yaml_output(fname, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs,
                                                         dont_add_implicit_info=dont_add_implicit_info, seed_unique_id=seed_unique_id, cpath=cpath, skip_annotations=skip_annotations, debug=debug)
     else:
@@ -5328,7 +5832,11 @@ def read_json_yaml(fname):  # try to read <fname> as json (since it's faster), o
 
 # ----------------------------------------------------------------------------------------
 def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, debug=False):
-    yamlfo = read_json_yaml(fname)
+    if getsuffix(fname) == columnarfile.suffix:  # events are read lazily from the columnar file as we iterate over them (so e.g. with <skip_annotations> or <n_max_queries> we don't read most of the file)
+        colfile = columnarfile.ColumnarFile(fname)
+        yamlfo = {'version-info' : colfile.version_info, 'germline-info' : colfile.glfo, 'partitions' : colfile.partition_lines, 'events' : colfile.iter_events()}
+    else:
+        yamlfo = read_json_yaml(fname)
     if debug:
         print '  read yaml version %s from %s' % (yamlfo['version-info']['partis-yaml'], fname)
 
@@ -1,8 +1,10 @@
 import time
 import copy
+import collections
 import sys
 import math
 import os
+import errno
 import itertools
 import operator
 import pysam
@@ -11,6 +13,8 @@ from collections import OrderedDict
 import csv
 import numpy
 import traceback
+import json
+import hashlib
 
 import utils
 import glutils
@@ -50,6 +54,9 @@ class Waterer(object):
         self.vs_info = vs_info
 
         self.absolute_max_insertion_length = 120  # but if it's longer than this, we always skip the annotation
+        self.n_max_sw_rounds = 3  # max number of times we run ig-sw on any one query (we rerun queries with indels, or that failed for other reasons after indel reruns)
+        self.chunks_per_proc = 4  # when we're not on a batch system, we split queries into about this many chunks per proc, so procs that finish early can pick up more work
+        self.min_chunk_size = 20
 
         self.gap_open_penalty = self.args.gap_open_penalty  # not modifying it now, but just to make sure we don't in the future
         self.match_score = 5  # see commented table above ^
@@ -95,24 +102,134 @@ class Waterer(object):
         if self.vs_info is not None:  # if we're reading a cache file, we should make sure to read the exact same info from there
             self.add_vs_indels()
 
-        itry = 0
-        while True:  # if we're not running vsearch, we still gotta run twice to get shm indeld sequences
-            mismatches, gap_opens, queries_for_each_proc = self.split_queries(self.args.n_procs)  # NOTE can tell us to run more than <self.args.n_procs> (we run at least one proc for each different mismatch score)
-            self.write_input_files(base_infname, queries_for_each_proc)
+        new_queries = set(self.remaining_queries)  # queries for which we actually run sw (i.e. that aren't in the alignment store)
+        if self.args.sw_alignment_store_fname is not None:
+            self.read_alignment_store()
+            new_queries &= self.remaining_queries
+
+        processing_time = 0.
+        self.ig_sw_time = 0.
+        if len(self.remaining_queries) == 0:
+            pass
+        elif self.args.batch_system is None:
+            processing_time = self.run_work_queue(base_infname, base_outfname)
+        else:  # on a batch system it's better to submit one big job per proc each time through
+            itry = 0
+            while True:  # if we're not running vsearch, we still gotta run twice to get shm indeld sequences
+                mismatches, gap_opens, queries_for_each_proc = self.split_queries(self.args.n_procs)  # NOTE can tell us to run more than <self.args.n_procs> (we run at least one proc for each different mismatch score)
+                self.write_input_files(base_infname, queries_for_each_proc)
+
+                print '    running %d proc%s for %d seq%s' % (len(mismatches), utils.plural(len(mismatches)), len(self.remaining_queries), utils.plural(len(self.remaining_queries)))
+                sys.stdout.flush()
+                self.execute_commands(base_infname, base_outfname, mismatches, gap_opens)
+
+                processing_start = time.time()
+                self.read_output(base_outfname, len(mismatches))
+                processing_time = time.time() - processing_start
+
+                if itry >= self.n_max_sw_rounds - 1 or len(self.indel_reruns) == 0:
+                    break
+                itry += 1
 
-            print '    running %d proc%s for %d seq%s' % (len(mismatches), utils.plural(len(mismatches)), len(self.remaining_queries), utils.plural(len(self.remaining_queries)))
-            sys.stdout.flush()
-            self.execute_commands(base_infname, base_outfname, mismatches, gap_opens)
+        processing_start = time.time()
+        if self.args.sw_alignment_store_fname is not None:
+            self.write_alignment_store(new_queries)
+        self.finalize(cachefname)
+        print '    water time: %.1f  (ig-sw %.1f  processing %.1f)' % (time.time() - start, self.ig_sw_time, processing_time + time.time() - processing_start)
 
-            processing_start = time.time()
-            self.read_output(base_outfname, len(mismatches))
+    # ----------------------------------------------------------------------------------------
+    def run_work_queue(self, base_infname, base_outfname):
+        """
+        Run ig-sw on small chunks of queries, keeping up to <self.args.n_procs> procs going at once: whenever a proc finishes we start the next chunk, then read the finished chunk's output while the others are running.
+        Queries that need indel reruns are queued as soon as their chunk is read (rather than waiting for every proc to finish).
+        Queries that fail for other reasons are only rerun (in the next round, and only if there were indel reruns in this round, to match what happens with the batch system loop) if they were run with the no-indel gap open penalty, since otherwise ig-sw would give the same result.
+        Returns total time spent reading output.
+        """
+        start = time.time()
+        n_procs = self.args.n_procs
+        chunk_size = max(self.min_chunk_size, int(math.ceil(len(self.remaining_queries) / float(self.chunks_per_proc * n_procs))))
+        chunk_queue = collections.deque()  # each entry: (iround, mismatch, gap open, list of queries)
+        n_unfinished = [0 for _ in range(self.n_max_sw_rounds)]  # number of chunks in each round that are queued or running
+        rounds_finished = [False for _ in range(self.n_max_sw_rounds)]
+        had_indel_reruns = [False for _ in range(self.n_max_sw_rounds)]
+        normal_gap_reruns = [[] for _ in range(self.n_max_sw_rounds)]  # queries to rerun with the normal gap open in each round (if there were indel reruns in the previous round)
 
-            if itry > 1 or len(self.indel_reruns) == 0:
-                break
-            itry += 1
+        # ----------------------------------------------------------------------------------------
+        def queue_queries(iround, queries, gap_open):
+            for mqueries in utils.group_seqs_by_value(queries, self.get_mismatch):
+                for istart in range(0, len(mqueries), chunk_size):
+                    chunk_queue.append((iround, self.get_mismatch(mqueries[0]), gap_open, mqueries[istart : istart + chunk_size]))
+                    n_unfinished[iround] += 1
 
-        self.finalize(cachefname)
-        print '    water time: %.1f  (ig-sw %.1f  processing %.1f)' % (time.time() - start, time.time() - processing_start, self.ig_sw_time)
+        # ----------------------------------------------------------------------------------------
+        def start_chunk(ichunk, chunkfo):
+            _, mismatch, gap_open, queries = chunkfo
+            workdir = '%s/sw-%d' % (self.args.workdir, ichunk)
+            utils.prep_dir(workdir)
+            self.write_input_file(workdir + '/' + base_infname, queries)
+            cmdfo = {'cmd_str' : self.get_ig_sw_cmd_str(workdir, base_infname, base_outfname, mismatch, gap_open),
+                     'workdir' : workdir,
+                     'logdir' : workdir,
+                     'outfname' : workdir + '/' + base_outfname}
+            return {'proc' : utils.run_cmd(cmdfo), 'cmdfo' : cmdfo, 'chunkfo' : chunkfo}
+
+        # ----------------------------------------------------------------------------------------
+        def finish_chunk(runfo):
+            iround, _, gap_open, queries = runfo['chunkfo']
+            cmdfo = runfo['cmdfo']
+            utils.finish_process(0, [runfo['proc']], 1, cmdfo, 1)  # raises an exception if it failed
+            os.remove(cmdfo['workdir'] + '/' + base_infname)
+            queries_read_from_file = self.read_sam_file(cmdfo['outfname'])
+            os.remove(cmdfo['outfname'])
+            os.rmdir(cmdfo['workdir'])  # finish_process() already removed the log files
+
+            not_read = (set(queries) & self.remaining_queries) - queries_read_from_file
+            if len(not_read) > 0:  # see note in read_output()
+                print '\n%s didn\'t read %s from %s' % (utils.color('red', 'warning'), ' '.join(not_read), cmdfo['workdir'])
+
+            indel_reruns = [q for q in queries if q in self.indel_reruns]
+            if len(indel_reruns) > 0:
+                had_indel_reruns[iround] = True
+            if iround + 1 < self.n_max_sw_rounds:
+                self.indel_reruns -= set(indel_reruns)  # leave them in there if we're out of tries (same as the batch system loop)
+                queue_queries(iround + 1, indel_reruns, self.args.no_indel_gap_open_penalty)
+                if gap_open != self.gap_open_penalty:
+                    normal_gap_reruns[iround + 1] += [q for q in queries if q in self.remaining_queries and q not in indel_reruns]
+            n_unfinished[iround] -= 1
+
+            for iround in range(self.n_max_sw_rounds):  # check if we just finished this round (i.e. all its chunks are done, and none can be added because the previous round is also finished)
+                if rounds_finished[iround] or n_unfinished[iround] > 0 or (iround > 0 and not rounds_finished[iround - 1]):
+                    continue
+                rounds_finished[iround] = True
+                if had_indel_reruns[iround] and iround + 1 < self.n_max_sw_rounds:
+                    queue_queries(iround + 1, normal_gap_reruns[iround + 1], self.gap_open_penalty)
+
+        # ----------------------------------------------------------------------------------------
+        queue_queries(0, list(self.remaining_queries), self.gap_open_penalty)
+        n_initial_chunks = len(chunk_queue)
+        print '    running %d proc%s on %d chunk%s of up to %d seqs (%d seq%s)' % (n_procs, utils.plural(n_procs), n_initial_chunks, utils.plural(n_initial_chunks), chunk_size, len(self.remaining_queries), utils.plural(len(self.remaining_queries)))
+        sys.stdout.flush()
+        running, ichunk, processing_time = [], 0, 0.
+        with utils.ChildProcWaiter() as waiter:
+            while len(chunk_queue) > 0 or len(running) > 0:
+                while len(chunk_queue) > 0 and len(running) < n_procs:
+                    running.append(start_chunk(ichunk, chunk_queue.popleft()))
+                    ichunk += 1
+                finished = [running[i] for i, _ in waiter.wait([r['proc'] for r in running])]  # blocks until at least one finishes
+                for runfo in finished:
+                    running.remove(runfo)
+                    while len(chunk_queue) > 0 and len(running) < n_procs:  # start the next one before reading the output
+                        running.append(start_chunk(ichunk, chunk_queue.popleft()))
+                        ichunk += 1
+                    processing_start = time.time()
+                    finish_chunk(runfo)
+                    processing_time += time.time() - processing_start
+
+        if ichunk > n_initial_chunks:
+            print '      reran %d chunk%s' % (ichunk - n_initial_chunks, utils.plural(ichunk - n_initial_chunks))
+        sys.stdout.flush()
+        self.ig_sw_time = time.time() - start
+        return processing_time
 
     # ----------------------------------------------------------------------------------------
     def clean_cache(self, cache_path):
@@ -124,6 +241,82 @@ class Waterer(object):
             print '  removing old sw cache glfo %s-glfo' % cache_path
             glutils.remove_glfo_files(cache_path + '-glfo', self.args.locus)
 
+    # ----------------------------------------------------------------------------------------
+    def get_alignment_store_key(self, query):  # content-based key for --sw-alignment-store-fname: hash of germline set, sequence, and everything else that determines the sw result
+        if not hasattr(self, 'glfo_hash'):
+            glstrs = [self.args.locus] + ['%s:%s' % (g, self.glfo['seqs'][r][g]) for r in utils.regions for g in sorted(self.glfo['seqs'][r])]
+            glstrs += ['%s:%s' % (g, self.glfo[c + '-positions'][g]) for c in sorted(utils.conserved_codons[self.args.locus].values()) for g in sorted(self.glfo[c + '-positions'])]
+            self.glfo_hash = hashlib.md5(' '.join(glstrs)).hexdigest()
+        if not hasattr(self, 'ig_sw_hash'):  # ig-sw doesn't have a version, so use the binary's contents (so rebuilding it invalidates stored alignments)
+            with open(self.args.ig_sw_binary, 'rb') as swfile:
+                self.ig_sw_hash = hashlib.md5(swfile.read()).hexdigest()
+        paramstr = 'match %d mismatch %d gap-open %d no-indel-gap-open %d max-per-region %s skip-unproductive %s rounds %d max-vj-mut-freq %s ig-sw %s' % (self.match_score, self.get_mismatch(query), self.gap_open_penalty, self.args.no_indel_gap_open_penalty,
+                                                                                                                                                          ':'.join(str(n) for n in self.args.n_max_per_region), self.args.skip_unproductive, self.n_max_sw_rounds, self.args.max_vj_mut_freq, self.ig_sw_hash)
+        if query in self.vs_indels:  # the vsearch indel changes the sequence we pass to ig-sw
+            paramstr += ' vsearch-indel-reversed-seq %s' % self.info['indels'][query]['reversed_seq']
+        return hashlib.md5(' '.join([self.glfo_hash, paramstr, self.input_info[query]['seqs'][0]])).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def read_alignment_store(self):  # add info for any remaining queries whose alignments are already in --sw-alignment-store-fname (each line in the file is a key, then a tab, then the json sw cache info for that sequence)
+        fname = self.args.sw_alignment_store_fname
+        if not os.path.exists(fname):
+            print '        sw alignment store %s doesn\'t exist yet, will create it' % fname
+            return
+        start = time.time()
+        key_queries = {}
+        for query in self.remaining_queries:
+            key = self.get_alignment_store_key(query)
+            if key not in key_queries:
+                key_queries[key] = []
+            key_queries[key].append(query)
+        n_lines = 0
+        with open(fname) as storefile:
+            for fline in storefile:
+                n_lines += 1
+                key, jsonstr = fline.rstrip('\n').split('\t', 1)
+                if key not in key_queries:  # most of the time we don't need to parse the json at all
+                    continue
+                for query in key_queries.pop(key):  # if there's more than one (i.e. duplicate sequences), they get collapsed later, same as if we'd run sw
+                    line = json.loads(jsonstr)
+                    line['unique_ids'] = [query]
+                    line['duplicates'] = [self.duplicates.get(query, [])]
+                    utils.transfer_indel_reversed_seqs(line)
+                    utils.add_implicit_info(self.glfo, line, aligned_gl_seqs=self.aligned_gl_seqs)
+                    if indelutils.has_indels(line['indelfos'][0]):
+                        self.info['indels'][query] = line['indelfos'][0]
+                    self.add_to_info(line)
+        n_found = len(self.info['passed-queries'])
+        print '        read %d / %d sequences from sw alignment store %s (%d entries in %.1f sec)' % (n_found, n_found + len(self.remaining_queries), fname, n_lines, time.time() - start)
+
+    # ----------------------------------------------------------------------------------------
+    def write_alignment_store(self, new_queries):  # append alignments for newly-run queries to --sw-alignment-store-fname (before finalize() does any trimming, padding, duplicate removal, etc.)
+        fname = self.args.sw_alignment_store_fname
+        queries_to_write = [q for q in self.input_info if q in new_queries and q in self.info['passed-queries']]  # NOTE failed queries (and skipped unproductive ones) aren't written, so they'll get rerun each time
+        if len(queries_to_write) == 0:
+            return
+        utils.prep_dir(dirname=None, fname=fname, allow_other_files=True)
+        lockfname = fname + '.lock'
+        while True:
+            try:
+                lockfd = os.open(lockfname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)  # atomic, so only one process can get the lock
+                break
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+                print '  waiting for lock on %s' % lockfname
+                time.sleep(0.5)
+        try:
+            with open(fname, 'a') as storefile:
+                for query in queries_to_write:
+                    outline = utils.get_yamlfo_for_output(self.info[query], utils.sw_cache_headers, glfo=self.glfo)
+                    for key in ['unique_ids', 'duplicates']:  # these are set when we read it
+                        del outline[key]
+                    storefile.write('%s\t%s\n' % (self.get_alignment_store_key(query), json.dumps(outline)))
+        finally:
+            os.close(lockfd)
+            os.remove(lockfname)
+        print '        appended %d new sequence%s to sw alignment store %s' % (len(queries_to_write), utils.plural(len(queries_to_write)), fname)
+
     # ----------------------------------------------------------------------------------------
     def read_cachefile(self, cachefname):
         start = time.time()
@@ -297,27 +490,30 @@ class Waterer(object):
                    'workdir' : self.subworkdir(iproc, n_procs),
                    'outfname' : self.subworkdir(iproc, n_procs) + '/' + base_outfname}
                   for iproc in range(n_procs)]
-        utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname)
+        proc_records = utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, retry_fcn=utils.retry_killed_procs if self.args.batch_system is None else None)
+        if self.args.debug:
+            print '      ig-sw %s' % utils.proc_records_str(proc_records)
 
         for iproc in range(n_procs):
             os.remove(self.subworkdir(iproc, n_procs) + '/' + base_infname)
         sys.stdout.flush()
         self.ig_sw_time = time.time() - start
 
+    # ----------------------------------------------------------------------------------------
+    def get_mismatch(self, query):
+        if self.vs_info is None:
+            return self.mismatch
+        mfreq_q = self.vs_info['annotations'][query]['v_mut_freq'] if query in self.vs_info['annotations'] else self.default_mfreq
+        def keyfunc(pair):
+            mf, mm = pair
+            return abs(mf - mfreq_q)
+        nearest_mfreq, nearest_mismatch = min(self.mfreq_mismatch_vals, key=keyfunc)  # take the optimized value whose mfreq is closest to this sequence's mfreq
+        return nearest_mismatch
+
     # ----------------------------------------------------------------------------------------
     def split_queries_by_match_mismatch(self, input_queries, n_procs, debug=False):
-        def get_query_mfreq(q):
-            return self.vs_info['annotations'][q]['v_mut_freq'] if q in self.vs_info['annotations'] else self.default_mfreq
-        def best_mismatch(q):
-            mfreq_q = self.vs_info['annotations'][q]['v_mut_freq'] if q in self.vs_info['annotations'] else self.default_mfreq
-            def keyfunc(pair):
-                mf, mm = pair
-                return abs(mf - mfreq_q)
-            nearest_mfreq, nearest_mismatch = min(self.mfreq_mismatch_vals, key=keyfunc)  # take the optimized value whose mfreq is closest to this sequence's mfreq
-            return nearest_mismatch
-
-        query_groups = utils.group_seqs_by_value(input_queries, best_mismatch)
-        mismatch_vals = [best_mismatch(queries[0]) for queries in query_groups]
+        query_groups = utils.group_seqs_by_value(input_queries, self.get_mismatch)
+        mismatch_vals = [self.get_mismatch(queries[0]) for queries in query_groups]
 
         # note: it'd be nice to be able to give ig-sw a different match:mismatch for each sequence (rather than running separate procs for each match:mismatch), but it initializes a matrix using the match:mismatch values before looping over sequences, so that's probably infeasible
 
@@ -393,14 +589,18 @@ class Waterer(object):
             workdir = self.subworkdir(iproc, n_procs)
             if n_procs > 1:
                 utils.prep_dir(workdir)
-            with open(workdir + '/' + base_infname, 'w') as sub_infile:
-                for query_name in queries_for_each_proc[iproc]:
-                    if query_name in self.info['indels']:
-                        seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
-                    else:
-                        assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here (where "it's nice" means "it used to be the other way and it fucking sucked and a fuckton of effort went into synchronizing the treatments")
-                        seq = self.input_info[query_name]['seqs'][0]
-                    sub_infile.write('>%s NUKES\n%s\n' % (query_name, seq))
+            self.write_input_file(workdir + '/' + base_infname, queries_for_each_proc[iproc])
+
+    # ----------------------------------------------------------------------------------------
+    def write_input_file(self, fname, queries):
+        with open(fname, 'w') as sub_infile:
+            for query_name in queries:
+                if query_name in self.info['indels']:
+                    seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
+                else:
+                    assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here (where "it's nice" means "it used to be the other way and it fucking sucked and a fuckton of effort went into synchronizing the treatments")
+                    seq = self.input_info[query_name]['seqs'][0]
+                sub_infile.write('>%s NUKES\n%s\n' % (query_name, seq))
 
     # # ----------------------------------------------------------------------------------------
     # def get_vdjalign_cmd_str(self, workdir, base_infname, base_outfname, mismatch):
@@ -477,18 +677,7 @@ class Waterer(object):
 
         queries_read_from_file = set()  # should be able to remove this, eventually
         for iproc in range(n_procs):
-            outfname = self.subworkdir(iproc, n_procs) + '/' + base_outfname
-            # self.remove_length_discrepant_matches(outfname)
-            with contextlib.closing(pysam.Samfile(outfname)) as sam:  # changed bam to sam because ig-sw outputs sam files
-                grouped = itertools.groupby(iter(sam), operator.attrgetter('qname'))
-                for _, reads in grouped:  # loop over query sequences
-                    try:
-                        readlist = list(reads)
-                    except:  # should no longer happen (was a result of pysam barfing when ig-sw gave it cigar and query sequences that were different lengths, but now ig-sw should skip matches for which that's true) it would be better if ig-sw didn't make those matches to start with, but that would require understanding a lot more about ig-sw
-                        raise Exception('failed to convert sam reads')
-                    qinfo = self.read_query(sam.references, readlist)
-                    self.summarize_query(qinfo)  # returns before adding to <self.info> if it thinks we should rerun the query
-                    queries_read_from_file.add(qinfo['name'])
+            queries_read_from_file |= self.read_sam_file(self.subworkdir(iproc, n_procs) + '/' + base_outfname)
 
         not_read = self.remaining_queries - queries_read_from_file
         if len(not_read) > 0:  # ig-sw (now) doesn't write matches for cases in which cigar and read length differ, which means there are now queries for which it finds zero matches (well, it didn't seem to happen before... but not sure that it couldn't have)
@@ -502,6 +691,22 @@ class Waterer(object):
 
         sys.stdout.flush()
 
+    # ----------------------------------------------------------------------------------------
+    def read_sam_file(self, outfname):  # returns set of queries that were in the file
+        queries_read_from_file = set()
+        # self.remove_length_discrepant_matches(outfname)
+        with contextlib.closing(pysam.Samfile(outfname)) as sam:  # changed bam to sam because ig-sw outputs sam files
+            grouped = itertools.groupby(iter(sam), operator.attrgetter('qname'))
+            for _, reads in grouped:  # loop over query sequences
+                try:
+                    readlist = list(reads)
+                except:  # should no longer happen (was a result of pysam barfing when ig-sw gave it cigar and query sequences that were different lengths, but now ig-sw should skip matches for which that's true) it would be better if ig-sw didn't make those matches to start with, but that would require understanding a lot more about ig-sw
+                    raise Exception('failed to convert sam reads')
+                qinfo = self.read_query(sam.references, readlist)
+                self.summarize_query(qinfo)  # returns before adding to <self.info> if it thinks we should rerun the query
+                queries_read_from_file.add(qinfo['name'])
+        return queries_read_from_file
+
     # ----------------------------------------------------------------------------------------
     def remove_query(self, query):
         # NOTE you're iterating over a deep copy of <self.info['queries']>, right? you better be!
@@ -1320,32 +1525,37 @@ class Waterer(object):
         # ----------------------------------------------------------------------------------------
         def get_long_seqs(tdbg=False):
             long_seqs, seq_classes = {}, {}  # <long_seqs>: map from each long/kept seq to its uid, <seq_classes>: map from each long/kept seq to the list of uids in its class
+            cdr3_indices = {}  # substring index of the long seqs for each cdr3 length, so we only have to look at the ones that contain (or are contained in) each new seq
+            lseq_order, lseq_counter = {}, itertools.count()  # order in which each long seq was added (for choosing among several matches)
             for uid in self.info['queries']:
                 useq = getseq(uid)
                 found, switch = False, False
                 if uid in pre_kept_uids:  # NOTE that if two pre-kept queries have the same seq, we'll just keep whichever one is last, which isn't really right but oh well
                     switch = True
-                for lseq, lid in long_seqs.items():
-                    if self.info[lid]['cdr3_length'] != self.info[uid]['cdr3_length']:
-                        continue
+                sindex = cdr3_indices.setdefault(self.info[uid]['cdr3_length'], utils.SubstringIndex())
+                matches = sindex.containing(useq) | sindex.contained(useq)
+                if len(matches) > 0:  # if there's more than one, use the one that was added first
+                    found = True
+                    lseq = list(matches)[0] if len(matches) == 1 else min(matches, key=lseq_order.get)
+                    lid = long_seqs[lseq]
                     if useq in lseq:  # if lseq is longer (or they're the same), keep the one that's in there (lseq)
-                        found = True
                         if uid in pre_kept_uids and len(useq) < len(lseq) and lid not in pre_kept_uids:
                             print '  %s pre-included query \'%s\' is being kept, but has shorter sequence than \'%s\', which we\'re marking as duplicate:\n    %s %s\n    %s %s' % (utils.color('yellow', 'warning'), uid, lid, useq, uid, lseq, lid)
-                        break
-                    elif lseq in useq:  # but useq is longer, we need to switch to useq
-                        found = True
+                    else:  # but useq is longer, we need to switch to useq
                         switch = True
-                        break
                 if found:
                     if switch:
                         long_seqs[useq] = uid
+                        lseq_order.setdefault(useq, next(lseq_counter))
                         seq_classes[useq] = seq_classes[lseq] + [uid]
                         if tdbg:
                             print '  %s --> %s (%s)' % (lid, uid, ' '.join(seq_classes[useq]))
                         if lseq != useq:  # if they're the same this must be a pre-kept query
                             del long_seqs[lseq]
+                            del lseq_order[lseq]
                             del seq_classes[lseq]
+                            sindex.remove(lseq)
+                            sindex.add(useq)
                     else:
                         seq_classes[lseq].append(uid)
                         if tdbg:
@@ -1355,7 +1565,9 @@ class Waterer(object):
                         print '  new: %s' % uid
                     assert useq not in long_seqs
                     long_seqs[useq] = uid
+                    lseq_order[useq] = next(lseq_counter)
                     seq_classes[useq] = [uid]
+                    sindex.add(useq)
             lkseqs = {u : lseq for lseq, uids in seq_classes.items() for u in uids}  # map from each uid to its 'keyseq', i.e. the longest seq that contains its seq
             return long_seqs, lkseqs
 
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import random
+import unittest
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/test', '')
+sys.path.insert(1, partis_dir + '/python')
+
+from clusterpath import ClusterPath, MergeLogPartitions
+
+# ----------------------------------------------------------------------------------------
+def random_path(n_uids, n_steps, non_hierarchical_frac=0.1):  # list of partitions, mostly made by merging clusters in the previous one, but sometimes reshuffling the uids within a cluster (so it can't be encoded as merges)
+    partition = [[u] for u in ['u%d' % i for i in range(n_uids)]]
+    partitions = [partition]
+    for _ in range(n_steps):
+        partition = [list(c) for c in partition]
+        random.shuffle(partition)
+        if random.random() < non_hierarchical_frac and any(len(c) > 1 for c in partition):
+            random.shuffle([c for c in partition if len(c) > 1][0])
+        while len(partition) > 1 and random.random() < 0.5:
+            cluster = partition.pop()
+            partition[random.randrange(len(partition))] += cluster
+        partitions.append(partition)
+    return partitions
+
+# ----------------------------------------------------------------------------------------
+class TestMergeLogPartitions(unittest.TestCase):
+    # ----------------------------------------------------------------------------------------
+    def setUp(self):
+        random.seed(1)
+
+    # ----------------------------------------------------------------------------------------
+    def test_append_pop_setitem(self):
+        for _ in range(200):
+            ref = random_path(random.randint(1, 30), random.randint(1, 30))
+            mlp = MergeLogPartitions(snapshot_interval=random.randint(1, 5), n_cached=random.randint(1, 3))
+            for partition in ref:
+                mlp.append(partition)
+            self.assertEqual(list(mlp), ref)
+            for _ in range(10):
+                ip = random.randrange(-len(ref), len(ref))
+                self.assertEqual(mlp[ip], ref[ip])
+
+            rm_uid = random.choice([u for c in ref[0] for u in c])  # remove a uid from every partition, the way utils.read_yaml_output() removes failed queries
+            for ip in range(len(ref)):
+                new_partition = [[u for u in c if u != rm_uid] for c in mlp[ip]]
+                ref[ip] = [c for c in new_partition if len(c) > 0]
+                mlp[ip] = ref[ip]
+                self.assertEqual(list(mlp), ref)
+
+            ip = random.randrange(len(ref))
+            self.assertEqual(mlp.pop(ip), ref.pop(ip))
+            self.assertEqual(list(mlp), ref)
+
+    # ----------------------------------------------------------------------------------------
+    def test_modifying_returned_partition(self):  # modifying what we get back shouldn't change what's stored, whether or not it's cached
+        ref = random_path(20, 10)
+        mlp = MergeLogPartitions(ref, n_cached=2)
+        for ip in [3, 3, len(ref) - 1]:
+            partition = mlp[ip]
+            partition.pop(0)
+            partition.append(['new-uid'])
+            self.assertEqual(mlp[ip], ref[ip])
+        partition = mlp[3]
+        partition[0] = partition[0] + ['new-uid']
+        mlp[3] = partition
+        self.assertEqual(mlp[3], partition)
+        self.assertEqual([mlp[i] for i in range(len(ref)) if i != 3], [ref[i] for i in range(len(ref)) if i != 3])
+
+    # ----------------------------------------------------------------------------------------
+    def test_readonly_best(self):  # read-only access to the best partition shouldn't copy it
+        ref = random_path(20, 10)
+        cpath = ClusterPath()
+        for ip, partition in enumerate(ref):
+            cpath.add_partition(partition, logprob=float(ip), n_procs=1)
+        self.assertEqual(cpath.best(readonly=True), cpath.best())
+        self.assertIs(cpath.best(readonly=True), cpath.best(readonly=True))
+        self.assertIsNot(cpath.best(), cpath.best())
+
+    # ----------------------------------------------------------------------------------------
+    def test_init_sub_paths(self):  # sub paths should be computed once (on the deduplicated partitions if there's a seed uid), and reset when the path changes
+        ref = random_path(20, 10)
+        cpath = ClusterPath(seed_unique_id='u0')
+        for ip, partition in enumerate(ref):
+            cpath.add_partition(partition, logprob=float(ip), n_procs=1)
+        cpath.init_sub_paths()
+        dedup_partitions = cpath.deduplicate_seed_uid()
+        self.assertEqual(cpath.sub_paths_best_partition, dedup_partitions[cpath.i_best])
+        self.assertEqual(cpath.sub_paths, cpath.get_sub_paths(dedup_partitions, range(len(dedup_partitions[cpath.i_best]))))
+        cpath.deduplicate_seed_uid = None  # make sure a second call uses the cached info
+        sub_paths = cpath.sub_paths
+        cpath.init_sub_paths()
+        self.assertIs(cpath.sub_paths, sub_paths)
+        cpath.add_partition(ref[-1], logprob=float(len(ref)), n_procs=1)
+        self.assertIsNone(cpath.sub_paths)
+        self.assertIsNone(cpath.sub_paths_best_partition)
+
+# ----------------------------------------------------------------------------------------
+class TestCompactPartitionLines(unittest.TestCase):
+    # ----------------------------------------------------------------------------------------
+    def test_round_trip(self):
+        random.seed(2)
+        for _ in range(50):
+            ref = random_path(random.randint(1, 30), random.randint(1, 20))
+            cpath = ClusterPath()
+            for ip, partition in enumerate(ref):
+                cpath.add_partition(partition, logprob=float(ip), n_procs=1)
+            full_lines = cpath.get_partition_lines(True)
+            compact_lines = json.loads(json.dumps(cpath.get_partition_lines(True, compact=True)))  # go through json, since that's how they're written
+            self.assertTrue(all('partition' in l for l in full_lines))
+            self.assertTrue('partition' in compact_lines[0])
+            new_cpath = ClusterPath(partition_lines=compact_lines)
+            self.assertEqual([[[str(u) for u in c] for c in p] for p in new_cpath.partitions], [l['partition'] for l in full_lines])
+            self.assertEqual(new_cpath.i_best, cpath.i_best)
+
+# ----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import os
+import sys
+import math
+import random
+import itertools
+import unittest
+from collections import OrderedDict
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/test', '')
+sys.path.insert(1, partis_dir + '/python')
+
+import utils
+from glomerator import Glomerator
+
+# ----------------------------------------------------------------------------------------
+def reference_naive_seq_glomerate(naive_seqs, n_clusters):  # the original version, which rescans every pair of clusters for each merge
+    clusters = [[names,] for names in naive_seqs.keys()]
+    max_per_cluster = int(math.ceil(float(len(clusters)) / n_clusters))
+    distances = {}
+    def get_clusters_to_merge():
+        smallest_min_distance, clusters_to_merge = None, None
+        for clust_a, clust_b in itertools.combinations(clusters, 2):
+            if len(clust_a) + len(clust_b) > max_per_cluster and not glomerate.merge_whatever_you_got:
+                continue
+            min_distance = None
+            for query_a in clust_a:
+                for query_b in clust_b:
+                    joint_key = query_a + ';' + query_b
+                    if joint_key not in distances:
+                        distances[joint_key] = utils.hamming_fraction(naive_seqs[query_a], naive_seqs[query_b])
+                        distances[query_b + ';' + query_a] = distances[joint_key]
+                    if min_distance is None or distances[joint_key] < min_distance:
+                        min_distance = distances[joint_key]
+            if smallest_min_distance is None or min_distance < smallest_min_distance:
+                smallest_min_distance = min_distance
+                clusters_to_merge = (clust_a, clust_b)
+        return clusters_to_merge
+    def glomerate():
+        clusters_to_merge = get_clusters_to_merge()
+        if clusters_to_merge is None:
+            glomerate.merge_whatever_you_got = True
+        else:
+            clusters.append(clusters_to_merge[0] + clusters_to_merge[1])
+            clusters.remove(clusters_to_merge[0])
+            clusters.remove(clusters_to_merge[1])
+    def homogenize():
+        n_to_keep_in_biggest_cluster = int(math.ceil(float(len(clusters[0]) + len(clusters[-1])) / 2))
+        clusters[0] = clusters[0] + clusters[-1][n_to_keep_in_biggest_cluster : ]
+        clusters[-1] = clusters[-1][ : n_to_keep_in_biggest_cluster]
+        clusters.sort(key=len)
+    glomerate.merge_whatever_you_got = False
+    while len(clusters) > n_clusters:
+        glomerate()
+    if len(clusters) > 1:
+        clusters.sort(key=len)
+        itries = 0
+        while float(len(clusters[-1])) / len(clusters[0]) > 1.1 and len(clusters[-1]) - len(clusters[0]) > 3:
+            homogenize()
+            itries += 1
+            if itries > len(clusters):
+                break
+    return clusters
+
+# ----------------------------------------------------------------------------------------
+class TestNaiveSeqGlomerate(unittest.TestCase):
+    # ----------------------------------------------------------------------------------------
+    def test_against_reference(self):
+        random.seed(1)
+        for _ in range(60):
+            seq_len = random.choice([4, 8, 15])  # short seqs, so there's lots of tied distances
+            ancestors = [''.join(random.choice('ACGT') for _ in range(seq_len)) for _ in range(random.randint(1, 5))]
+            naive_seqs = OrderedDict()
+            for iseq in range(random.randint(2, 40)):
+                seq = list(random.choice(ancestors))
+                for _ in range(random.randint(0, 2)):
+                    seq[random.randrange(seq_len)] = random.choice('ACGTN')
+                naive_seqs['s%d' % iseq] = ''.join(seq)
+            n_clusters = random.randint(1, len(naive_seqs))
+            self.assertEqual(Glomerator().naive_seq_glomerate(naive_seqs, n_clusters), reference_naive_seq_glomerate(naive_seqs, n_clusters))
+
+# ----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
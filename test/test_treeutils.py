@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import os
+import sys
+import math
+import unittest
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/test', '')
+sys.path.insert(1, partis_dir + '/python')
+
+import treeutils
+
+# ----------------------------------------------------------------------------------------
+def reference_lb_values(dtree, tau, multifo, n_tau_lengths=10):  # node-by-node version of the original message passing, with the dummy branch above the root written out explicitly
+    def getmulti(node):
+        return multifo.get(node.taxon.label, 1)
+    nodes = list(dtree.preorder_node_iter())
+    lengths = {n : (n_tau_lengths * tau if n is dtree.seed_node else n.edge.length) for n in nodes}  # the dummy root branch is the seed node's only parent edge (and the dummy root has no parent, so sends nothing down)
+    up, down = {}, {}
+    for node in reversed(nodes):  # children before parents
+        bl = lengths[node] / tau
+        up[node] = math.exp(-bl) * sum(up[c] for c in node.child_node_iter()) + getmulti(node) * tau * (1 - math.exp(-bl))
+    for node in nodes:  # parents before children
+        bl = lengths[node] / tau
+        down[node] = 0. if node is dtree.seed_node else down[node.parent_node] + sum(up[c] for c in node.parent_node.child_node_iter() if c is not node)
+        down[node] = math.exp(-bl) * down[node] + getmulti(node) * tau * (1 - math.exp(-bl))
+    lbvals = {'lbi' : {}, 'lbr' : {}}
+    for node in nodes:
+        child_sum = sum(up[c] for c in node.child_node_iter())
+        lbvals['lbi'][node.taxon.label] = down[node] + child_sum
+        lbvals['lbr'][node.taxon.label] = 0. if node is dtree.seed_node else child_sum / down[node]
+    return lbvals
+
+# ----------------------------------------------------------------------------------------
+class TestLbValues(unittest.TestCase):
+    treestr = '((A:0.01,B:0.02,C:0.0)X:0.005,(D:0.03,(E:0.01,F:0.002)Y:0.02)Z:0.01,G:0.04)R;'  # includes a polytomy and a zero length branch
+    multifo = {'A' : 3, 'E' : 2, 'Y' : 4, 'R' : 2}
+
+    # ----------------------------------------------------------------------------------------
+    def test_against_reference(self):
+        dtree = treeutils.get_dendro_tree(treestr=self.treestr)
+        taufo = {'lbi' : treeutils.default_lb_tau, 'lbr' : treeutils.default_lb_tau * treeutils.default_lbr_tau_factor}
+        for multifo in [None, self.multifo]:
+            lbvals = treeutils.set_lb_values(dtree, taufo, dont_normalize=True, multifo=multifo)
+            for metric, tau in taufo.items():
+                refvals = reference_lb_values(dtree, tau, {} if multifo is None else multifo)[metric]
+                self.assertEqual(set(lbvals[metric]), set(refvals))
+                for label in refvals:
+                    self.assertAlmostEqual(lbvals[metric][label], refvals[label], places=12, msg='%s %s' % (metric, label))
+
+    # ----------------------------------------------------------------------------------------
+    def test_tree_unmodified(self):
+        dtree = treeutils.get_dendro_tree(treestr=self.treestr)
+        before = dtree.as_string(schema='newick')
+        treeutils.set_lb_values(dtree, {'lbi' : treeutils.default_lb_tau}, multifo=self.multifo)
+        self.assertEqual(dtree.as_string(schema='newick'), before)
+
+# ----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import os
+import sys
+import copy
+import unittest
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/test', '')
+sys.path.insert(1, partis_dir + '/python')
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class TestLazyAnnotation(unittest.TestCase):
+    fname = partis_dir + '/test/reference-results/partition-new-simu.yaml'
+
+    # ----------------------------------------------------------------------------------------
+    def read_lines(self):  # return lazy lines, and the same lines with implicit info added eagerly
+        glfo, lazy_lines, _ = utils.read_output(self.fname)
+        _, eager_lines, _ = utils.read_output(self.fname, dont_add_implicit_info=True)
+        for line in eager_lines:
+            if not line['invalid']:
+                utils.add_implicit_info(glfo, line)
+        return glfo, [l for l in lazy_lines if not l['invalid']], [l for l in eager_lines if not l['invalid']]
+
+    # ----------------------------------------------------------------------------------------
+    def test_same_as_eager(self):
+        _, lazy_lines, eager_lines = self.read_lines()
+        self.assertEqual(len(lazy_lines), len(eager_lines))
+        self.assertTrue(all(type(l) == utils.LazyAnnotation for l in lazy_lines))
+        for lline, eline in zip(lazy_lines[:5], eager_lines[:5]):
+            self.assertEqual(lline.copy(), eline)
+        for lline, eline in zip(lazy_lines[5:10], eager_lines[5:10]):
+            self.assertEqual(copy.deepcopy(lline), eline)
+        for lline, eline in zip(lazy_lines[10:15], eager_lines[10:15]):
+            self.assertEqual(sorted(lline.keys()), sorted(eline.keys()))
+            self.assertEqual(dict(lline), eline)  # once implicit info is added, the C-level copy sees everything
+
+    # ----------------------------------------------------------------------------------------
+    def test_glfo_modified_after_reading(self):  # implicit info should use the germline info from when we read the file
+        glfo, lazy_lines, eager_lines = self.read_lines()
+        for region in utils.regions:
+            for gene in glfo['seqs'][region]:
+                glfo['seqs'][region][gene] = 'N' * len(glfo['seqs'][region][gene])
+        for lline, eline in zip(lazy_lines[:5], eager_lines[:5]):
+            self.assertEqual(lline['v_gl_seq'], eline['v_gl_seq'])
+            self.assertEqual(lline.copy(), eline)
+
+# ----------------------------------------------------------------------------------------
+class TestIterFastx(unittest.TestCase):
+    fname = partis_dir + '/test/example.fa'
+
+    # ----------------------------------------------------------------------------------------
+    def test_chunks(self):
+        seqfos = utils.read_fastx(self.fname)
+        for chunk_size in [1, 7, len(seqfos), len(seqfos) + 1]:
+            chunks = list(utils.iter_fastx_chunks(self.fname, chunk_size))
+            self.assertTrue(all(len(c) == chunk_size for c in chunks[:-1]))
+            self.assertTrue(0 < len(chunks[-1]) <= chunk_size)
+            self.assertEqual([s for c in chunks for s in c], seqfos)
+        queries = [s['name'] for s in seqfos[3:9]]
+        self.assertEqual([s['name'] for c in utils.iter_fastx_chunks(self.fname, 4, queries=queries) for s in c], queries)
+
+# ----------------------------------------------------------------------------------------
+class TestGreedyCentroidCluster(unittest.TestCase):
+    # ----------------------------------------------------------------------------------------
+    def test_no_overlap(self):  # a seq with no unambiguous overlap with a centroid (e.g. all Ns) shouldn't get merged with it, or have anything merged with it
+        seqdict = {'e' : 'NNNNNNNNNN', 'a' : 'ACGTACGTAC', 'b' : 'ACGTACGTAA', 'c' : 'TTTTGGGGCC'}
+        sizes = {'e' : 10, 'a' : 5, 'b' : 1, 'c' : 1}
+        partition = utils.greedy_centroid_cluster(seqdict, 0.15, sizes=sizes)
+        self.assertEqual(sorted(sorted(c) for c in partition), [['a', 'b'], ['c'], ['e']])
+
+# ----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()